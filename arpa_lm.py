@@ -0,0 +1,188 @@
+import gzip
+import io
+
+import numpy as np
+
+from decoder import Scorer, LOG_10
+
+UNK_LOG_PROB = -100.  # log10 probability of out of vocabulary words if the model has no <unk>, as in KenLM
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path), encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+class ArpaLM(object):
+    def __init__(self, vocab, logprobs, backoffs, keys):
+        """
+        Backoff n-gram model stored as a sorted array trie. The n-grams of order n are sorted by the key
+        parent * len(vocab) + word, where parent is the index of their (n-1)-gram prefix in order n-1
+        (the word id itself for unigrams), so a child is found with one binary search.
+        Probabilities and backoffs are log10, as in the ARPA file.
+        :param vocab: list of words, the word id is the index of the unigram
+        :param logprobs: per order, float32 array of n-gram probabilities
+        :param backoffs: per order, float32 array of backoff weights (empty for the highest order)
+        :param keys: per order, sorted int64 array of n-gram keys (empty for unigrams)
+        """
+        self.vocab = vocab
+        self.word_ids = {w: i for i, w in enumerate(vocab)}
+        self.logprobs = logprobs
+        self.backoffs = backoffs
+        self.keys = keys
+        self.order = len(logprobs)
+        self.unk_id = self.word_ids.get('<unk>')
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an ARPA file (optionally gzipped), or arrays saved by ArpaLM.save() if the path ends with .npz.
+        """
+        if path.endswith('.npz'):
+            arrays = np.load(path)
+            order = int(arrays['order'])
+            return cls(vocab=arrays['vocab'].tolist(),
+                       logprobs=[arrays['logprobs_%d' % n] for n in range(order)],
+                       backoffs=[arrays['backoffs_%d' % n] for n in range(order)],
+                       keys=[arrays['keys_%d' % n] for n in range(order)])
+        return cls.from_arpa(path)
+
+    def save(self, path):
+        """
+        Saves the arrays to a .npz file, which loads much faster than parsing the ARPA file again.
+        """
+        arrays = {'order': np.array(self.order), 'vocab': np.array(self.vocab)}
+        for n in range(self.order):
+            arrays['logprobs_%d' % n] = self.logprobs[n]
+            arrays['backoffs_%d' % n] = self.backoffs[n]
+            arrays['keys_%d' % n] = self.keys[n]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def from_arpa(cls, path):
+        counts = []
+        sections = []
+        current = None
+        with _open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('ngram ') and current is None:
+                    counts.append(int(line.split('=')[1]))
+                elif line.startswith('\\') and line.endswith('-grams:'):
+                    current = int(line[1:line.index('-')])
+                    sections.append(([], [], []))
+                elif line == '\\end\\':
+                    break
+                elif current is not None:
+                    parts = line.split()
+                    words, logprobs, backoffs = sections[current - 1]
+                    words.append(parts[1:current + 1])
+                    logprobs.append(float(parts[0]))
+                    backoffs.append(float(parts[current + 1]) if len(parts) > current + 1 else 0.)
+        if not sections:
+            raise ValueError("{} is not an ARPA file".format(path))
+
+        vocab = [words[0] for words in sections[0][0]]
+        word_ids = {w: i for i, w in enumerate(vocab)}
+        size = len(vocab)
+        logprobs = [np.array(sections[0][1], dtype=np.float32)]
+        backoffs = [np.array(sections[0][2], dtype=np.float32)]
+        keys = [np.zeros(0, dtype=np.int64)]
+        skipped = 0
+        for n in range(2, len(sections) + 1):
+            words, probs, bows = sections[n - 1]
+            ids = np.array([[word_ids.get(w, -1) for w in ngram] for ngram in words], dtype=np.int64)
+            ids = ids.reshape(len(words), n)
+            valid = (ids >= 0).all(1)
+            parent = np.where(valid, ids[:, 0], 0)
+            for j in range(1, n - 1):
+                parent, found = cls._find(keys[j], parent * size + ids[:, j])
+                valid &= found
+            skipped += int((~valid).sum())
+            order_keys = (parent * size + ids[:, n - 1])[valid]
+            sort = np.argsort(order_keys, kind='stable')
+            keys.append(order_keys[sort])
+            logprobs.append(np.array(probs, dtype=np.float32)[valid][sort])
+            backoffs.append(np.array(bows, dtype=np.float32)[valid][sort])
+        backoffs[-1] = np.zeros(0, dtype=np.float32)
+        if skipped:
+            print("Skipped {} n-grams of {} with unknown words or missing prefixes".format(skipped, path))
+        if counts and counts[0] != len(vocab):
+            print("Warning: {} declares {} unigrams, found {}".format(path, counts[0], len(vocab)))
+        return cls(vocab, logprobs, backoffs, keys)
+
+    @staticmethod
+    def _find(keys, queries):
+        positions = np.minimum(np.searchsorted(keys, queries), max(len(keys) - 1, 0))
+        found = keys[positions] == queries if len(keys) else np.zeros(len(queries), dtype=bool)
+        return positions, found
+
+    def word_id(self, word):
+        return self.word_ids.get(word, self.unk_id)
+
+    def index(self, ids):
+        """
+        :return: index of the n-gram with the given word ids in its order, None if it isn't in the model
+        """
+        index = ids[0]
+        size = len(self.vocab)
+        for n in range(1, len(ids)):
+            keys = self.keys[n]
+            key = index * size + ids[n]
+            index = int(keys.searchsorted(key))
+            if index == len(keys) or keys[index] != key:
+                return None
+        return index
+
+    def score(self, context, word_id):
+        """
+        Backoff probability of a word.
+        :param context: tuple of previous word ids, most recent last
+        :return: log10 probability, and the context after the word reduced to the longest suffix in the model
+        """
+        if word_id is None:
+            return UNK_LOG_PROB, ()
+        ids = context[max(0, len(context) - self.order + 1):] + (word_id,)
+        for start in range(len(ids)):
+            index = self.index(ids[start:])
+            if index is not None:
+                log_prob = float(self.logprobs[len(ids) - start - 1][index])
+                break
+        # contexts longer than the matched one back off
+        for s in range(start):
+            index = self.index(ids[s:-1])
+            if index is not None:
+                log_prob += float(self.backoffs[len(ids) - s - 2][index])
+        ids = ids[max(0, len(ids) - self.order + 1):]
+        for start in range(len(ids)):
+            if self.index(ids[start:]) is not None:
+                return log_prob, ids[start:]
+        return log_prob, ()
+
+    def sentence_start(self):
+        bos = self.word_ids.get('<s>')
+        return (bos,) if bos is not None else ()
+
+    def nbytes(self):
+        return sum(a.nbytes for arrays in (self.logprobs, self.backoffs, self.keys) for a in arrays)
+
+
+class ArpaScorer(Scorer):
+    def __init__(self, lm_path, alpha=0, beta=0, cache_size=100000):
+        """
+        Scorer backed by ArpaLM, doesn't need kenlm.
+        :param lm_path: ARPA file (.arpa, .arpa.gz) or arrays saved by ArpaLM.save() (.npz)
+        """
+        super(ArpaScorer, self).__init__(alpha, beta, cache_size)
+        self.lm_path = lm_path
+        self.lm = ArpaLM.load(lm_path)
+
+    def start(self):
+        return self.lm.sentence_start()
+
+    def score(self, state, word):
+        log_prob, state = self.lm.score(state, self.lm.word_id(word))
+        return log_prob * LOG_10, state
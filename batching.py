@@ -0,0 +1,95 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher(object):
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=10., num_workers=1):
+        """
+        Groups requests submitted concurrently (e.g. by server threads) into batches.
+        A batch is started when max_batch_size requests are waiting, or when the oldest waiting request has waited
+        max_wait_ms. It takes the oldest request and the waiting requests closest to it in length.
+        :param run_batch: function of a list of items returning a list of results, called in num_workers threads
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.batches = 0
+        self.requests = 0
+        self._pending = []  # (arrival time, length, item, future), oldest first
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, item, length):
+        """
+        :return: a concurrent.futures.Future of the result of the item
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._pending.append((time.perf_counter(), length, item, future))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item, length):
+        return self.submit(item, length).result()
+
+    def close(self):
+        """
+        Runs the waiting requests and stops the workers.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def stats(self):
+        return {'batches': self.batches, 'requests': self.requests, 'waiting': len(self._pending),
+                'mean_batch_size': self.requests / max(self.batches, 1)}
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                wait = self._pending[0][0] + self.max_wait - time.perf_counter()
+                if len(self._pending) >= self.max_batch_size or wait <= 0 or self._closed:
+                    return self._take()
+                self._cond.wait(wait)
+
+    def _take(self):
+        pending = self._pending
+        size = min(self.max_batch_size, len(pending))
+        by_length = sorted(range(len(pending)), key=lambda i: pending[i][1])
+        oldest = by_length.index(0)
+        # the window of `size` requests in length order that contains the oldest one and has the least spread
+        start = min(range(max(0, oldest - size + 1), min(oldest, len(pending) - size) + 1),
+                    key=lambda s: pending[by_length[s + size - 1]][1] - pending[by_length[s]][1])
+        chosen = set(by_length[start:start + size])
+        self._pending = [r for i, r in enumerate(pending) if i not in chosen]
+        return [r for i, r in enumerate(pending) if i in chosen]
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.run_batch([item for _, _, item, _ in batch])
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, _, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            with self._cond:
+                self.batches += 1
+                self.requests += len(batch)
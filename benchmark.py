@@ -1,4 +1,5 @@
 import argparse
+import gc
 import json
 import time
 import torch
@@ -28,6 +29,11 @@ parser.add_argument('--dist_url', default='tcp://127.0.0.1:1550', type=str,
 parser.add_argument('--dist_backend', default='gloo', type=str, help='distributed backend')
 parser.add_argument('--world_size', default=1, type=int, help='number of distributed processes')
 parser.add_argument('--rank', default=0, type=int, help='The rank of this process')
+parser.add_argument('--recompute-rnns', default=0, type=int,
+                    help='Recompute RNN activations in backward for every group of N layers (0 disables)')
+parser.add_argument('--memory-report', default='', type=str,
+                    help='Comma separated durations in seconds, e.g. 5,10,15,30. Compares peak memory and throughput '
+                         'of a training step with and without RNN recomputation instead of the regular benchmark')
 args = parser.parse_args()
 
 args.distributed = args.world_size > 1
@@ -35,11 +41,14 @@ if args.distributed:
     dist.init_process_group(backend=args.dist_backend, init_method=args.dist_url,
                             world_size=args.world_size, rank=args.rank)
 
-if args.distributed:
+if args.memory_report:
+    input_data = None  # allocated per duration, so that it doesn't count against the peak memory
+elif args.distributed:
     input_data = torch.randn(int(args.num_samples / args.world_size), 1, 161, args.seconds * 100).cuda()
 else:
     input_data = torch.randn(args.num_samples, 1, 161, args.seconds * 100).cuda()
-input_data = torch.chunk(input_data, int(len(input_data) / args.batch_size))
+if input_data is not None:
+    input_data = torch.chunk(input_data, int(len(input_data) / args.batch_size))
 
 rnn_type = args.rnn_type.lower()
 assert rnn_type in supported_rnns, "rnn_type should be either lstm, rnn or gru"
@@ -54,7 +63,8 @@ model = DeepSpeech(rnn_hidden_size=args.hidden_size,
                    nb_layers=args.hidden_layers,
                    audio_conf=audio_conf,
                    labels=labels,
-                   rnn_type=supported_rnns[rnn_type])
+                   rnn_type=rnn_type,
+                   recompute_rnns=args.recompute_rnns)
 
 print("Number of parameters: %d" % DeepSpeech.get_param_size(model))
 
@@ -73,15 +83,16 @@ batch_size = int(args.batch_size)
 
 def iteration(inputs):
     # targets, align half of the audio
-    targets = torch.ones(int(batch_size * ((seconds * 100) / 2)))
-    target_sizes = torch.empty(batch_size, dtype=torch.int).fill_(int((seconds * 100) / 2))
+    batch_size = inputs.size(0)
+    targets = torch.ones(int(batch_size * (inputs.size(3) / 2)), dtype=torch.int)
+    target_sizes = torch.empty(batch_size, dtype=torch.int).fill_(int(inputs.size(3) / 2))
     input_percentages = torch.ones(batch_size).fill_(1)
     input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
 
-    out, output_sizes = model(inputs, input_sizes)
+    out, _, output_sizes = model(inputs, input_sizes)
     out = out.transpose(0, 1)  # TxNxH
 
-    loss = criterion(out, targets, output_sizes, target_sizes)
+    loss = criterion(out, targets, output_sizes.cpu(), target_sizes)
     loss = loss / inputs.size(0)  # average the loss by minibatch
     # compute gradient
     optimizer.zero_grad()
@@ -110,6 +121,43 @@ def run_benchmark():
     return running_time / float(args.runs)
 
 
-run_time = run_benchmark()
+def memory_report(durations):
+    """
+    Runs training steps of the given durations with and without RNN recomputation
+    and prints peak GPU memory and throughput for each.
+    """
+    m = model.module if DeepSpeech.is_parallel(model) else model
+    groups = [0, args.recompute_rnns or 1]
+    rows = []
+    for duration in durations:
+        for group in groups:
+            m.recompute_rnns = group
+            gc.collect()
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+            try:
+                inputs = torch.randn(batch_size, 1, 161, int(duration * 100)).cuda()
+                iteration(inputs)  # dry run
+                start_time = time.time()
+                for n in range(args.runs):
+                    iteration(inputs)
+                run_time = (time.time() - start_time) / args.runs
+                peak = torch.cuda.max_memory_allocated() / 1024 ** 2
+                rows.append((duration, group, '%.0f' % peak, '%.3f' % run_time, '%.2f' % (batch_size / run_time)))
+                del inputs
+            except RuntimeError as e:
+                if 'out of memory' not in str(e):
+                    raise
+                optimizer.zero_grad()
+                rows.append((duration, group, 'OOM', '-', '-'))
+    print("\n{:>10} {:>10} {:>14} {:>12} {:>12}".format('Seconds', 'Recompute', 'Peak mem (MB)', 'Sec/iter', 'Utt/sec'))
+    for row in rows:
+        print("{:>10} {:>10} {:>14} {:>12} {:>12}".format(*row))
+
+
+if args.memory_report:
+    memory_report([float(x) for x in args.memory_report.split(',')])
+else:
+    run_time = run_benchmark()
 
-print("\n Average run time: %.2fs" % run_time)
+    print("\n Average run time: %.2fs" % run_time)
@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+from decoder import GreedyDecoder, PrefixBeamCTCDecoder, BeamCTCDecoder
+from logits_store import LogitsStore
+from sparse_logits import load_probs
+
+parser = argparse.ArgumentParser(description='DeepSpeech decoder benchmark')
+parser.add_argument('--outputs', default='', type=str,
+                    help='File list written by test.py --output-path or a store written by --output-store, '
+                         'synthetic probabilities are used if empty')
+parser.add_argument('--labels-path', default='labels.json', help='Contains all characters for transcription')
+parser.add_argument('--num-utterances', default=50, type=int, help='Number of utterances to decode')
+parser.add_argument('--frames', default=500, type=int, help='Output frames per synthetic utterance')
+parser.add_argument('--batch-size', default=10, type=int, help='Utterances per decode call')
+parser.add_argument('--beam-widths', default='10,100', type=str, help='Comma separated beam widths to try')
+parser.add_argument('--num-processes', default='1,4', type=str, help='Comma separated worker counts to try')
+parser.add_argument('--cutoff-top-n', default=40, type=int, help='Only the top N characters are extended per step')
+parser.add_argument('--cutoff-prob', default=1.0, type=float, help='Cumulative probability cutoff per step')
+parser.add_argument('--lm-path', default=None, type=str, help='Optional kenlm language model')
+parser.add_argument('--alpha', default=0.8, type=float, help='Language model weight')
+parser.add_argument('--beta', default=1, type=float, help='Language model word bonus (all words)')
+parser.add_argument('--seed', default=123456, type=int, help='Seed for the synthetic probabilities')
+
+
+def synthetic_probs(num_utterances, frames, num_labels, seed):
+    """
+    Peaky CTC-like outputs: mostly blank, with a random confident label every few frames.
+    """
+    rng = np.random.RandomState(seed)
+    result = []
+    for _ in range(num_utterances):
+        logits = rng.randn(frames, num_labels).astype(np.float32)
+        logits[:, 0] += 4
+        spikes = rng.rand(frames) < 0.3
+        logits[spikes, rng.randint(1, num_labels, spikes.sum())] += 8
+        probs = np.exp(logits - logits.max(1, keepdims=True))
+        result.append(probs / probs.sum(1, keepdims=True))
+    return result
+
+
+def load_outputs(path, num_utterances):
+    if os.path.isdir(path):
+        store = LogitsStore(path)
+        return [np.asarray(store.get(i), dtype=np.float32) for i in range(min(num_utterances, len(store)))]
+    with open(path) as f:
+        files = [line.strip() for line in f if line.strip()][:num_utterances]
+    result = []
+    for filename in files:
+        with open(filename, 'rb') as f:
+            result.append(load_probs(pickle.load(f)))
+    return result
+
+
+def batches(utterances, batch_size):
+    for i in range(0, len(utterances), batch_size):
+        chunk = utterances[i:i + batch_size]
+        sizes = torch.IntTensor([len(p) for p in chunk])
+        probs = torch.zeros(len(chunk), int(sizes.max()), chunk[0].shape[1])
+        for j, p in enumerate(chunk):
+            probs[j, :len(p)] = torch.from_numpy(p)
+        yield probs, sizes
+
+
+def run(decoder, utterances, batch_size):
+    transcripts = []
+    decoder.decode(*next(batches(utterances[:1], 1)))  # warm up, starts worker pools
+    start_time = time.perf_counter()
+    for probs, sizes in batches(utterances, batch_size):
+        strings, _ = decoder.decode(probs, sizes)
+        transcripts.extend(s[0] for s in strings)
+    return time.perf_counter() - start_time, transcripts
+
+
+def agreement(decoder, transcripts, reference):
+    """
+    Character error rate in percents of the transcripts relative to a reference decoder output.
+    """
+    errors = sum(decoder.cer(t, r) for t, r in zip(transcripts, reference))
+    return 100. * errors / max(1, sum(len(r) for r in reference))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with open(args.labels_path) as label_file:
+        labels = str(''.join(json.load(label_file)))
+    blank_index = labels.index('_')
+
+    if args.outputs:
+        utterances = load_outputs(args.outputs, args.num_utterances)
+    else:
+        utterances = synthetic_probs(args.num_utterances, args.frames, len(labels), args.seed)
+    total_frames = sum(len(p) for p in utterances)
+
+    try:
+        import ctcdecode
+        has_ctcdecode = True
+    except ImportError:
+        has_ctcdecode = False
+        print("ctcdecode is not installed, skipping BeamCTCDecoder")
+
+    lm = dict(lm_path=args.lm_path, alpha=args.alpha, beta=args.beta)
+    configs = [('greedy', GreedyDecoder(labels, blank_index=blank_index))]
+    for beam_width in [int(x) for x in args.beam_widths.split(',')]:
+        for num_processes in [int(x) for x in args.num_processes.split(',')]:
+            kwargs = dict(lm, cutoff_top_n=args.cutoff_top_n, cutoff_prob=args.cutoff_prob, beam_width=beam_width,
+                          num_processes=num_processes, blank_index=blank_index)
+            configs.append(('prefix w={} p={}'.format(beam_width, num_processes),
+                            PrefixBeamCTCDecoder(labels, **kwargs)))
+            if has_ctcdecode:
+                configs.append(('ctcdecode w={} p={}'.format(beam_width, num_processes),
+                                BeamCTCDecoder(labels, **kwargs)))
+
+    print("{} utterances, {} output frames".format(len(utterances), total_frames))
+    print("{:<24} {:>10} {:>14} {:>16} {:>14}".format('Decoder', 'Total (s)', 'ms/utterance', 'ms/1000 frames',
+                                                      'CER vs greedy'))
+    greedy = None
+    for name, decoder in configs:
+        elapsed, transcripts = run(decoder, utterances, args.batch_size)
+        if greedy is None:
+            greedy = transcripts
+        print("{:<24} {:>10.3f} {:>14.2f} {:>16.2f} {:>13.2f}%".format(
+            name, elapsed, 1000 * elapsed / len(utterances), 1e6 * elapsed / total_frames,
+            agreement(decoder, transcripts, greedy)))
@@ -0,0 +1,121 @@
+import argparse
+import os
+import random
+import time
+
+import numpy as np
+
+from arpa_lm import ArpaLM, ArpaScorer
+
+parser = argparse.ArgumentParser(description='ARPA language model benchmark')
+parser.add_argument('--lm-path', default='', type=str, help='ARPA file to benchmark')
+parser.add_argument('--generate', default='lm_benchmark.arpa', type=str,
+                    help='Where to write a synthetic ARPA file if --lm-path is not given')
+parser.add_argument('--vocab-size', default=50000, type=int, help='Words in the synthetic model')
+parser.add_argument('--ngrams', default='1000000,1000000', type=str,
+                    help='Comma separated number of bigrams, trigrams, ... of the synthetic model')
+parser.add_argument('--sentences', default=2000, type=int, help='Number of query sentences')
+parser.add_argument('--sentence-length', default=20, type=int, help='Words per query sentence')
+parser.add_argument('--beams', default=10, type=int,
+                    help='Every sentence is scored this many times, as by the beams of a search')
+parser.add_argument('--cache-size', default=100000, type=int, help='Scorer cache size')
+parser.add_argument('--seed', default=123456, type=int, help='Seed for the synthetic model and queries')
+
+
+def generate_arpa(path, vocab_size, ngrams, seed):
+    """
+    Writes a random backoff model. As in real ARPA files, both the prefix and the suffix of every n-gram
+    are in the model, so the number of n-grams written can be smaller than requested.
+    """
+    rng = np.random.RandomState(seed)
+    vocab = ['<unk>', '<s>', '</s>'] + ['w%d' % i for i in range(vocab_size - 3)]
+    orders = [[(w,) for w in vocab]]
+    for count in ngrams:
+        previous = orders[-1]
+        known = set(previous)
+        parents = rng.randint(0, len(previous), count)
+        # zipf-like word choice, so that frequent words have many continuations
+        words = np.minimum(rng.zipf(1.3, count), vocab_size) - 1
+        grams = set(previous[p] + (vocab[w],) for p, w in zip(parents, words))
+        orders.append(sorted(gram for gram in grams if gram[1:] in known))
+    with open(path, 'w') as f:
+        f.write('\n\\data\\\n')
+        for n, grams in enumerate(orders):
+            f.write('ngram {}={}\n'.format(n + 1, len(grams)))
+        for n, grams in enumerate(orders):
+            f.write('\n\\{}-grams:\n'.format(n + 1))
+            logprobs = -rng.uniform(0.5, 6, len(grams))
+            backoffs = -rng.uniform(0, 1, len(grams))
+            for gram, logprob, backoff in zip(grams, logprobs, backoffs):
+                if n + 1 < len(orders):
+                    f.write('{:.4f}\t{}\t{:.4f}\n'.format(logprob, ' '.join(gram), backoff))
+                else:
+                    f.write('{:.4f}\t{}\n'.format(logprob, ' '.join(gram)))
+        f.write('\n\\end\\\n')
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+def score_sentences(scorer, sentences, beams):
+    queries = 0
+    for sentence in sentences:
+        for _ in range(beams):
+            state = scorer.start()
+            for word in sentence:
+                _, state = scorer.word_score(state, word)
+                queries += 1
+    return queries
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    lm_path = args.lm_path
+    if not lm_path:
+        lm_path = args.generate
+        ngrams = [int(x) for x in args.ngrams.split(',')]
+        _, elapsed = timed(generate_arpa, lm_path, args.vocab_size, ngrams, args.seed)
+        print("Generated {} in {:.1f}s".format(lm_path, elapsed))
+    print("ARPA file size:      {:.1f} MB".format(os.path.getsize(lm_path) / 1024 ** 2))
+
+    lm, parse_time = timed(ArpaLM.load, lm_path)
+    npz_path = os.path.splitext(lm_path)[0] + '.npz'
+    lm.save(npz_path)
+    _, npz_time = timed(ArpaLM.load, npz_path)
+    print("N-grams per order:   {}".format([len(p) for p in lm.logprobs]))
+    print("Array memory:        {:.1f} MB".format(lm.nbytes() / 1024 ** 2))
+    print("Load time (ARPA):    {:.2f}s".format(parse_time))
+    print("Load time (.npz):    {:.2f}s".format(npz_time))
+
+    # queries continue with a bigram of the previous word most of the time, so that all backoff paths are used
+    random.seed(args.seed)
+    bigrams = lm.keys[1] if lm.order > 1 else np.zeros(0, dtype=np.int64)
+    size = len(lm.vocab)
+    sentences = []
+    for _ in range(args.sentences):
+        sentence = [random.choice(lm.vocab)]
+        while len(sentence) < args.sentence_length:
+            previous = lm.word_ids[sentence[-1]]
+            start, end = bigrams.searchsorted([previous * size, (previous + 1) * size])
+            if end > start and random.random() < 0.8:
+                sentence.append(lm.vocab[int(bigrams[random.randrange(start, end)]) % size])
+            else:
+                sentence.append(random.choice(lm.vocab))
+        sentences.append(sentence)
+
+    configs = [('arpa, no cache', ArpaScorer(npz_path, cache_size=0)),
+               ('arpa, cache {}'.format(args.cache_size), ArpaScorer(npz_path, cache_size=args.cache_size))]
+    try:
+        from decoder import KenLMScorer
+        configs.append(('kenlm, no cache', KenLMScorer(lm_path, cache_size=0)))
+    except ImportError:
+        print("kenlm is not installed, skipping KenLMScorer")
+    print("")
+    print("{:<24} {:>10} {:>12} {:>10}".format('Scorer', 'Queries', 'us/query', 'Hit rate'))
+    for name, scorer in configs:
+        queries, elapsed = timed(score_sentences, scorer, sentences, args.beams)
+        hit_rate = '{:.1f}%'.format(100. * scorer.hits / queries) if scorer.cache_size else 'n/a'
+        print("{:<24} {:>10} {:>12.2f} {:>10}".format(name, queries, 1e6 * elapsed / queries, hit_rate))
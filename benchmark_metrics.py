@@ -0,0 +1,97 @@
+import argparse
+import random
+import time
+from multiprocessing import Pool
+
+from data.utils import get_cer_wer, get_batch_cer_wer
+from decoder import Decoder
+
+parser = argparse.ArgumentParser(description='WER/CER computation benchmark')
+parser.add_argument('--utterances', default=20000, type=int, help='Number of synthetic transcript pairs')
+parser.add_argument('--words', default=20, type=int, help='Average number of words per reference')
+parser.add_argument('--vocab-size', default=5000, type=int, help='Number of distinct synthetic words')
+parser.add_argument('--error-rate', default=0.2, type=float, help='Fraction of corrupted words in transcripts')
+parser.add_argument('--batch-size', default=20, type=int, help='Batch size of the batched API')
+parser.add_argument('--num-processes', default='2,4', type=str, help='Comma separated pool sizes to try')
+parser.add_argument('--seed', default=123456, type=int, help='Seed for the synthetic transcripts')
+
+
+def synthetic_pairs(utterances, words, vocab_size, error_rate, seed):
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocab = [''.join(rng.choice(letters) for _ in range(rng.randint(1, 10))) for _ in range(vocab_size)]
+    transcripts, references = [], []
+    for _ in range(utterances):
+        reference = [rng.choice(vocab) for _ in range(rng.randint(1, 2 * words))]
+        transcript = []
+        for word in reference:
+            r = rng.random()
+            if r < error_rate / 3:
+                continue  # deletion
+            elif r < 2 * error_rate / 3:
+                transcript.append(rng.choice(vocab))  # substitution
+            elif r < error_rate:
+                transcript.extend([word, rng.choice(vocab)])  # insertion
+            else:
+                transcript.append(word)
+        transcripts.append(' '.join(transcript))
+        references.append(' '.join(reference))
+    return transcripts, references
+
+
+def per_pair(transcripts, references):
+    decoder = Decoder('_ abcdefghijklmnopqrstuvwxyz')
+    return [get_cer_wer(decoder, t, r) for t, r in zip(transcripts, references)]
+
+
+def batched(transcripts, references, batch_size, pool=None):
+    errors = []
+    for i in range(0, len(transcripts), batch_size):
+        errors.extend(get_batch_cer_wer(transcripts[i:i + batch_size], references[i:i + batch_size], pool)[0])
+    return errors
+
+
+def reference_counts(transcripts, references):
+    """
+    The numbers computed pair by pair with Decoder.wer() and Decoder.cer(), as before the batched API.
+    """
+    decoder = Decoder('_ abcdefghijklmnopqrstuvwxyz')
+    counts = []
+    for transcript, reference in zip(transcripts, references):
+        reference, transcript = reference.strip(), transcript.strip()
+        wer_ref = float(len(reference.split()) or 1)
+        cer_ref = float(len(reference.replace(' ', '')) or 1)
+        counts.append((decoder.wer(transcript, reference), decoder.cer(transcript, reference), wer_ref, cer_ref))
+    return counts
+
+
+def timed(function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    transcripts, references = synthetic_pairs(args.utterances, args.words, args.vocab_size, args.error_rate,
+                                              args.seed)
+    expected, baseline = timed(reference_counts, transcripts, references)
+
+    configs = [('per pair', per_pair, ()),
+               ('batch {}'.format(args.batch_size), batched, (args.batch_size,)),
+               ('whole set', batched, (len(transcripts),))]
+    pools = []
+    for num_processes in [int(x) for x in args.num_processes.split(',') if x]:
+        pool = Pool(num_processes)
+        pools.append(pool)
+        configs.append(('whole set, {} processes'.format(num_processes), batched, (len(transcripts), pool)))
+
+    print("{} utterances, {} reference words".format(len(transcripts), sum(len(r.split()) for r in references)))
+    print("{:<26} {:>10} {:>16} {:>8}".format('Method', 'Time (s)', 'Utterances/s', 'Exact'))
+    print("{:<26} {:>10.3f} {:>16.0f} {:>8}".format('Decoder.wer/cer', baseline, len(transcripts) / baseline, 'True'))
+    for name, function, extra in configs:
+        errors, elapsed = timed(function, transcripts, references, *extra)
+        exact = [tuple(e) for e in errors] == expected
+        print("{:<26} {:>10.3f} {:>16.0f} {:>8}".format(name, elapsed, len(transcripts) / elapsed, str(exact)))
+    for pool in pools:
+        pool.close()
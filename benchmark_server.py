@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description='Load test of the transcription server')
+parser.add_argument('--url', default='http://localhost:8888/transcribe', help='Transcription endpoint')
+parser.add_argument('--audio-path', nargs='+', required=True, help='Audio files to send, used in turn')
+parser.add_argument('--requests', default=200, type=int, help='Total number of requests')
+parser.add_argument('--concurrency', default=16, type=int, help='Number of requests in flight')
+parser.add_argument('--repeat-payloads', action='store_true',
+                    help='Send the files unchanged, so that repeated files are answered from the result cache of the '
+                         'server. By default random bytes are appended to every request (after the end of the audio '
+                         'data of a WAV file) to make it unique, so that the numbers measure transcription')
+
+
+def post_file(url, path, data):
+    boundary = uuid.uuid4().hex
+    body = ('--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').format(boundary, os.path.basename(path)).encode()
+    body += data + '\r\n--{}--\r\n'.format(boundary).encode()
+    request = Request(url, data=body, headers={'Content-Type': 'multipart/form-data; boundary=' + boundary})
+    start_time = time.perf_counter()
+    with urlopen(request) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    return time.perf_counter() - start_time, result.get('status') == 'OK'
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    files = []
+    for path in args.audio_path:
+        with open(path, 'rb') as f:
+            files.append((path, f.read()))
+
+    def run(i):
+        path, data = files[i % len(files)]
+        if not args.repeat_payloads:
+            data += os.urandom(16)
+        try:
+            return post_file(args.url, path, data)
+        except Exception as e:
+            print("Request {} failed: {}".format(i, e))
+            return None, False
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(run, range(args.requests)))
+    total_time = time.perf_counter() - start_time
+
+    latencies = np.array([latency for latency, ok in results if ok]) * 1000
+    print("{} requests, concurrency {}, {} failed".format(args.requests, args.concurrency,
+                                                         args.requests - len(latencies)))
+    if len(latencies):
+        print("Latency (ms): p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+            *np.percentile(latencies, [50, 90, 99, 100])))
+    print("Throughput: {:.2f} requests/s".format(len(latencies) / total_time))
@@ -0,0 +1,255 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import torch
+from tqdm import tqdm
+
+from data.data_loader import SpectrogramDataset, AudioDataLoader
+from data.utils import get_batch_cer_wer
+from decoder import GreedyDecoder
+from model import DeepSpeech
+
+parser = argparse.ArgumentParser(description='DeepSpeech low-rank compression')
+parser.add_argument('--model-path', default='models/deepspeech_final.pth',
+                    help='Path to model file created by training')
+parser.add_argument('--output-path', default='models/deepspeech_lowrank_{}.pth',
+                    help='Where to save compressed models, {} is replaced by the rank setting')
+parser.add_argument('--ranks', default='', type=str, help='Comma separated ranks to try, e.g. 128,256,512')
+parser.add_argument('--energies', default='', type=str,
+                    help='Comma separated fractions of the singular value energy to keep, e.g. 0.9,0.95,0.99')
+parser.add_argument('--layers', default='', type=str, help='Comma separated RNN layers to factorize (default all)')
+parser.add_argument('--cuda', action="store_true", help='Use cuda to evaluate the model')
+parser.add_argument('--seconds', default=10, type=int, help='Duration of the synthetic input for latency runs')
+parser.add_argument('--runs', default=5, type=int, help='How many runs to average latency over')
+parser.add_argument('--test-manifest', metavar='DIR', default='',
+                    help='Path to manifest csv to measure WER on (skipped if empty)')
+parser.add_argument('--cache-dir', metavar='DIR', help='path to save temp audio', default='data/cache/')
+parser.add_argument('--batch-size', default=20, type=int, help='Batch size for evaluation')
+parser.add_argument('--num-workers', default=4, type=int, help='Number of workers used in dataloading')
+parser.add_argument('--norm', default='max_frame', action="store",
+                    help='Normalize sounds. Choices: "mean", "frame", "max_frame", "none"')
+parser.add_argument('--finetune-epochs', default=0, type=int,
+                    help='Fine-tune each compressed model with train.py for this many epochs (0 disables)')
+parser.add_argument('--train-manifest', metavar='DIR', default='data/train_manifest.csv',
+                    help='path to train manifest csv used for fine-tuning')
+parser.add_argument('--val-manifest', metavar='DIR', default='data/val_manifest.csv',
+                    help='path to validation manifest csv used for fine-tuning')
+parser.add_argument('--finetune-args', default='', type=str,
+                    help='Extra arguments passed to train.py when fine-tuning, e.g. "--lr 1e-4 --batch-size 16"')
+
+
+def energy_rank(singular_values, energy):
+    """
+    Smallest rank that keeps the given fraction of the squared singular values.
+    """
+    cumulative = torch.cumsum(singular_values ** 2, 0)
+    cumulative = cumulative / cumulative[-1]
+    return int((cumulative < energy).sum().item()) + 1
+
+
+def input_weights(batch_rnn):
+    """
+    Returns the input-to-hidden matrices of both directions stacked into a single (G*H*D)xI matrix,
+    so that both directions share one projection.
+    """
+    rnn = batch_rnn.rnn
+    weights = [rnn.weight_ih_l0.data]
+    if batch_rnn.bidirectional:
+        weights.append(rnn.weight_ih_l0_reverse.data)
+    weight = torch.cat(weights, 0)
+    if batch_rnn.projection is not None:
+        weight = torch.mm(weight, batch_rnn.projection.weight.data)
+    return weight
+
+
+def factorize(model, rank=None, energy=None, layers=None):
+    """
+    Replaces the input-to-hidden matrices W of the selected BatchRNN layers with SVD factors U x V,
+    where V becomes the layer projection and U the new (narrower) RNN input weights.
+    Layers where the factorization does not reduce the parameter count are left untouched.
+    :param rank: Fixed rank to use for every layer
+    :param energy: Fraction of singular value energy to keep, chooses the rank per layer
+    :param layers: Indices of RNN layers to factorize, all layers if None
+    :return: New DeepSpeech model and the ranks chosen per layer
+    """
+    assert (rank is None) != (energy is None), "Either rank or energy has to be given"
+    if model._rnn_type == 'cnn':
+        raise ValueError("Low-rank factorization is only supported for recurrent models")
+    state_dict = model.state_dict()
+    ranks = []
+    factors = {}
+    for i, batch_rnn in enumerate(model.rnns):
+        weight = input_weights(batch_rnn)
+        if layers is not None and i not in layers:
+            ranks.append(batch_rnn.rank)
+            continue
+        u, s, v = torch.svd(weight)
+        r = rank if rank is not None else energy_rank(s, energy)
+        r = min(r, s.size(0))
+        rows, cols = weight.size()
+        if r * (rows + cols) >= rows * cols:
+            # the factorization would be bigger than the dense matrix
+            r = None
+        else:
+            root = s[:r].sqrt()
+            factors[i] = (u[:, :r] * root, (v[:, :r] * root).t())
+        ranks.append(r)
+
+    compressed = DeepSpeech(rnn_hidden_size=model._hidden_size,
+                            nb_layers=model._hidden_layers,
+                            labels=model._labels,
+                            audio_conf=model._audio_conf,
+                            rnn_type=model._rnn_type,
+                            bnm=model._bnm,
+                            bidirectional=model._bidirectional,
+                            rnn_ranks=ranks,
+                            packed_rnns=model.packed_rnns)
+    for i, batch_rnn in enumerate(model.rnns):
+        prefix = 'rnns.%d.' % i
+        if i in factors:
+            u, v = factors[i]
+            weight_ih = u.chunk(2, 0) if batch_rnn.bidirectional else (u,)
+            state_dict[prefix + 'rnn.weight_ih_l0'] = weight_ih[0].contiguous()
+            if batch_rnn.bidirectional:
+                state_dict[prefix + 'rnn.weight_ih_l0_reverse'] = weight_ih[1].contiguous()
+            state_dict[prefix + 'projection.weight'] = v.contiguous()
+        elif ranks[i] is None and batch_rnn.projection is not None:
+            # rank was dropped, multiply the existing factors back
+            weight = input_weights(batch_rnn)
+            weight_ih = weight.chunk(2, 0) if batch_rnn.bidirectional else (weight,)
+            state_dict[prefix + 'rnn.weight_ih_l0'] = weight_ih[0].contiguous()
+            if batch_rnn.bidirectional:
+                state_dict[prefix + 'rnn.weight_ih_l0_reverse'] = weight_ih[1].contiguous()
+            del state_dict[prefix + 'projection.weight']
+    compressed.load_state_dict(state_dict)
+    for x in compressed.rnns:
+        x.flatten_parameters()
+    return compressed, ranks
+
+
+def measure_latency(model, device, seconds, runs):
+    """
+    Average forward time in seconds of a single utterance of the given duration.
+    """
+    inputs = torch.randn(1, 1, 161, seconds * 100).to(device)
+    input_sizes = torch.IntTensor([inputs.size(3)])
+    model(inputs, input_sizes)  # warm up
+    start_time = time.time()
+    for _ in range(runs):
+        model(inputs, input_sizes)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return (time.time() - start_time) / runs
+
+
+def evaluate(model, test_loader, decoder, device):
+    """
+    Returns WER and CER (in percents) of the model over the given loader.
+    """
+    total_cer, total_wer, num_tokens, num_chars = 0, 0, 0, 0
+    for data in tqdm(test_loader, total=len(test_loader)):
+        inputs, targets, filenames, input_percentages, target_sizes = data
+        input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
+        split_targets = []
+        offset = 0
+        for size in target_sizes:
+            split_targets.append(targets[offset:offset + size])
+            offset += size
+        inputs = inputs.to(device)
+        _, out, output_sizes = model(inputs, input_sizes)
+        decoded_output, _ = decoder.decode(out, output_sizes)
+        target_strings = decoder.convert_to_strings(split_targets)
+        _, total = get_batch_cer_wer([x[0] for x in decoded_output], [x[0] for x in target_strings])
+        total_wer += total.wer
+        total_cer += total.cer
+        num_tokens += total.wer_ref
+        num_chars += total.cer_ref
+    return 100 * float(total_wer) / num_tokens, 100 * float(total_cer) / num_chars
+
+
+def finetune(model_path, save_folder):
+    """
+    Runs the regular training loop starting from the compressed weights, returns the best model path.
+    """
+    cmd = [sys.executable, 'train.py',
+           '--continue-from', model_path, '--finetune',
+           '--epochs', str(args.finetune_epochs),
+           '--train-manifest', args.train_manifest,
+           '--val-manifest', args.val_manifest,
+           '--cache-dir', args.cache_dir,
+           '--norm', args.norm,
+           '--save-folder', save_folder,
+           '--id', 'Low-rank finetune ' + os.path.basename(model_path)]
+    if args.cuda:
+        cmd.append('--cuda')
+    cmd.extend(args.finetune_args.split())
+    print(' '.join(cmd))
+    subprocess.check_call(cmd)
+    return os.path.join(save_folder, 'best.model')
+
+
+def report(name, model, ranks, device, test_loader, decoder):
+    model = model.to(device)
+    model.eval()
+    row = {
+        'name': name,
+        'ranks': ranks,
+        'params': DeepSpeech.get_param_size(model),
+        'latency': measure_latency(model, device, args.seconds, args.runs),
+        'wer': None,
+        'cer': None,
+    }
+    if test_loader is not None:
+        row['wer'], row['cer'] = evaluate(model, test_loader, decoder, device)
+    return row
+
+
+def print_report(rows):
+    print("")
+    print("{:<16} {:>12} {:>10} {:>8} {:>8}  {}".format('Setting', 'Params', 'Latency', 'WER', 'CER', 'Ranks'))
+    for row in rows:
+        wer = '{:.3f}'.format(row['wer']) if row['wer'] is not None else 'n/a'
+        cer = '{:.3f}'.format(row['cer']) if row['cer'] is not None else 'n/a'
+        print("{:<16} {:>12d} {:>9.3f}s {:>8} {:>8}  {}".format(row['name'], row['params'], row['latency'],
+                                                                wer, cer, row['ranks']))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = DeepSpeech.load_model(args.model_path)
+    model.eval()
+
+    labels = DeepSpeech.get_labels(model)
+    audio_conf = DeepSpeech.get_audio_conf(model)
+    decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
+    test_loader = None
+    if args.test_manifest:
+        test_dataset = SpectrogramDataset(audio_conf=audio_conf, manifest_filepath=args.test_manifest,
+                                          cache_path=args.cache_dir, labels=labels, normalize=args.norm)
+        test_loader = AudioDataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+
+    layers = [int(x) for x in args.layers.split(',')] if args.layers else None
+    settings = [('rank', int(x)) for x in args.ranks.split(',') if x]
+    settings += [('energy', float(x)) for x in args.energies.split(',') if x]
+    if not settings:
+        print("error: at least one of --ranks or --energies has to be given")
+        sys.exit(1)
+
+    rows = [report('original', model, model._rnn_ranks, device, test_loader, decoder)]
+    for kind, value in settings:
+        name = '{}={}'.format(kind, value)
+        compressed, ranks = factorize(model.cpu(), layers=layers, **{kind: value})
+        output_path = args.output_path.format(name.replace('=', '_'))
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        torch.save(DeepSpeech.serialize(compressed), output_path)
+        print("Saved {} model with ranks {} to {}".format(name, ranks, output_path))
+        rows.append(report(name, compressed, ranks, device, test_loader, decoder))
+        if args.finetune_epochs > 0:
+            best_path = finetune(output_path, os.path.splitext(output_path)[0] + '_finetune')
+            rows.append(report(name + '+ft', DeepSpeech.load_model(best_path), ranks, device, test_loader, decoder))
+    print_report(rows)
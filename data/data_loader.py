@@ -1,11 +1,14 @@
 import csv
 import hashlib
+import io
+import json
 import shutil
 
 import math
 import os
 import random
 import subprocess
+import wave
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
@@ -46,6 +49,87 @@ def load_audio(path, channel=-1):
     return sound, sample_rate
 
 
+def load_audio_bytes(data, channel=-1):
+    """
+    Decodes an audio file held in memory, without temporary files or sox.
+    PCM WAV is read with the wave module, other formats with soundfile when it is installed.
+    :return: float32 samples on the scale of load_audio (32-bit integer range) and the sample rate,
+             or None if the format can't be decoded in memory
+    """
+    try:
+        with wave.open(io.BytesIO(data)) as f:
+            width, channels, sample_rate = f.getsampwidth(), f.getnchannels(), f.getframerate()
+            frames = f.readframes(f.getnframes())
+        sound = _pcm_to_float(frames, width).reshape(-1, channels)
+    except (wave.Error, EOFError):
+        try:
+            import soundfile
+        except ImportError:
+            return None
+        try:
+            sound, sample_rate = soundfile.read(io.BytesIO(data), dtype='float32', always_2d=True)
+        except RuntimeError:
+            return None
+    sound = sound.mean(axis=1) if channel == -1 else sound[:, channel]
+    return sound * 2 ** 31, sample_rate
+
+
+def _pcm_to_float(frames, width):
+    """
+    :return: float32 samples in [-1, 1) of little-endian PCM frames with width bytes per sample
+    """
+    if width == 1:
+        return (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+    if width == 3:
+        padded = np.zeros((len(frames) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)
+        return padded.view('<i4').ravel().astype(np.float32) / 2 ** 31
+    return np.frombuffer(frames, dtype='<i{}'.format(width)).astype(np.float32) / 2 ** (8 * width - 1)
+
+
+def iter_audio(path, sample_rate, channel=-1, block_seconds=10.):
+    """
+    Reads an audio file in blocks, so that memory does not grow with the length of the file.
+    PCM WAV at sample_rate is read directly, other files are converted by sox to a temporary WAV first.
+    :return: generator of float32 sample blocks on the scale of load_audio (32-bit integer range)
+    """
+    try:
+        f = wave.open(path)
+    except (wave.Error, EOFError):
+        f = None
+    if f is None or f.getframerate() != sample_rate or f.getcomptype() != 'NONE':
+        if f is not None:
+            f.close()
+        with NamedTemporaryFile(suffix=".wav") as converted:
+            subprocess.check_call(['sox', path, '-r', str(sample_rate), '-b', '16', '-e', 'signed-integer',
+                                   '-t', 'wav', converted.name], stderr=subprocess.DEVNULL)
+            yield from iter_audio(converted.name, sample_rate, channel, block_seconds)
+        return
+    block = int(block_seconds * sample_rate)
+    with f:
+        width, channels = f.getsampwidth(), f.getnchannels()
+        while True:
+            frames = f.readframes(block)
+            if not frames:
+                return
+            sound = _pcm_to_float(frames, width).reshape(-1, channels)
+            sound = sound.mean(axis=1) if channel == -1 else sound[:, channel]
+            yield sound * 2 ** 31
+
+
+def quiet_point(audio, sample_rate, search_seconds=1., frame_seconds=0.02):
+    """
+    :return: index of the middle of the lowest energy frame in the last search_seconds of the audio
+    """
+    frame = int(sample_rate * frame_seconds)
+    start = max(0, len(audio) - int(sample_rate * search_seconds))
+    frames = (len(audio) - start) // frame
+    if frames == 0:
+        return len(audio)
+    energy = (audio[start:start + frames * frame].reshape(frames, frame) ** 2).sum(1)
+    return start + int(np.argmin(energy)) * frame + frame // 2
+
+
 class AudioParser(object):
     def parse_transcript(self, transcript_path):
         """
@@ -190,6 +274,25 @@ class SpectrogramParser(AudioParser):
     def parse_audio_for_transcription(self, audio_path):
         return self.parse_audio(audio_path)
 
+    def parse_audio_bytes(self, data):
+        """
+        Spectrogram of an audio file held in memory (e.g. an uploaded file), without augmentation or the cache.
+        :return: the spectrogram, or None if the format can't be decoded in memory (see load_audio_bytes)
+        """
+        audio = load_audio_bytes(data, channel=self.channel)
+        if audio is None:
+            return None
+        return self.parse_audio_samples(*audio)
+
+    def parse_audio_samples(self, y, sample_rate):
+        """
+        Spectrogram of decoded samples (on the scale of load_audio), resampled to the model sample rate if needed.
+        """
+        if sample_rate != self.sample_rate:
+            y = librosa.resample(y, orig_sr=sample_rate, target_sr=self.sample_rate)
+        spect = self.audio_to_stft(y, self.sample_rate)
+        return self.normalize_audio(spect)
+
     def audio_to_stft(self, y, sample_rate):
         n_fft = int(sample_rate * (self.window_size + 1e-8))
         win_length = n_fft
@@ -361,6 +464,47 @@ class SpectrogramDataset(Dataset, SpectrogramParser):
     def get_reference_transcript(self, txt):
         return self.labels.render_transcript(self.parse_transcript(txt))
 
+    def durations(self):
+        """
+        Durations in seconds of the utterances, from the third manifest column if present,
+        otherwise probed with soxi (see probe_durations).
+        """
+        durations = [float(dur or 0) for _, _, dur in self.ids]
+        missing = [wav for (wav, _, _), dur in zip(self.ids, durations) if dur <= 0]
+        if missing:
+            probed = probe_durations(missing, self.cache_path)
+            durations = [dur if dur > 0 else probed[wav] for (wav, _, _), dur in zip(self.ids, durations)]
+        return durations
+
+
+class AudioFileDataset(Dataset, SpectrogramParser):
+    def __init__(self, audio_conf, paths, cache_path, normalize=False, channel=-1, durations=None):
+        """
+        Dataset of audio files without transcripts, for batched transcription.
+        :param paths: list of audio file paths
+        :param durations: optional durations in seconds of the files, 0 for unknown (see durations())
+        """
+        self.paths = paths
+        self._durations = durations or [0] * len(paths)
+        super(AudioFileDataset, self).__init__(audio_conf, cache_path, normalize, channel=channel)
+
+    def __getitem__(self, index):
+        audio_path = self.paths[index]
+        return self.parse_audio_for_transcription(audio_path).contiguous(), audio_path
+
+    def __len__(self):
+        return len(self.paths)
+
+    def durations(self):
+        """
+        Durations in seconds of the files, probed with soxi where they were not given (see probe_durations).
+        """
+        missing = [path for path, dur in zip(self.paths, self._durations) if dur <= 0]
+        if missing:
+            probed = probe_durations(missing, self.cache_path)
+            self._durations = [dur if dur > 0 else probed[path] for path, dur in zip(self.paths, self._durations)]
+        return self._durations
+
 
 def _collate_fn(batch):
     def func(p):
@@ -399,6 +543,20 @@ class AudioDataLoader(DataLoader):
         self.collate_fn = _collate_fn
 
 
+def _collate_spects(batch):
+    return [sample[0] for sample in batch], [sample[1] for sample in batch]
+
+
+class AudioFileDataLoader(DataLoader):
+    def __init__(self, *args, **kwargs):
+        """
+        Creates a data loader for AudioFileDatasets. Batches are lists of spectrograms and lists of paths,
+        padded by transcribe_batch.
+        """
+        super(AudioFileDataLoader, self).__init__(*args, **kwargs)
+        self.collate_fn = _collate_spects
+
+
 class BucketingSampler(Sampler):
     def __init__(self, data_source, batch_size=1):
         """
@@ -459,11 +617,73 @@ class DistributedBucketingSampler(Sampler):
         self.bins = [self.bins[i] for i in bin_ids]
 
 
+class DurationBatchSampler(Sampler):
+    def __init__(self, durations, batch_size=1, max_frames=0, frames_per_second=100):
+        """
+        Batches utterances of similar duration together, longest first, so that little compute is spent on padding.
+        :param durations: duration in seconds of every utterance of the dataset
+        :param batch_size: utterances per batch if max_frames is 0
+        :param max_frames: if set, batches take as many utterances as fit into this many padded spectrogram frames
+        (batch size times the frames of the longest utterance), batch_size is then ignored
+        """
+        super(DurationBatchSampler, self).__init__(durations)
+        order = sorted(range(len(durations)), key=lambda i: -durations[i])
+        self.bins = []
+        for i in order:
+            if self.bins:
+                batch = self.bins[-1]
+                if max_frames:
+                    fits = (len(batch) + 1) * durations[batch[0]] * frames_per_second <= max_frames
+                else:
+                    fits = len(batch) < batch_size
+                if fits:
+                    batch.append(i)
+                    continue
+            self.bins.append([i])
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def __len__(self):
+        return len(self.bins)
+
+
+def padding_ratio(durations, bins):
+    """
+    Fraction of the padded batches that is padding.
+    """
+    padded = sum(len(batch) * max(durations[i] for i in batch) for batch in bins)
+    return 1. - sum(durations[i] for batch in bins for i in batch) / padded if padded else 0.
+
+
 def get_audio_length(path):
     output = subprocess.check_output(['soxi -D \"%s\"' % path.strip().replace('"', '\\"')], shell=True)
     return float(output)
 
 
+def probe_durations(paths, cache_path):
+    """
+    Durations of audio files with soxi. Results are kept in durations.json in cache_path, keyed by path and size.
+    :return: dict of path -> duration in seconds
+    """
+    cache_fn = os.path.join(cache_path, 'durations.json')
+    cache = {}
+    if os.path.exists(cache_fn):
+        with open(cache_fn) as f:
+            cache = json.load(f)
+    result = {}
+    for path in tq(paths, desc='Probing durations'):
+        size = os.path.getsize(path)
+        if path not in cache or cache[path][0] != size:
+            cache[path] = [size, get_audio_length(path)]
+        result[path] = cache[path][1]
+    os.makedirs(cache_path, exist_ok=True)
+    with open(cache_fn + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(cache_fn + '.tmp', cache_fn)
+    return result
+
+
 def audio_with_sox(path, sample_rate, start_time, end_time):
     """
     crop and resample the recording with sox and loads it.
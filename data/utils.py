@@ -5,6 +5,9 @@ import io
 import os
 from tqdm import tqdm
 import subprocess
+from collections import namedtuple
+
+import Levenshtein as Lev
 import torch.distributed as dist
 
 
@@ -44,14 +47,50 @@ def reduce_tensor(tensor, world_size):
     return rt
 
 
+ErrorCounts = namedtuple('ErrorCounts', ['wer', 'cer', 'wer_ref', 'cer_ref'])
+
+
 def get_cer_wer(decoder, transcript, reference):
-    reference = reference.strip()
-    transcript = transcript.strip()
-    wer_ref = float(len(reference.split()) or 1)
-    cer_ref = float(len(reference.replace(' ','')) or 1)
-    if reference == transcript:
-        return 0, 0, wer_ref, cer_ref
+    """
+    Word and character edit distances of a single transcript, see get_batch_cer_wer().
+    The decoder argument is kept for compatibility and not used.
+    """
+    return _batch_errors([transcript], [reference])[0]
+
+
+def get_batch_cer_wer(transcripts, references, pool=None, chunk_size=256):
+    """
+    Word and character edit distances of a batch of transcripts, the same numbers as Decoder.wer() and
+    Decoder.cer() give for each pair. Words are mapped to characters once per chunk of chunk_size pairs.
+    :param pool: optional multiprocessing pool to compute the chunks in parallel
+    :return: list of ErrorCounts(wer, cer, wer_ref, cer_ref) per utterance, and their sum
+    """
+    chunks = [(transcripts[i:i + chunk_size], references[i:i + chunk_size])
+              for i in range(0, len(transcripts), chunk_size)]
+    if pool is not None and len(chunks) > 1:
+        errors = [e for chunk in pool.starmap(_batch_errors, chunks) for e in chunk]
     else:
-        wer = decoder.wer(transcript, reference)
-        cer = decoder.cer(transcript, reference)
-    return wer, cer, wer_ref, cer_ref
+        errors = [e for chunk in chunks for e in _batch_errors(*chunk)]
+    total = ErrorCounts(*[sum(values) for values in zip(*errors)]) if errors else ErrorCounts(0, 0, 0., 0.)
+    return errors, total
+
+
+def _batch_errors(transcripts, references):
+    word_ids = {}
+    errors = []
+    for transcript, reference in zip(transcripts, references):
+        reference = reference.strip()
+        transcript = transcript.strip()
+        reference_words = reference.split()
+        reference_chars = reference.replace(' ', '')
+        wer_ref = float(len(reference_words) or 1)
+        cer_ref = float(len(reference_chars) or 1)
+        if reference == transcript:
+            errors.append(ErrorCounts(0, 0, wer_ref, cer_ref))
+            continue
+        # Levenshtein only accepts strings, so every word becomes one character
+        w1 = ''.join([chr(word_ids.setdefault(w, len(word_ids))) for w in transcript.split()])
+        w2 = ''.join([chr(word_ids.setdefault(w, len(word_ids))) for w in reference_words])
+        errors.append(ErrorCounts(Lev.distance(w1, w2), Lev.distance(transcript.replace(' ', ''), reference_chars),
+                                  wer_ref, cer_ref))
+    return errors
@@ -15,10 +15,19 @@
 # ----------------------------------------------------------------------------
 # Modified to support pytorch Tensors
 
+import math
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool
+
 import Levenshtein as Lev
+import numpy as np
 import torch
 from six.moves import xrange
 
+LOG_10 = math.log(10)
+NEG_INF = -float('inf')
+
 
 class Decoder(object):
     """
@@ -86,6 +95,12 @@ class Decoder(object):
         """
         raise NotImplementedError
 
+    def close(self):
+        """
+        Releases the resources of the decoder, e.g. worker processes. The decoder can't be used afterwards.
+        """
+        pass
+
 
 class BeamCTCDecoder(Decoder):
     def __init__(self, labels, lm_path=None, alpha=0, beta=0, cutoff_top_n=40, cutoff_prob=1.0, beam_width=100,
@@ -98,6 +113,12 @@ class BeamCTCDecoder(Decoder):
         self._decoder = CTCBeamDecoder(labels, lm_path, alpha, beta, cutoff_top_n, cutoff_prob, beam_width,
                                        num_processes, blank_index)
 
+    def set_lm_weights(self, alpha, beta):
+        """
+        Changes the language model weight and word bonus without reloading the language model.
+        """
+        self._decoder.reset_params(alpha, beta)
+
     def convert_to_strings(self, out, seq_len):
         results = []
         for b, batch in enumerate(out):
@@ -143,6 +164,358 @@ class BeamCTCDecoder(Decoder):
         return strings, offsets
 
 
+class Scorer(object):
+    def __init__(self, alpha=0, beta=0, cache_size=0):
+        """
+        Language model interface for PrefixBeamCTCDecoder. Every completed word adds
+        alpha * log P(word | previous words) + beta to the score of a beam.
+        Subclasses implement start() and score(), LM states have to be hashable.
+        :param cache_size: number of (state, word) results of score() kept in an LRU cache, 0 disables it
+        """
+        self.alpha = alpha
+        self.beta = beta
+        self.cache_size = cache_size
+        self.reset_cache()
+
+    def reset_cache(self):
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()  # decoders in several threads (e.g. test.py pipeline) share the cache
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        """
+        Returns the LM state at the beginning of a sentence.
+        """
+        return None
+
+    def score(self, state, word):
+        """
+        Returns natural log probability of the word given the state, and the state after the word.
+        """
+        raise NotImplementedError
+
+    def word_score(self, state, word):
+        if not self.cache_size:
+            log_prob, state = self.score(state, word)
+            return self.alpha * log_prob + self.beta, state
+        key = (state, word)
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self.hits += 1
+                self._cache.move_to_end(key)
+        if result is None:
+            # scored without the lock, another thread may score the same key meanwhile
+            result = self.score(state, word)
+            with self._cache_lock:
+                self.misses += 1
+                self._cache[key] = result
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        log_prob, state = result
+        return self.alpha * log_prob + self.beta, state
+
+    def __getstate__(self):
+        # decoder worker processes start with an empty cache
+        state = dict(self.__dict__)
+        for name in ('_cache', '_cache_lock', 'hits', 'misses'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset_cache()
+
+
+class KenLMScorer(Scorer):
+    def __init__(self, lm_path, alpha=0, beta=0, cache_size=100000):
+        """
+        Scorer backed by the kenlm python module, loads both ARPA and binary models.
+        """
+        super(KenLMScorer, self).__init__(alpha, beta, cache_size)
+        self.lm_path = lm_path
+        self._load()
+
+    def _load(self):
+        try:
+            import kenlm
+        except ImportError:
+            raise ImportError("KenLMScorer requires kenlm package.")
+        self._kenlm = kenlm
+        self.model = kenlm.Model(self.lm_path)
+
+    def start(self):
+        state = self._kenlm.State()
+        self.model.BeginSentenceWrite(state)
+        return state
+
+    def score(self, state, word):
+        next_state = self._kenlm.State()
+        log_prob = self.model.BaseScore(state, word, next_state)
+        return log_prob * LOG_10, next_state
+
+    def __getstate__(self):
+        # the model is reloaded from lm_path in decoder worker processes
+        return {'alpha': self.alpha, 'beta': self.beta, 'lm_path': self.lm_path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reset_cache()
+        self._load()
+
+
+def load_scorer(lm_path, alpha=0, beta=0):
+    """
+    ArpaScorer for ARPA files (.arpa, .arpa.gz) and their saved arrays (.npz), KenLMScorer for other models.
+    """
+    if lm_path.endswith(('.arpa', '.arpa.gz', '.npz')):
+        from arpa_lm import ArpaScorer
+        return ArpaScorer(lm_path, alpha, beta)
+    return KenLMScorer(lm_path, alpha, beta)
+
+
+def _log_add(a, b):
+    if a < b:
+        a, b = b, a
+    if b == NEG_INF:
+        return a
+    return a + math.log1p(math.exp(b - a))
+
+
+class _PrefixNode(object):
+    """
+    Prefix of the beam search, a node of the prefix tree. Nodes are hashed by identity, so that extending and
+    looking up prefixes doesn't depend on their length. Extensions are kept in children and reused (as in the
+    PathTrie of ctcdecode), so every prefix has one node even after it was pruned and extended again.
+    """
+    __slots__ = ('parent', 'label', 'time', 'lm_score', 'lm_state', 'word', 'children')
+
+    def __init__(self, parent, label, time, lm_score, lm_state, word):
+        self.parent = parent
+        self.label = label
+        self.time = time
+        self.lm_score = lm_score
+        self.lm_state = lm_state
+        self.word = word
+        self.children = {}
+
+
+_worker_decoder = None
+
+
+def _init_beam_worker(config):
+    global _worker_decoder
+    _worker_decoder = PrefixBeamCTCDecoder(**config)
+
+
+def _beam_worker(task):
+    probs, alpha, beta = task
+    if _worker_decoder.scorer is not None:
+        _worker_decoder.scorer.alpha = alpha
+        _worker_decoder.scorer.beta = beta
+    return _worker_decoder.decode_utterance(probs)
+
+
+class PrefixBeamCTCDecoder(Decoder):
+    def __init__(self, labels, lm_path=None, alpha=0, beta=0, cutoff_top_n=40, cutoff_prob=1.0, beam_width=100,
+                 num_processes=4, blank_index=0, scorer=None):
+        """
+        CTC prefix beam search in Python/NumPy, a drop-in replacement for BeamCTCDecoder that doesn't need ctcdecode.
+        Language model scores are added at word boundaries through a Scorer.
+
+        Arguments:
+            lm_path (string, optional): language model loaded with load_scorer() if no scorer is given
+            scorer (Scorer, optional): language model scorer, overrides lm_path
+            num_processes (int): utterances of a batch are decoded by a pool of that many processes
+        """
+        super(PrefixBeamCTCDecoder, self).__init__(labels, blank_index)
+        if scorer is None and lm_path is not None:
+            scorer = load_scorer(lm_path, alpha, beta)
+        self.scorer = scorer
+        self.cutoff_top_n = cutoff_top_n
+        self.cutoff_prob = cutoff_prob
+        self.beam_width = beam_width
+        self.num_processes = num_processes
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _candidates(self, probs):
+        """
+        Labels to extend the beams with at one time step: the cutoff_top_n most probable ones, and only as
+        many of them as needed to reach cutoff_prob of the probability mass.
+        """
+        n = min(self.cutoff_top_n, probs.shape[0])
+        if n < probs.shape[0]:
+            top = np.argpartition(-probs, n - 1)[:n]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(-probs[top], kind='stable')]
+        if self.cutoff_prob < 1.0:
+            keep = int(np.searchsorted(np.cumsum(probs[top]), self.cutoff_prob)) + 1
+            top = top[:keep]
+        return top.tolist()
+
+    def _extend(self, prefix, label, t):
+        """
+        :return: prefix node for the prefix extended with the label, created at time step t if it doesn't exist yet
+        """
+        node = prefix.children.get(label)
+        if node is not None:
+            return node
+        node = prefix.children[label] = _PrefixNode(prefix, label, t, prefix.lm_score, prefix.lm_state, '')
+        if label != self.space_index:
+            node.word = prefix.word + self.labels[label]
+        elif self.scorer is not None and prefix.word:
+            word_score, node.lm_state = self.scorer.word_score(prefix.lm_state, prefix.word)
+            node.lm_score += word_score
+        return node
+
+    def decode_utterance(self, probs):
+        """
+        Beam search over a single TxV matrix of label probabilities. Each time step is computed for all beams and
+        candidate labels at once, only the extensions that survive pruning become new prefixes.
+        :return: list of (transcript, time step per character) for all beams, best first
+        """
+        blank = self.blank_index
+        log_probs = np.log(np.maximum(probs, 1e-30))
+        root = _PrefixNode(None, None, -1, 0., self.scorer.start() if self.scorer is not None else None, '')
+        nodes = [root]
+        p_blank = np.zeros(1)  # log prob of each beam ending in blank
+        p_label = np.full(1, NEG_INF)  # log prob of each beam ending in a label
+        for t in range(probs.shape[0]):
+            step = log_probs[t]
+            candidates = self._candidates(probs[t])
+            labels = np.array([c for c in candidates if c != blank], dtype=np.int64)
+            last = np.array([-1 if n.label is None else n.label for n in nodes], dtype=np.int64)
+            lm_scores = np.array([n.lm_score for n in nodes])
+            total = np.logaddexp(p_blank, p_label)
+
+            # beams that keep their prefix: a blank, or a repeat of the last label without a blank in between
+            stay_blank = total + step[blank] if blank in candidates else np.full(len(nodes), NEG_INF)
+            repeated = (last >= 0) & np.isin(last, labels)
+            stay_label = np.where(repeated, p_label + step[np.maximum(last, 0)], NEG_INF)
+
+            # beams extended with a label, a repeated label can only follow a blank
+            ext = np.where(last[:, None] == labels[None, :], p_blank[:, None], total[:, None]) + step[labels][None, :]
+            column = {c: k for k, c in enumerate(labels.tolist())}
+            index = {n: k for k, n in enumerate(nodes)}
+            for k, n in enumerate(nodes):
+                # the extension is already a beam, merge them
+                if n.parent in index and n.label in column:
+                    b, c = index[n.parent], column[n.label]
+                    stay_label[k] = np.logaddexp(stay_label[k], ext[b, c])
+                    ext[b, c] = NEG_INF
+            ext_lm = np.repeat(lm_scores[:, None], len(labels), 1)
+            created = {}
+            if self.scorer is not None and self.space_index in column:
+                c = column[self.space_index]
+                for b, n in enumerate(nodes):
+                    created[b, c] = self._extend(n, self.space_index, t)
+                    ext_lm[b, c] = created[b, c].lm_score
+
+            scores = np.concatenate((np.logaddexp(stay_blank, stay_label) + lm_scores, (ext + ext_lm).ravel()))
+            k = min(self.beam_width, int(np.isfinite(scores).sum()))
+            best = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            next_nodes, next_blank, next_label = [], [], []
+            for idx in best.tolist():
+                if idx < len(nodes):
+                    next_nodes.append(nodes[idx])
+                    next_blank.append(stay_blank[idx])
+                    next_label.append(stay_label[idx])
+                else:
+                    b, c = divmod(idx - len(nodes), len(labels))
+                    node = created.get((b, c))
+                    next_nodes.append(node if node is not None else self._extend(nodes[b], int(labels[c]), t))
+                    next_blank.append(NEG_INF)
+                    next_label.append(ext[b, c])
+            nodes, p_blank, p_label = next_nodes, np.array(next_blank), np.array(next_label)
+
+        results = []
+        for prefix, score in zip(nodes, np.logaddexp(p_blank, p_label).tolist()):
+            score += prefix.lm_score
+            if self.scorer is not None and prefix.word:
+                word_score, _ = self.scorer.word_score(prefix.lm_state, prefix.word)
+                score += word_score
+            results.append((score, prefix))
+        results.sort(key=lambda x: x[0], reverse=True)
+        return [self._backtrack(prefix) for _, prefix in results]
+
+    def _backtrack(self, prefix):
+        labels, offsets = [], []
+        while prefix.parent is not None:
+            labels.append(self.labels[prefix.label])
+            offsets.append(prefix.time)
+            prefix = prefix.parent
+        return ''.join(reversed(labels)), tuple(reversed(offsets))
+
+    def set_lm_weights(self, alpha, beta):
+        """
+        Changes the language model weight and word bonus without reloading the language model.
+        """
+        if self.scorer is not None:
+            self.scorer.alpha = alpha
+            self.scorer.beta = beta
+
+    def close(self):
+        """
+        Stops the worker processes, if they were started.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                config = dict(labels=self.labels, cutoff_top_n=self.cutoff_top_n, cutoff_prob=self.cutoff_prob,
+                              beam_width=self.beam_width, num_processes=1, blank_index=self.blank_index,
+                              scorer=self.scorer)
+                self._pool = Pool(self.num_processes, initializer=_init_beam_worker, initargs=(config,))
+        return self._pool
+
+    def decode(self, probs, sizes=None):
+        """
+        Decodes probability output with prefix beam search.
+        Arguments:
+            probs: Tensor of character probabilities of size NxTxV
+            sizes: Size of each sequence in the mini-batch
+        Returns:
+            strings: transcripts of all beams for each utterance, best first
+            offsets: time step per character for each of them
+        """
+        probs = probs.cpu().float().numpy()
+        sizes = torch.as_tensor(sizes).cpu().tolist() if sizes is not None else [probs.shape[1]] * probs.shape[0]
+        utterances = [probs[i, :sizes[i]] for i in range(probs.shape[0])]
+        if self.num_processes > 1 and len(utterances) > 1:
+            # the workers have copies of the scorer, the current weights are sent along with the utterances
+            alpha, beta = (self.scorer.alpha, self.scorer.beta) if self.scorer is not None else (0, 0)
+            results = self._get_pool().map(_beam_worker, [(p, alpha, beta) for p in utterances])
+        else:
+            results = [self.decode_utterance(p) for p in utterances]
+        strings = [[transcript for transcript, _ in beams] for beams in results]
+        offsets = [[torch.tensor(o, dtype=torch.int) for _, o in beams] for beams in results]
+        return strings, offsets
+
+
+def create_beam_decoder(labels, implementation='auto', **kwargs):
+    """
+    Beam search decoder: BeamCTCDecoder if ctcdecode is installed (or requested), otherwise PrefixBeamCTCDecoder.
+    :param implementation: 'auto', 'ctcdecode' or 'prefix'
+    """
+    if implementation == 'auto':
+        try:
+            import ctcdecode
+            implementation = 'ctcdecode'
+        except ImportError:
+            implementation = 'prefix'
+    if implementation == 'ctcdecode':
+        return BeamCTCDecoder(labels, **kwargs)
+    return PrefixBeamCTCDecoder(labels, **kwargs)
+
+
 class GreedyDecoder(Decoder):
     def __init__(self, labels, blank_index=0):
         super(GreedyDecoder, self).__init__(labels, blank_index)
@@ -165,11 +538,12 @@ class GreedyDecoder(Decoder):
     def process_string(self, sequence, size, remove_repetitions=False):
         string = ''
         offsets = []
+        sequence = sequence[:size].tolist()
         for i in range(size):
-            char = self.int_to_char[sequence[i].item()]
+            char = self.int_to_char[sequence[i]]
             if char != self.int_to_char[self.blank_index]:
                 # if this char is a repetition and remove_repetitions=true, then skip
-                if remove_repetitions and i != 0 and char == self.int_to_char[sequence[i - 1].item()]:
+                if remove_repetitions and i != 0 and char == self.int_to_char[sequence[i - 1]]:
                     pass
                 elif char == self.labels[self.space_index]:
                     string += ' '
@@ -179,6 +553,35 @@ class GreedyDecoder(Decoder):
                     offsets.append(i)
         return string, torch.tensor(offsets, dtype=torch.int)
 
+    def collapse_batch(self, sequences, sizes=None):
+        """
+        Removes repeated elements and blanks from a whole batch of label sequences at once with tensor ops.
+        Gives the same strings and offsets as convert_to_strings(sequences, sizes, remove_repetitions=True,
+        return_offsets=True).
+
+        Arguments:
+            sequences: NxT tensor of label indices
+            sizes(optional): Size of each sequence in the mini-batch
+        Returns:
+            strings: one list with a single string per sequence
+            offsets: one list with a single int tensor of time steps per sequence
+        """
+        sequences = sequences.cpu()
+        keep = sequences != self.blank_index
+        keep[:, 1:] &= sequences[:, 1:] != sequences[:, :-1]
+        if sizes is not None:
+            sizes = torch.as_tensor(sizes).cpu().long()
+            keep &= torch.arange(sequences.size(1)).unsqueeze(0) < sizes.unsqueeze(1)
+        counts = keep.sum(1).tolist()
+        offsets = torch.nonzero(keep)[:, 1].int().split(counts)
+        chars = sequences[keep].tolist()
+        strings = []
+        start = 0
+        for count in counts:
+            strings.append([''.join([self.labels[c] for c in chars[start:start + count]])])
+            start += count
+        return strings, [[o] for o in offsets]
+
     def decode(self, probs, sizes=None):
         """
         Returns the argmax decoding given the probability matrix. Removes
@@ -192,6 +595,5 @@ class GreedyDecoder(Decoder):
             offsets: time step per character predicted
         """
         _, max_probs = torch.max(probs, 2)
-        strings, offsets = self.convert_to_strings(max_probs.view(max_probs.size(0), max_probs.size(1)), sizes,
-                                                   remove_repetitions=True, return_offsets=True)
+        strings, offsets = self.collapse_batch(max_probs.view(max_probs.size(0), max_probs.size(1)), sizes)
         return strings, offsets
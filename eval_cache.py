@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class EvalCache(object):
+    def __init__(self, path, model, audio_conf, normalize):
+        """
+        Acoustic model outputs of single utterances, keyed by the model weights, the feature configuration and the
+        audio content. Evaluations that only change decoder options read the outputs instead of running the model.
+        :param path: cache directory, can be shared by models and test sets
+        :param normalize: spectrogram normalization of the evaluation (see SpectrogramParser)
+        """
+        self.path = path
+        digest = hashlib.sha1()
+        digest.update(str(model).encode())
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        digest.update(json.dumps([audio_conf, normalize], sort_keys=True, default=str).encode())
+        self.model_hash = digest.hexdigest()
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, audio_path):
+        if audio_path not in self.keys:
+            with open(audio_path, 'rb') as f:
+                audio_hash = hashlib.sha1(f.read()).hexdigest()
+            self.keys[audio_path] = hashlib.sha1((self.model_hash + audio_hash).encode()).hexdigest()
+        return self.keys[audio_path]
+
+    def _file(self, audio_path):
+        key = self.key(audio_path)
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def contains(self, audio_path):
+        found = os.path.exists(self._file(audio_path))
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def get(self, audio_path):
+        """
+        :return: TxV logits of the utterance and the number of spectrogram frames of its input
+        """
+        with np.load(self._file(audio_path)) as f:
+            return f['logits'], int(f['frames'])
+
+    def put(self, audio_path, logits, frames):
+        filename = self._file(audio_path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        np.savez(filename + '.tmp.npz', logits=np.asarray(logits, dtype=np.float32), frames=frames)
+        os.replace(filename + '.tmp.npz', filename)
@@ -0,0 +1,167 @@
+import csv
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from sparse_logits import sparsify, densify
+
+
+class LogitsStoreWriter(object):
+    def __init__(self, path, labels, topk=0, half=False, shard_frames=1 << 20):
+        """
+        Writes model outputs of many utterances into one directory: frames of consecutive utterances are
+        concatenated into .npy shards, and index.csv keeps (utterance id, shard, offset, length, reference).
+        :param labels: labels of the model, saved with the outputs
+        :param topk: keep only the k most probable labels per frame (0 keeps all), see sparse_logits.py
+        :param half: store probabilities in fp16
+        :param shard_frames: frames per shard, a shard is written when it is full
+        """
+        self.path = path
+        self.labels = labels
+        self.topk = topk
+        self.dtype = np.float16 if half else np.float32
+        self.shard_frames = shard_frames
+        self.shards = []
+        self.index = []
+        self._pending = []
+        self._pending_frames = 0
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, utterance_id, probs, reference='', transcript=''):
+        """
+        :param probs: TxV probabilities of the utterance
+        """
+        probs = np.asarray(probs)
+        if self.topk > 0:
+            sparse = sparsify(probs, self.topk, half=self.dtype == np.float16)
+            frames = (sparse['values'], sparse['indices'])
+        else:
+            frames = (probs.astype(self.dtype),)
+        self.index.append([utterance_id, len(self.shards), self._pending_frames, len(probs), reference, transcript])
+        self._pending.append(frames)
+        self._pending_frames += len(probs)
+        if self._pending_frames >= self.shard_frames:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        name = 'shard_{:05d}'.format(len(self.shards))
+        arrays = [np.concatenate(parts) for parts in zip(*self._pending)]
+        np.save(os.path.join(self.path, name + '.npy'), arrays[0])
+        if len(arrays) > 1:
+            np.save(os.path.join(self.path, name + '.indices.npy'), arrays[1])
+        self.shards.append(name)
+        self._pending = []
+        self._pending_frames = 0
+
+    def close(self):
+        self._flush()
+        _write_index(self.path, {'labels': self.labels, 'topk': self.topk, 'dtype': np.dtype(self.dtype).name,
+                                 'shards': self.shards}, self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _write_index(path, meta, index):
+    with open(os.path.join(path, 'index.csv'), 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'shard', 'offset', 'length', 'reference', 'transcript'])
+        writer.writerows(index)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def merge_stores(path, parts):
+    """
+    Merges stores written by several LogitsStoreWriters (e.g. by parallel test.py processes) into one store.
+    The shard files of the parts are moved, not copied.
+    """
+    if not parts:
+        raise ValueError("No stores to merge into {}".format(path))
+    os.makedirs(path, exist_ok=True)
+    meta, shards, index = None, [], []
+    for part in parts:
+        with open(os.path.join(part, 'meta.json')) as f:
+            part_meta = json.load(f)
+        meta = meta or part_meta
+        with open(os.path.join(part, 'index.csv'), newline='', encoding='utf-8') as f:
+            for row in list(csv.reader(f))[1:]:
+                row[1] = int(row[1]) + len(shards)
+                index.append(row)
+        for name in part_meta['shards']:
+            merged_name = 'shard_{:05d}'.format(len(shards))
+            for suffix in ('.npy', '.indices.npy'):
+                if os.path.exists(os.path.join(part, name + suffix)):
+                    shutil.move(os.path.join(part, name + suffix), os.path.join(path, merged_name + suffix))
+            shards.append(merged_name)
+    meta['shards'] = shards
+    _write_index(path, meta, index)
+
+
+class LogitsStore(object):
+    def __init__(self, path):
+        """
+        Reads a store written by LogitsStoreWriter. Shards are memory-mapped, so only the frames that are
+        accessed are read from disk, and processes reading the same store share the page cache.
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.labels = meta['labels']
+        self.topk = meta['topk']
+        self.shard_names = meta['shards']
+        with open(os.path.join(path, 'index.csv'), newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))[1:]
+        self.ids = [row[0] for row in rows]
+        self.locations = [(int(row[1]), int(row[2]), int(row[3])) for row in rows]
+        self.references = [row[4] for row in rows]
+        self.transcripts = [row[5] for row in rows]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _shard(self, index):
+        if index not in self._shards:
+            name = os.path.join(self.path, self.shard_names[index])
+            arrays = (np.load(name + '.npy', mmap_mode='r'),)
+            if self.topk > 0:
+                arrays += (np.load(name + '.indices.npy', mmap_mode='r'),)
+            self._shards[index] = arrays
+        return self._shards[index]
+
+    def get(self, i, fill=True):
+        """
+        :return: TxV probabilities of utterance i, a view of the memory-mapped shard for dense stores
+        :param fill: for top-k stores, see sparse_logits.densify()
+        """
+        shard, offset, length = self.locations[i]
+        arrays = [a[offset:offset + length] for a in self._shard(shard)]
+        if self.topk > 0:
+            return densify({'values': arrays[0], 'indices': arrays[1], 'num_labels': len(self.labels),
+                            'repeats': None}, fill)
+        return arrays[0]
+
+    def batches(self, batch_size, fill=True, indices=None):
+        """
+        Yields padded NxTxV float tensors of probabilities, output sizes and references of consecutive utterances.
+        :param indices: utterances to read, all of them if None
+        """
+        if indices is None:
+            indices = range(len(self))
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            lengths = [self.locations[i][2] for i in batch]
+            probs = torch.zeros(len(batch), max(lengths), len(self.labels))
+            out = probs.numpy()
+            for j, i in enumerate(batch):
+                out[j, :lengths[j]] = self.get(i, fill)
+            yield probs, torch.IntTensor(lengths), [self.references[i] for i in batch]
@@ -1,4 +1,5 @@
 import math
+import time
 from collections import OrderedDict
 
 import torch
@@ -6,6 +7,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 from torch.nn.parameter import Parameter
+from torch.nn.utils.rnn import PackedSequence
+from torch.utils.checkpoint import checkpoint
+
+# torch.load(mmap=True), torch.device as a context manager and load_state_dict(assign=True) need torch 2.1
+MMAP_LOADING = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1)
 
 supported_rnns = {
     'lstm': nn.LSTM,
@@ -59,38 +65,42 @@ class MaskConv(nn.Module):
         """
         for module in self.seq_module:
             x = module(x)
-            mask = torch.ByteTensor(x.size()).fill_(0)
-            if x.is_cuda:
-                mask = mask.cuda()
-            for i, length in enumerate(lengths):
-                length = length.item()
-                if (mask[i].size(2) - length) > 0:
-                    mask[i].narrow(2, length, mask[i].size(2) - length).fill_(1)
-            x = x.masked_fill(mask, 0)
+            mask = torch.arange(x.size(3), device=x.device).unsqueeze(0) >= lengths.to(x.device).unsqueeze(1)
+            x = x.masked_fill(mask.view(x.size(0), 1, 1, x.size(3)), 0)
         return x, lengths
 
 
 class BatchRNN(nn.Module):
-    def __init__(self, input_size, hidden_size, rnn_type=nn.LSTM, bidirectional=False, batch_norm=True, bnm=0.1):
+    def __init__(self, input_size, hidden_size, rnn_type=nn.LSTM, bidirectional=False, batch_norm=True, bnm=0.1,
+                 rank=None):
+        """
+        :param rank: If set, the input-to-hidden matrix is factorized as weight_ih x projection, where projection
+        maps the input to `rank` features (see compress.py).
+        """
         super(BatchRNN, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
         self.bidirectional = bidirectional
         self.bnm = bnm
+        self.rank = rank
         self.batch_norm = SequenceWise(nn.BatchNorm1d(input_size, momentum=bnm)) if batch_norm else None
-        self.rnn = rnn_type(input_size=input_size, hidden_size=hidden_size,
+        self.projection = nn.Linear(input_size, rank, bias=False) if rank else None
+        self.rnn = rnn_type(input_size=rank or input_size, hidden_size=hidden_size,
                             bidirectional=bidirectional, bias=True)
         self.num_directions = 2 if bidirectional else 1
 
     def flatten_parameters(self):
         self.rnn.flatten_parameters()
 
-    def forward(self, x, output_lengths):
-        assert x.is_cuda
+    def forward(self, x, output_lengths=None):
+        if isinstance(x, PackedSequence):
+            return self.forward_packed(x)
         max_seq_length = x.size(0)
         if self.batch_norm is not None:
             x = self.batch_norm(x)
             # x = x._replace(data=self.batch_norm(x.data))
+        if self.projection is not None:
+            x = self.projection(x)
         x = nn.utils.rnn.pack_padded_sequence(x, output_lengths.data.cpu().numpy())
         x, h = self.rnn(x)
         x, _ = nn.utils.rnn.pad_packed_sequence(x, total_length=max_seq_length)
@@ -99,33 +109,21 @@ class BatchRNN(nn.Module):
         # x = x.to('cuda')
         return x
 
-
-class DeepBatchRNN(nn.Module):
-    def __init__(self, input_size, hidden_size, rnn_type=nn.LSTM, bidirectional=False, num_layers=1,
-                 batch_norm=True, sum_directions=True, **kwargs):
-        super(DeepBatchRNN, self).__init__()
-        self._bidirectional = bidirectional
-        rnns = []
-        rnn = BatchRNN(input_size=input_size, hidden_size=hidden_size, rnn_type=rnn_type, bidirectional=bidirectional,
-                       batch_norm=False)
-        rnns.append(('0', rnn))
-        for x in range(num_layers - 1):
-            rnn = BatchRNN(input_size=hidden_size, hidden_size=hidden_size, rnn_type=rnn_type,
-                           bidirectional=bidirectional, batch_norm=batch_norm)
-            rnns.append(('%d' % (x + 1), rnn))
-        self.rnns = nn.Sequential(OrderedDict(rnns))
-        self.sum_directions = sum_directions
-
-    def flatten_parameters(self):
-        for x in range(len(self.rnns)):
-            self.rnns[x].flatten_parameters()
-
-    def forward(self, x, lengths):
-        max_seq_length = x.size(0)
-        x = nn.utils.rnn.pack_padded_sequence(x, lengths.data.squeeze(0).cpu().numpy())
-        x = self.rnns(x)
-        x, _ = nn.utils.rnn.pad_packed_sequence(x, total_length=max_seq_length)
-        return x, None
+    def forward_packed(self, x):
+        """
+        Same as forward, but takes and returns a PackedSequence, so that a stack of layers needs to be packed once.
+        BatchNorm, projection and the direction sum are applied to the packed data, so padding is never computed.
+        :param x: PackedSequence with data of size (sum of lengths)xH
+        """
+        data = x.data
+        if self.batch_norm is not None:
+            data = self.batch_norm.module(data)
+        if self.projection is not None:
+            data = self.projection(data)
+        x, h = self.rnn(x._replace(data=data))
+        if self.bidirectional:
+            x = x._replace(data=x.data.view(x.data.size(0), 2, -1).sum(1))  # (LxH*2) -> (LxH) by sum
+        return x
 
 
 class Lookahead(nn.Module):
@@ -173,7 +171,13 @@ DEBUG = 1
 
 class DeepSpeech(nn.Module):
     def __init__(self, rnn_type=nn.LSTM, labels="abc", rnn_hidden_size=768, nb_layers=5, audio_conf=None,
-                 bidirectional=True, context=20, bnm=0.1):
+                 bidirectional=True, context=20, bnm=0.1, rnn_ranks=None, recompute_rnns=0, packed_rnns=False):
+        """
+        :param recompute_rnns: If > 0, RNN activations are not kept for backward in training but recomputed
+        for every group of that many layers (activation checkpointing).
+        :param packed_rnns: Pack the RNN input once and run the whole stack on the PackedSequence, instead of
+        packing and padding in every layer. Uses the same weights as the padded stack.
+        """
         super(DeepSpeech, self).__init__()
 
         # model metadata needed for serialization/deserialization
@@ -187,6 +191,9 @@ class DeepSpeech(nn.Module):
         self._labels = labels
         self._bidirectional = bidirectional
         self._bnm = bnm
+        self._rnn_ranks = rnn_ranks or [None] * nb_layers
+        self.recompute_rnns = recompute_rnns
+        self.packed_rnns = packed_rnns
 
         sample_rate = self._audio_conf.get("sample_rate", 16000)
         window_size = self._audio_conf.get("window_size", 0.02)
@@ -238,12 +245,12 @@ class DeepSpeech(nn.Module):
 
             rnns = []
             rnn = BatchRNN(input_size=rnn_input_size, hidden_size=rnn_hidden_size, rnn_type=supported_rnns[rnn_type],
-                           bidirectional=bidirectional, batch_norm=False)
+                           bidirectional=bidirectional, batch_norm=False, rank=self._rnn_ranks[0])
             rnns.append(('0', rnn))
             for x in range(nb_layers - 1):
                 rnn = BatchRNN(input_size=rnn_hidden_size, hidden_size=rnn_hidden_size,
                                rnn_type=supported_rnns[rnn_type],
-                               bidirectional=bidirectional, bnm=bnm)
+                               bidirectional=bidirectional, bnm=bnm, rank=self._rnn_ranks[x + 1])
                 rnns.append(('%d' % (x + 1), rnn))
             self.rnns = nn.Sequential(OrderedDict(rnns))
 
@@ -262,43 +269,110 @@ class DeepSpeech(nn.Module):
             )
 
     def forward(self, x, lengths):
-        assert x.is_cuda
         lengths = lengths.cpu().int()
-        output_lengths = self.get_seq_lens(lengths).cuda()
+        cpu_lengths = self.get_seq_lens(lengths)
+        output_lengths = cpu_lengths.to(x.device)
 
         if self._rnn_type == 'cnn':
             x = x.squeeze(1)
-            x = self.rnns(x)
+            x = self._run_cnn(x, lengths)
             x = self.fc(x)
             x = x.transpose(1, 2).transpose(0, 1).contiguous()
         else:
             # x = self.dropout1(x)
-            x, _ = self.conv(x, output_lengths)
+            x, _ = self.conv(x, cpu_lengths)
             # x = self.dropout2(x)
-            if DEBUG: assert x.is_cuda
             # x = x.to('cuda')
             sizes = x.size()
             x = x.view(sizes[0], sizes[1] * sizes[2], sizes[3])  # Collapse feature dimension
             x = x.transpose(1, 2).transpose(0, 1).contiguous()  # TxNxH
-            assert x.is_cuda
 
-            for rnn in self.rnns:
-                x = rnn(x, output_lengths)
-                assert x.is_cuda
+            max_seq_length = x.size(0)
+            batch_sizes = None
+            if self.packed_rnns:
+                x = nn.utils.rnn.pack_padded_sequence(x, cpu_lengths)
+                x, batch_sizes = x.data, x.batch_sizes
+
+            if self.recompute_rnns and self.training and torch.is_grad_enabled():
+                for start in range(0, len(self.rnns), self.recompute_rnns):
+                    x = checkpoint(self._recompute_rnns, x, cpu_lengths, batch_sizes,
+                                   start, start + self.recompute_rnns, use_reentrant=True)
+            else:
+                x = self._run_rnns(x, cpu_lengths, batch_sizes, 0, len(self.rnns))
+
+            if self.packed_rnns:
+                x, _ = nn.utils.rnn.pad_packed_sequence(PackedSequence(x, batch_sizes), total_length=max_seq_length)
 
             if not self._bidirectional:  # no need for lookahead layer in bidirectional
                 x = self.lookahead(x)
-                assert x.is_cuda
 
             x = self.fc(x)
-        if DEBUG: assert x.is_cuda
         x = x.transpose(0, 1)
         # identity in training mode, softmax in eval mode
         outs = F.softmax(x, dim=-1)
-        if DEBUG: assert outs.is_cuda
-        if DEBUG: assert output_lengths.is_cuda
         return x, outs, output_lengths
 
+    def _run_cnn(self, x, lengths):
+        """
+        Runs the 'cnn' stack over NxHxT input, zeroing the frames past each sequence length before every
+        convolution, so that the outputs don't depend on the padding of the batch.
+        """
+        lengths = lengths.to(x.device)
+        for module in self.rnns:
+            if isinstance(module, nn.Conv1d):
+                mask = torch.arange(x.size(2), device=x.device).unsqueeze(0) >= lengths.unsqueeze(1)
+                x = x.masked_fill(mask.unsqueeze(1), 0)
+                lengths = self._conv_seq_lens(lengths, module.kernel_size[0], module.stride[0],
+                                              module.padding[0], module.dilation[0])
+            x = module(x)
+        return x
+
+    def get_cnn_context(self):
+        """
+        Receptive field of the 'cnn' stack in input frames.
+        :return: (stride, left, right) - output frame t sees input frames [t * stride - left, t * stride + right]
+        """
+        stride, left, right = 1, 0, 0
+        for m in list(self.rnns) + list(self.fc):
+            if isinstance(m, nn.Conv1d):
+                left += m.padding[0] * stride
+                right += (m.dilation[0] * (m.kernel_size[0] - 1) - m.padding[0]) * stride
+                stride *= m.stride[0]
+        return stride, left, right
+
+    def _run_rnns(self, x, lengths, batch_sizes, start, end):
+        """
+        Runs RNN layers [start, end) over a padded TxNxH batch, or over packed data if batch_sizes is given.
+        """
+        if batch_sizes is None:
+            for rnn in self.rnns[start:end]:
+                x = rnn(x, lengths)
+            return x
+        x = PackedSequence(x, batch_sizes)
+        for rnn in self.rnns[start:end]:
+            x = rnn(x)
+        return x.data
+
+    def _recompute_rnns(self, x, lengths, batch_sizes, start, end):
+        # Checkpointing runs this twice: without grad in the forward pass, and with grad when recomputing
+        # for backward. The recomputation must not update BatchNorm running statistics a second time.
+        norms = [m for rnn in self.rnns[start:end] for m in rnn.modules() if isinstance(m, nn.BatchNorm1d)]
+        momenta = [m.momentum for m in norms]
+        tracked = [m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None for m in norms]
+        if torch.is_grad_enabled():
+            for m in norms:
+                m.momentum = 0.
+        try:
+            x = self._run_rnns(x, lengths, batch_sizes, start, end)
+        finally:
+            for m, momentum in zip(norms, momenta):
+                m.momentum = momentum
+            if torch.is_grad_enabled():
+                for m, count in zip(norms, tracked):
+                    if count is not None:
+                        m.num_batches_tracked.copy_(count)
+        return x
+
     def get_seq_lens(self, input_length):
         """
         Given a 1D Tensor or Variable containing integer sequence lengths, return a 1D tensor or variable
@@ -307,43 +381,88 @@ class DeepSpeech(nn.Module):
         :return: 1D Tensor scaled by model
         """
         seq_len = input_length
+        if self._rnn_type == 'cnn':
+            for m in self.rnns.modules():
+                if type(m) == nn.modules.conv.Conv1d:
+                    seq_len = self._conv_seq_lens(seq_len, m.kernel_size[0], m.stride[0], m.padding[0], m.dilation[0])
+            return seq_len.int()
         for m in self.conv.modules():
             if type(m) == nn.modules.conv.Conv2d:
-                seq_len = ((seq_len + 2 * m.padding[1] - m.dilation[1] * (m.kernel_size[1] - 1) - 1) / m.stride[1] + 1)
+                seq_len = self._conv_seq_lens(seq_len, m.kernel_size[1], m.stride[1], m.padding[1], m.dilation[1])
         return seq_len.int()
 
+    @staticmethod
+    def _conv_seq_lens(seq_len, kernel_size, stride, padding, dilation):
+        return (seq_len + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+
     @classmethod
     def load_model(cls, path):
-        package = torch.load(path, map_location=lambda storage, loc: storage)
-        model = cls(rnn_hidden_size=package['hidden_size'],
-                    nb_layers=package['hidden_layers'],
-                    labels=package['labels'],
-                    audio_conf=package['audio_conf'],
-                    rnn_type=package['rnn_type'],
-                    bnm=package.get('bnm', 0.1),
-                    bidirectional=package.get('bidirectional', True))
-        model.load_state_dict(package['state_dict'])
+        return cls.load_model_package(cls.load_package(path))
+
+    @classmethod
+    def load_model_package(cls, package):
+        kwargs = dict(rnn_hidden_size=package['hidden_size'],
+                      nb_layers=package['hidden_layers'],
+                      labels=package['labels'],
+                      audio_conf=package['audio_conf'],
+                      rnn_type=package['rnn_type'],
+                      bnm=package.get('bnm', 0.1),
+                      bidirectional=package.get('bidirectional', True),
+                      rnn_ranks=package.get('rnn_ranks'),
+                      packed_rnns=package.get('packed_rnns', False))
+        if not package.get('inference') or not MMAP_LOADING:
+            model = cls(**kwargs)
+            model.load_state_dict(package['state_dict'])
+        else:
+            # Inference packages: build the model without allocating weights and assign the loaded tensors
+            # instead of copying them, so memory-mapped weights stay shared between processes.
+            # fp16 weights are converted to fp32 copies, which are private to each process.
+            with torch.device('meta'):
+                model = cls(**kwargs)
+            state_dict = package['state_dict']
+            if package.get('half'):
+                state_dict = {k: v.float() if v.is_floating_point() else v for k, v in state_dict.items()}
+            model.load_state_dict(state_dict, assign=True)
         if package['rnn_type'] != 'cnn':
             for x in model.rnns:
                 x.flatten_parameters()
         return model
 
-    @classmethod
-    def load_model_package(cls, package):
-        model = cls(rnn_hidden_size=package['hidden_size'],
-                    nb_layers=package['hidden_layers'],
-                    labels=package['labels'],
-                    audio_conf=package['audio_conf'],
-                    rnn_type=package['rnn_type'],
-                    bnm=package.get('bnm', 0.1),
-                    bidirectional=package.get('bidirectional', True))
-        model.load_state_dict(package['state_dict'])
-        return model
+    @staticmethod
+    def load_package(path):
+        """
+        Loads a model package. With torch 2.1 or later, files in the zip format (the default since torch 1.6) are
+        memory-mapped, so tensors are only read when used and their pages are shared by all processes loading the file.
+        """
+        if not MMAP_LOADING:
+            return torch.load(path, map_location=lambda storage, loc: storage)
+        try:
+            return torch.load(path, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # legacy serialization format can't be memory-mapped
+            return torch.load(path, map_location=lambda storage, loc: storage)
+
+    @staticmethod
+    def serialize_inference(model, half=False):
+        """
+        Package with the architecture metadata and weights only, without optimizer state and training history.
+        :param half: Store floating point weights in fp16. They are converted back to fp32 on load, so unlike fp32
+        packages their weights are not shared between processes
+        """
+        package = DeepSpeech.serialize(model)
+        del package['checkpoint']
+        package['inference'] = True
+        package['half'] = half
+        if half:
+            package['state_dict'] = {k: v.half() if v.is_floating_point() else v
+                                     for k, v in package['state_dict'].items()}
+        return package
 
     @staticmethod
     def serialize(model, optimizer=None, epoch=None, iteration=None, loss_results=None, checkpoint=None,
                   cer_results=None, wer_results=None, avg_loss=None, meta=None,
-                  checkpoint_cer_results=None, checkpoint_wer_results=None, checkpoint_loss_results=None):
+                  checkpoint_cer_results=None, checkpoint_wer_results=None, checkpoint_loss_results=None,
+                  scaler=None):
         model = model.module if DeepSpeech.is_parallel(model) else model
         package = {
             'version': model._version,
@@ -355,9 +474,13 @@ class DeepSpeech(nn.Module):
             'state_dict': model.state_dict(),
             'bnm': model._bnm,
             'bidirectional': model._bidirectional,
+            'rnn_ranks': model._rnn_ranks,
+            'packed_rnns': model.packed_rnns,
         }
         if optimizer is not None:
             package['optim_dict'] = optimizer.state_dict()
+        if scaler is not None and scaler.is_enabled():
+            package['scaler_dict'] = scaler.state_dict()
         if avg_loss is not None:
             package['avg_loss'] = avg_loss
         if epoch is not None:
@@ -411,17 +534,98 @@ class DeepSpeech(nn.Module):
                isinstance(model, torch.nn.parallel.DistributedDataParallel)
 
 
+class CNNStreamer(object):
+    def __init__(self, model):
+        """
+        Chunked streaming inference for the 'cnn' model variant. Spectrogram frames are fed as they arrive and the
+        output frames whose receptive field is complete are returned. Only the input frames that are still inside
+        the receptive field of future outputs are kept, and in eval mode the outputs are the same as of a forward
+        over the whole utterance.
+        :param model: DeepSpeech model with rnn_type 'cnn', in eval mode
+        """
+        assert model._rnn_type == 'cnn', "Streaming is only supported for the 'cnn' model variant"
+        self.model = model
+        self.stride, self.left, self.right = model.get_cnn_context()
+        self.reset()
+
+    def reset(self):
+        self.buffer = None  # input frames kept, HxT
+        self.offset = 0  # index of the first buffered frame in the utterance
+        self.emitted = 0  # number of output frames returned so far
+
+    def feed(self, spect):
+        """
+        :param spect: Next HxT spectrogram frames
+        :return: logits and probs (TxC) of the output frames that became final, T may be 0
+        """
+        self.buffer = spect if self.buffer is None else torch.cat((self.buffer, spect), 1)
+        total = self.offset + self.buffer.size(1)
+        ready = max(0, (total - 1 - self.right) // self.stride + 1)
+        return self._emit(ready, total)
+
+    def finish(self):
+        """
+        Ends the utterance.
+        :return: logits and probs (TxC) of the remaining output frames
+        """
+        total = self.offset + (self.buffer.size(1) if self.buffer is not None else 0)
+        if total == 0:
+            return self._emit(0, 0)
+        end = int(self.model.get_seq_lens(torch.IntTensor([total]))[0])
+        result = self._emit(end, total)
+        self.reset()
+        return result
+
+    def _emit(self, end, total):
+        device = next(self.model.parameters()).device
+        if end <= self.emitted:
+            empty = torch.zeros(0, len(self.model._labels), device=device)
+            return empty, empty
+        # window start has to be on the output grid, so that window outputs line up with utterance outputs
+        start = max(0, self.stride * self.emitted - self.left)
+        start -= start % self.stride
+        stop = min(total, self.stride * (end - 1) + self.right + 1)
+        window = self.buffer[:, start - self.offset:stop - self.offset]
+        # at the end of the utterance the window ends where the utterance does, so the padding is the same
+        window = window.contiguous().view(1, 1, window.size(0), window.size(1))
+        logits, probs, _ = self.model(window.to(device), torch.IntTensor([window.size(3)]))
+        first = self.emitted - start // self.stride
+        logits = logits[0, first:first + end - self.emitted]
+        probs = probs[0, first:first + end - self.emitted]
+        self.emitted = end
+        # drop the frames no future output can see
+        keep = max(0, self.stride * self.emitted - self.left)
+        keep -= keep % self.stride
+        if keep > self.offset:
+            self.buffer = self.buffer[:, keep - self.offset:]
+            self.offset = keep
+        return logits, probs
+
+
 def main():
     import os.path
     import argparse
     parser = argparse.ArgumentParser(description='DeepSpeech model information')
     parser.add_argument('--model-path', default='models/deepspeech_final.pth',
                         help='Path to model file created by training')
+    parser.add_argument('--export-inference', default=None,
+                        help='Save a weights-only inference package of the model to this path')
+    parser.add_argument('--half', action='store_true',
+                        help='Store the exported weights in fp16 (half the file size, but they are converted to '
+                             'fp32 copies on load and not shared between processes)')
     args = parser.parse_args()
-    package = torch.load(args.model_path, map_location=lambda storage, loc: storage)
-    model = DeepSpeech.load_model(args.model_path)
+    start_time = time.time()
+    package = DeepSpeech.load_package(args.model_path)
+    model = DeepSpeech.load_model_package(package)
+    load_time = time.time() - start_time
+    if args.export_inference:
+        torch.save(DeepSpeech.serialize_inference(model, half=args.half), args.export_inference)
     print("Model name:         ", os.path.basename(args.model_path))
     print("DeepSpeech version: ", model._version)
+    print("Package type:       ", "inference" + (" (fp16)" if package.get('half') else "")
+          if package.get('inference') else "training")
+    print("File size:           {0:.1f} MB".format(os.path.getsize(args.model_path) / 1024 ** 2))
+    print("Cold start:          {0:.3f}s".format(load_time))
     print("")
     print("Recurrent Neural Network Properties")
     print("  RNN Type:         ", model._rnn_type)
@@ -446,8 +650,12 @@ def main():
     if package.get('meta', None) is not None:
         print("")
         print("Additional Metadata")
-        for k, v in model._meta:
+        for k, v in package['meta'].items():
             print("  ", k, ": ", v)
+    if args.export_inference:
+        print("")
+        print("Exported inference package to {0} ({1:.1f} MB)".format(
+            args.export_inference, os.path.getsize(args.export_inference) / 1024 ** 2))
 
 
 if __name__ == '__main__':
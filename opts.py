@@ -4,7 +4,8 @@ def add_decoder_args(parser):
     beam_args.add_argument('--top-paths', default=1, type=int, help='number of beams to return')
     beam_args.add_argument('--beam-width', default=10, type=int, help='Beam width to use')
     beam_args.add_argument('--lm-path', default=None, type=str,
-                           help='Path to an (optional) kenlm language model for use with beam search (req\'d with trie)')
+                           help='Path to an (optional) kenlm language model for use with beam search (req\'d with trie). '
+                                'The prefix beam decoder also reads ARPA files (.arpa, .arpa.gz, .npz) without kenlm')
     beam_args.add_argument('--alpha', default=0.8, type=float, help='Language model weight')
     beam_args.add_argument('--beta', default=1, type=float, help='Language model word bonus (all words)')
     beam_args.add_argument('--cutoff-top-n', default=40, type=int,
@@ -13,6 +14,9 @@ def add_decoder_args(parser):
     beam_args.add_argument('--cutoff-prob', default=1.0, type=float,
                            help='Cutoff probability in pruning,default 1.0, no pruning.')
     beam_args.add_argument('--lm-workers', default=1, type=int, help='Number of LM processes to use')
+    beam_args.add_argument('--beam-decoder', default='auto', choices=['auto', 'ctcdecode', 'prefix'], type=str,
+                           help='Beam search implementation: ctcdecode extension, built-in NumPy prefix beam search, '
+                                'or auto (ctcdecode if installed)')
     return parser
 
 
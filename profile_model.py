@@ -0,0 +1,286 @@
+import argparse
+import json
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from data.data_loader import SpectrogramDataset, _collate_fn
+from model import DeepSpeech, Lookahead
+
+parser = argparse.ArgumentParser(description='DeepSpeech per-layer profiler')
+parser.add_argument('--model-path', default='models/deepspeech_final.pth',
+                    help='Path to model file created by training')
+parser.add_argument('--durations', default='1,5,15', type=str,
+                    help='Comma separated durations in seconds of the synthetic inputs')
+parser.add_argument('--batch-sizes', default='1,8', type=str, help='Comma separated batch sizes')
+parser.add_argument('--manifest', metavar='DIR', default='',
+                    help='Profile on the first utterances of this manifest instead of synthetic inputs')
+parser.add_argument('--cache-dir', metavar='DIR', help='path to save temp audio', default='data/cache/')
+parser.add_argument('--norm', default='max_frame', action="store",
+                    help='Normalize sounds. Choices: "mean", "frame", "max_frame", "none"')
+parser.add_argument('--runs', default=5, type=int, help='How many runs to average the timings over')
+parser.add_argument('--threads', default=0, type=int, help='Number of CPU threads (0 keeps the torch default)')
+parser.add_argument('--no-memory', dest='memory', action='store_false',
+                    help='Skip the activation memory pass')
+parser.add_argument('--output-json', default='', type=str, help='Save the results as JSON to this file')
+
+
+def get_blocks(model):
+    """
+    Top-level blocks of the model in forward order, each profiled as a whole.
+    """
+    blocks = []
+    if model._rnn_type != 'cnn':
+        blocks.append(('conv', model.conv))
+    for i, m in enumerate(model.rnns):
+        if model._rnn_type == 'cnn' and not isinstance(m, nn.Conv1d):
+            continue  # batch norms and activations are counted with their convolution below
+        blocks.append(('rnns.%d' % i, m))
+    if getattr(model, 'lookahead', None) is not None:
+        blocks.append(('lookahead', model.lookahead))
+    blocks.append(('fc', model.fc))
+    return blocks
+
+
+def leaf_flops(module, inputs, output):
+    """
+    Approximate number of floating point operations of a leaf module (multiply-add counts as 2).
+    """
+    if isinstance(module, (nn.Conv1d, nn.Conv2d)):
+        kernel = 1
+        for k in module.kernel_size:
+            kernel *= k
+        return 2 * output.numel() * module.in_channels // module.groups * kernel
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+    if isinstance(module, nn.RNNBase):
+        x = inputs[0]
+        steps = x.data.size(0) if isinstance(x, nn.utils.rnn.PackedSequence) else x.size(0) * x.size(1)
+        gates = {'LSTM': 4, 'GRU': 3}.get(module.mode, 1)
+        directions = 2 if module.bidirectional else 1
+        return 2 * gates * module.hidden_size * (module.input_size + module.hidden_size) * steps * directions
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        return 2 * output.numel()
+    if isinstance(module, Lookahead):
+        return 2 * output.numel() * (module.context + 1)
+    return 0
+
+
+class BlockProfiler(object):
+    def __init__(self, model):
+        """
+        Collects wall time and FLOPs per block through forward hooks. In the memory pass every block
+        is also wrapped into a profiler range, so that allocations can be attributed to it.
+        """
+        self.model = model
+        self.blocks = get_blocks(model)
+        self.handles = []
+        self.record_ranges = False
+        self.reset()
+        for name, block in self.blocks:
+            self.handles.append(block.register_forward_pre_hook(self._pre_hook(name)))
+            self.handles.append(block.register_forward_hook(self._post_hook(name)))
+            for leaf in block.modules():
+                if not list(leaf.children()):
+                    self.handles.append(leaf.register_forward_hook(self._flops_hook(name)))
+        if model._rnn_type == 'cnn':
+            # batch norms and activations of the cnn stack go to the preceding convolution
+            current = None
+            for i, m in enumerate(model.rnns):
+                if isinstance(m, nn.Conv1d):
+                    current = 'rnns.%d' % i
+                elif current is not None:
+                    self.handles.append(m.register_forward_hook(self._flops_hook(current)))
+                    self.handles.append(m.register_forward_pre_hook(self._pre_hook(current)))
+                    self.handles.append(m.register_forward_hook(self._post_hook(current)))
+
+    def reset(self):
+        self.times = {name: 0. for name, _ in self.blocks}
+        self.flops = {name: 0 for name, _ in self.blocks}
+        self.starts = {}
+        self.ranges = {}
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+    def _pre_hook(self, name):
+        def hook(module, inputs):
+            if self.record_ranges:
+                self.ranges[name] = torch.autograd.profiler.record_function(name)
+                self.ranges[name].__enter__()
+            self.starts[name] = time.perf_counter()
+
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, inputs, output):
+            self.times[name] += time.perf_counter() - self.starts.pop(name)
+            if self.record_ranges:
+                self.ranges.pop(name).__exit__(None, None, None)
+
+        return hook
+
+    def _flops_hook(self, name):
+        def hook(module, inputs, output):
+            self.flops[name] += leaf_flops(module, inputs, output)
+
+        return hook
+
+    def param_bytes(self):
+        result = {}
+        for name, block in self.blocks:
+            modules = [block]
+            if self.model._rnn_type == 'cnn':
+                index = int(name.split('.')[1])
+                for m in list(self.model.rnns)[index + 1:]:
+                    if isinstance(m, nn.Conv1d):
+                        break
+                    modules.append(m)
+            result[name] = sum(p.numel() * p.element_size() for m in modules for p in m.parameters())
+        return result
+
+
+def memory_peaks(model, profiler, inputs, input_sizes):
+    """
+    Runs one forward under the autograd profiler with memory tracking.
+    :return: peak CPU memory allocated during the whole forward, and during each block (relative to its start)
+    """
+    names = [name for name, _ in profiler.blocks]
+    profiler.record_ranges = True
+    try:
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            model(inputs, input_sizes)
+    finally:
+        profiler.record_ranges = False
+    events = prof.function_events
+    allocations = sorted((e.time_range.start, e.cpu_memory_usage) for e in events if e.name == '[memory]')
+    ranges = [(e.name, e.time_range.start, e.time_range.end) for e in events if e.name in names]
+
+    timeline = []
+    used = 0
+    for start, size in allocations:
+        used += size
+        timeline.append((start, used))
+    total_peak = max([used for _, used in timeline] or [0])
+
+    peaks = {name: 0 for name in names}
+    for name, start, end in ranges:
+        before = 0
+        for t, used in timeline:
+            if t >= start:
+                break
+            before = used
+        during = [used - before for t, used in timeline if start <= t <= end]
+        peaks[name] = max([peaks[name]] + during)
+    return total_peak, peaks
+
+
+def synthetic_inputs(duration, batch_size):
+    inputs = torch.randn(batch_size, 1, 161, int(duration * 100))
+    input_sizes = torch.IntTensor([inputs.size(3)] * batch_size)
+    return inputs, input_sizes
+
+
+def manifest_inputs(dataset, batch_size):
+    inputs, _, _, input_percentages, _ = _collate_fn([dataset[i] for i in range(min(batch_size, len(dataset)))])
+    input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
+    return inputs, input_sizes
+
+
+def profile(model, profiler, inputs, input_sizes, runs, memory):
+    model(inputs, input_sizes)  # warm up
+    profiler.reset()
+    softmax_time = 0.
+    start_time = time.perf_counter()
+    for _ in range(runs):
+        logits, _, _ = model(inputs, input_sizes)
+        softmax_start = time.perf_counter()
+        F.softmax(logits, dim=-1)
+        softmax_time += time.perf_counter() - softmax_start
+    total_time = (time.perf_counter() - start_time - softmax_time) / runs
+    times = {name: t / runs for name, t in profiler.times.items()}
+    flops = {name: f // runs for name, f in profiler.flops.items()}
+    param_bytes = profiler.param_bytes()
+
+    total_peak, peaks = None, {}
+    if memory:
+        total_peak, peaks = memory_peaks(model, profiler, inputs, input_sizes)
+
+    modules = []
+    for name, _ in profiler.blocks:
+        modules.append({'name': name, 'time': times[name], 'flops': flops[name],
+                        'param_bytes': param_bytes[name], 'peak_memory': peaks.get(name)})
+    # softmax is applied inside DeepSpeech.forward as well, time it on the same logits
+    modules.append({'name': 'softmax', 'time': softmax_time / runs, 'flops': 3 * logits.numel(),
+                    'param_bytes': 0, 'peak_memory': None})
+    return {
+        'duration': inputs.size(3) / 100.,
+        'batch_size': inputs.size(0),
+        'total_time': total_time,
+        'total_flops': sum(m['flops'] for m in modules),
+        'peak_memory': total_peak,
+        'modules': modules,
+    }
+
+
+def print_result(result):
+    print("")
+    print("Duration {duration:.2f}s, batch size {batch_size}: {total_time:.4f}s, {gflops:.2f} GFLOPs, "
+          "peak activation memory {peak}".format(gflops=result['total_flops'] / 1e9,
+                                                 peak=format_bytes(result['peak_memory']), **result))
+    print("  {:<12} {:>10} {:>7} {:>10} {:>12} {:>12}".format('Module', 'Time (s)', '%', 'GFLOPs', 'Params',
+                                                            'Peak mem'))
+    for m in result['modules']:
+        print("  {:<12} {:>10.4f} {:>6.1f}% {:>10.3f} {:>12} {:>12}".format(
+            m['name'], m['time'], 100 * m['time'] / (result['total_time'] or 1), m['flops'] / 1e9,
+            format_bytes(m['param_bytes']), format_bytes(m['peak_memory'])))
+
+
+def format_bytes(size):
+    if size is None:
+        return 'n/a'
+    return '{:.1f} MB'.format(size / 1024 ** 2)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.set_grad_enabled(False)
+    model = DeepSpeech.load_model(args.model_path)
+    model.eval()
+    profiler = BlockProfiler(model)
+
+    batch_sizes = [int(x) for x in args.batch_sizes.split(',')]
+    if args.manifest:
+        audio_conf = DeepSpeech.get_audio_conf(model)
+        dataset = SpectrogramDataset(audio_conf=audio_conf, manifest_filepath=args.manifest, cache_path=args.cache_dir,
+                                     labels=DeepSpeech.get_labels(model), normalize=args.norm,
+                                     max_items=max(batch_sizes))
+        configs = [manifest_inputs(dataset, batch_size) for batch_size in batch_sizes]
+    else:
+        configs = [synthetic_inputs(float(duration), batch_size)
+                   for duration in args.durations.split(',') for batch_size in batch_sizes]
+
+    results = []
+    for inputs, input_sizes in configs:
+        result = profile(model, profiler, inputs, input_sizes, args.runs, args.memory)
+        print_result(result)
+        results.append(result)
+    profiler.remove()
+
+    if args.output_json:
+        with open(args.output_json, 'w') as f:
+            json.dump({
+                'model': args.model_path,
+                'rnn_type': model._rnn_type,
+                'hidden_size': model._hidden_size,
+                'hidden_layers': model._hidden_layers,
+                'threads': torch.get_num_threads(),
+                'params': DeepSpeech.get_param_size(model),
+                'results': results,
+            }, f, indent=2)
+        print("Saved profile to", args.output_json)
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class ResultCache(object):
+    def __init__(self, max_entries=1024):
+        """
+        Bounded LRU cache of results, shared by server threads. Requests for a key that is being computed wait for
+        that computation instead of starting another one.
+        :param max_entries: number of results kept, 0 disables the cache (requests are still coalesced)
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._results = OrderedDict()  # least recently used first
+        self._running = {}  # key -> Future of the computation in flight
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        :param compute: function without arguments computing the result of the key, called on a miss
+        :return: the cached result, or the result of compute. Exceptions of compute are raised to all waiting
+        requests and are not cached.
+        """
+        with self._lock:
+            if key in self._results:
+                self.hits += 1
+                self._results.move_to_end(key)
+                return self._results[key]
+            future = self._running.get(key)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._running[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._running[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._running[key]
+            if self.max_entries > 0:
+                self._results[key] = result
+                if len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+                    self.evictions += 1
+        future.set_result(result)
+        return result
+
+    def stats(self):
+        return {'entries': len(self._results), 'hits': self.hits, 'misses': self.misses,
+                'coalesced': self.coalesced, 'evictions': self.evictions, 'in_flight': len(self._running)}
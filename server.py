@@ -1,14 +1,18 @@
+import hashlib
+import json
 import os
 from tempfile import NamedTemporaryFile
 
 import torch
 from flask import Flask, request, jsonify
 import logging
+from batching import MicroBatcher
 from data.data_loader import SpectrogramParser
 from decoder import GreedyDecoder
 from model import DeepSpeech
 from opts import add_decoder_args, add_inference_args
-from transcribe import transcribe
+from result_cache import ResultCache
+from transcribe import transcribe_batch
 
 app = Flask(__name__)
 ALLOWED_EXTENSIONS = set(['.wav', '.mp3', '.ogg', '.webm'])
@@ -29,22 +33,50 @@ def transcribe_file():
             res['status'] = "error"
             res['message'] = "{} is not supported format.".format(file_extension)
             return jsonify(res)
+        logging.info('Transcribing file...')
+        data = file.read()
+        key = (hashlib.sha1(data).hexdigest(), model_id, decoder_config)
+        transcription = result_cache.get(key, lambda: transcribe_upload(data, file_extension))
+        logging.info('File transcribed')
+        res['status'] = "OK"
+        res['transcription'] = transcription
+        return jsonify(res)
+
+
+def transcribe_upload(data, file_extension):
+    # features are computed in the request thread, the model runs batched in the batcher threads
+    spect = spect_parser.parse_audio_bytes(data)
+    if spect is None:
+        # formats that can't be decoded in memory go through sox
         with NamedTemporaryFile(suffix=file_extension) as tmp_saved_audio_file:
-            file.save(tmp_saved_audio_file.name)
-            logging.info('Transcribing file...')
-            transcription, _ = transcribe(tmp_saved_audio_file.name, spect_parser, model, decoder, args.cuda)
-            logging.info('File transcribed')
-            res['status'] = "OK"
-            res['transcription'] = transcription
-            return jsonify(res)
+            tmp_saved_audio_file.write(data)
+            tmp_saved_audio_file.flush()
+            spect = spect_parser.parse_audio_for_transcription(tmp_saved_audio_file.name)
+    spect = spect.contiguous()
+    transcription, _ = batcher(spect, spect.size(1))
+    return transcription
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(dict(batcher.stats(), result_cache=result_cache.stats()))
 
 
 def main():
     import argparse
-    global model, spect_parser, decoder, args
+    global model, spect_parser, decoder, batcher, result_cache, model_id, decoder_config, args
     parser = argparse.ArgumentParser(description='DeepSpeech transcription server')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to be used by the server')
     parser.add_argument('--port', type=int, default=8888, help='Port to be used by the server')
+    parser.add_argument('--cache-dir', metavar='DIR', default='data/cache/',
+                        help='path to save temp audio (only for formats that are not decoded in memory)')
+    parser.add_argument('--max-batch-size', type=int, default=8,
+                        help='Concurrent requests of similar length are transcribed in batches of up to this size')
+    parser.add_argument('--max-wait-ms', type=float, default=10.,
+                        help='Longest time a request waits for others to fill its batch')
+    parser.add_argument('--model-workers', type=int, default=1, help='Number of threads running batches')
+    parser.add_argument('--result-cache-size', type=int, default=1024,
+                        help='Number of transcriptions kept for resubmitted audio, 0 to disable')
     parser = add_inference_args(parser)
     parser = add_decoder_args(parser)
     args = parser.parse_args()
@@ -53,25 +85,39 @@ def main():
     logging.info('Setting up server...')
     torch.set_grad_enabled(False)
     model = DeepSpeech.load_model(args.model_path)
-    if args.cuda:
-        model.cuda()
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = model.to(device)
     model.eval()
 
     labels = DeepSpeech.get_labels(model)
     audio_conf = DeepSpeech.get_audio_conf(model)
 
     if args.decoder == "beam":
-        from decoder import BeamCTCDecoder
+        from decoder import create_beam_decoder
 
-        decoder = BeamCTCDecoder(labels, lm_path=args.lm_path, alpha=args.alpha, beta=args.beta,
-                                 cutoff_top_n=args.cutoff_top_n, cutoff_prob=args.cutoff_prob,
-                                 beam_width=args.beam_width, num_processes=args.lm_workers)
+        decoder = create_beam_decoder(labels, implementation=args.beam_decoder, lm_path=args.lm_path,
+                                      alpha=args.alpha, beta=args.beta, cutoff_top_n=args.cutoff_top_n,
+                                      cutoff_prob=args.cutoff_prob, beam_width=args.beam_width,
+                                      num_processes=args.lm_workers)
     else:
         decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
 
-    spect_parser = SpectrogramParser(audio_conf, normalize=True)
+    spect_parser = SpectrogramParser(audio_conf, cache_path=args.cache_dir, normalize='max_frame')
+    batcher = MicroBatcher(lambda spects: transcribe_batch(spects, model, decoder, device),
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           num_workers=args.model_workers)
+    with open(args.model_path, 'rb') as f:
+        model_id = hashlib.sha1(f.read()).hexdigest()
+    decoder_config = json.dumps({name: getattr(args, name) for name in (
+        'decoder', 'beam_decoder', 'lm_path', 'alpha', 'beta', 'cutoff_top_n', 'cutoff_prob', 'beam_width')},
+        sort_keys=True)
+    result_cache = ResultCache(max_entries=args.result_cache_size)
     logging.info('Server initialised')
-    app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
+    try:
+        app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        batcher.close()
+        decoder.close()
 
 
 if __name__ == "__main__":
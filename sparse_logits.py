@@ -0,0 +1,142 @@
+import argparse
+import json
+import pickle
+
+import numpy as np
+import torch
+
+from data.utils import get_batch_cer_wer
+from decoder import GreedyDecoder
+from opts import add_decoder_args
+
+
+def sparsify(probs, k, half=False, rle_threshold=0., blank_index=0):
+    """
+    Keeps the k most probable labels of every frame.
+    :param probs: TxV array of label probabilities
+    :param half: store the probabilities in fp16
+    :param rle_threshold: consecutive frames where the blank has at least this probability are stored once,
+    with a repeat count (0 disables). Greedy decoding is not affected by thresholds of 0.5 and above.
+    :return: dict of numpy arrays, see densify()
+    """
+    probs = np.asarray(probs, dtype=np.float32)
+    frames, num_labels = probs.shape
+    k = min(k, num_labels)
+    repeats = None
+    if rle_threshold > 0 and frames:
+        blank = probs[:, blank_index] >= rle_threshold
+        keep = np.ones(frames, dtype=bool)
+        keep[1:] = ~(blank[1:] & blank[:-1])
+        kept = np.flatnonzero(keep)
+        repeats = np.diff(np.append(kept, frames)).astype(np.int32)
+        probs = probs[kept]
+    if k < num_labels:
+        indices = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(k), (len(probs), 1))
+    values = np.take_along_axis(probs, indices, 1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, 1)
+    values = np.take_along_axis(values, order, 1)
+    return {
+        'frames': frames,
+        'num_labels': num_labels,
+        'values': values.astype(np.float16 if half else np.float32),
+        'indices': indices.astype(np.uint8 if num_labels <= 256 else np.int16),
+        'repeats': repeats,
+    }
+
+
+def densify(sparse, fill=True):
+    """
+    Reconstructs TxV probabilities from the output of sparsify().
+    :param fill: spread the probability mass of the dropped labels uniformly over them, so that all labels keep
+    a non-zero probability (as beam search decoders with a language model expect). If False the dropped labels get
+    zero probability, which gives pruned inputs for decoders that only look at the top labels anyway.
+    """
+    values = sparse['values'].astype(np.float32)
+    indices = sparse['indices'].astype(np.int64)
+    num_labels = sparse['num_labels']
+    rows = len(values)
+    probs = np.zeros((rows, num_labels), dtype=np.float32)
+    if fill and indices.shape[1] < num_labels:
+        rest = np.maximum(1. - values.sum(1), 0.) / (num_labels - indices.shape[1])
+        probs += rest[:, None]
+    np.put_along_axis(probs, indices, values, 1)
+    if sparse['repeats'] is not None:
+        probs = np.repeat(probs, sparse['repeats'], 0)
+    return probs
+
+
+def load_probs(result, fill=True):
+    """
+    Dense TxV probabilities of an utterance saved by test.py --output-path, in either the dense or the sparse format.
+    """
+    if 'sparse_probs' in result:
+        return densify(result['sparse_probs'], fill)
+    return np.asarray(result['probs'], dtype=np.float32)
+
+
+def decode(decoder, utterances, batch_size=20):
+    transcripts = []
+    for i in range(0, len(utterances), batch_size):
+        chunk = utterances[i:i + batch_size]
+        sizes = torch.IntTensor([len(p) for p in chunk])
+        probs = torch.zeros(len(chunk), int(sizes.max()), chunk[0].shape[1])
+        for j, p in enumerate(chunk):
+            probs[j, :len(p)] = torch.from_numpy(p)
+        strings, _ = decoder.decode(probs, sizes)
+        transcripts.extend(s[0] for s in strings)
+    return transcripts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Space savings and WER impact of sparse (top-k) outputs')
+    parser.add_argument('--outputs', required=True,
+                        help='File list written by test.py --output-path (with full, dense outputs)')
+    parser.add_argument('--labels-path', default='labels.json', help='Contains all characters for transcription')
+    parser.add_argument('--ks', default='1,2,3,5,10', type=str, help='Comma separated numbers of labels to keep')
+    parser.add_argument('--half', action='store_true', help='Store the kept probabilities in fp16')
+    parser.add_argument('--rle-threshold', default=0., type=float,
+                        help='Run-length compress frames where the blank has at least this probability (0 disables)')
+    parser.add_argument('--decoder', default='greedy', choices=['greedy', 'beam'], type=str, help='Decoder to use')
+    parser = add_decoder_args(parser)
+    args = parser.parse_args()
+
+    with open(args.labels_path) as label_file:
+        labels = str(''.join(json.load(label_file)))
+    blank_index = labels.index('_')
+    if args.decoder == 'beam':
+        from decoder import create_beam_decoder
+
+        decoder = create_beam_decoder(labels, implementation=args.beam_decoder, lm_path=args.lm_path,
+                                      alpha=args.alpha, beta=args.beta, cutoff_top_n=args.cutoff_top_n,
+                                      cutoff_prob=args.cutoff_prob, beam_width=args.beam_width,
+                                      num_processes=args.lm_workers, blank_index=blank_index)
+    else:
+        decoder = GreedyDecoder(labels, blank_index=blank_index)
+
+    with open(args.outputs) as f:
+        files = [line.strip() for line in f if line.strip()]
+    utterances, references, dense_size = [], [], 0
+    for filename in files:
+        with open(filename, 'rb') as f:
+            result = pickle.load(f)
+        utterances.append(load_probs(result))
+        references.append(result['reference'])
+        dense_size += len(pickle.dumps({'logits': result.get('logits'), 'probs': result.get('probs')}, protocol=4))
+
+    def report(name, size, transcripts):
+        _, total = get_batch_cer_wer(transcripts, references)
+        print("{:<10} {:>12.1f} {:>8.1f}x {:>8.3f} {:>8.3f}".format(
+            name, size / 1024 ** 2, dense_size / max(size, 1), 100 * total.wer / total.wer_ref,
+            100 * total.cer / total.cer_ref))
+
+    print("{} utterances, {} frames".format(len(utterances), sum(len(p) for p in utterances)))
+    print("{:<10} {:>12} {:>9} {:>8} {:>8}".format('Output', 'Size (MB)', 'Savings', 'WER', 'CER'))
+    report('dense', dense_size, decode(decoder, utterances))
+    for k in [int(x) for x in args.ks.split(',')]:
+        sparse = [sparsify(p, k, args.half, args.rle_threshold, blank_index) for p in utterances]
+        size = sum(len(pickle.dumps(s, protocol=4)) for s in sparse)
+        report('top-{}'.format(k), size, decode(decoder, [densify(s) for s in sparse]))
+    decoder.close()
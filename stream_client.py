@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import time
+import wave
+from urllib.parse import urlparse
+
+import numpy as np
+
+parser = argparse.ArgumentParser(description='Streams audio files to the streaming transcription server')
+parser.add_argument('--url', default='http://localhost:8889/stream', help='Streaming endpoint')
+parser.add_argument('--audio-path', nargs='+', required=True, help='16-bit PCM WAV files to stream, used in turn')
+parser.add_argument('--sessions', default=1, type=int, help='Number of concurrent sessions')
+parser.add_argument('--chunk-ms', default=100, type=float, help='Audio sent in each chunk')
+parser.add_argument('--realtime', action='store_true', help='Send the audio at the speed it would be recorded')
+parser.add_argument('--quiet', action='store_true', help='Do not print the transcripts')
+
+
+def read_pcm(path):
+    with wave.open(path) as f:
+        assert f.getsampwidth() == 2, "{} is not 16-bit PCM".format(path)
+        channels, sample_rate = f.getnchannels(), f.getframerate()
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype('<i2')
+    return samples.tobytes(), sample_rate
+
+
+async def read_messages(reader):
+    """
+    Yields the JSON lines of a response with chunked transfer encoding.
+    """
+    status = (await reader.readline()).decode('latin-1')
+    while status.split(' ')[1] == '100':
+        await reader.readline()
+        status = (await reader.readline()).decode('latin-1')
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() != 'chunked':
+        raise RuntimeError('{}: {}'.format(status.strip(), (await reader.read()).decode()))
+    pending = b''
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if size == 0:
+            return
+        pending += await reader.readexactly(size)
+        await reader.readline()
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            yield json.loads(line.decode('utf-8'))
+
+
+async def stream(url, data, sample_rate, chunk_ms, realtime, verbose):
+    """
+    :return: the transcript, the seconds from the end of the audio to the last final transcript, number of partials
+    """
+    url = urlparse(url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    writer.write('POST {}?rate={} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/octet-stream\r\n'
+                 'Transfer-Encoding: chunked\r\n\r\n'.format(url.path, sample_rate, url.netloc).encode())
+    sent = []
+
+    async def send():
+        chunk = int(sample_rate * chunk_ms / 1000) * 2
+        start_time = time.perf_counter()
+        for i in range(0, len(data), chunk):
+            piece = data[i:i + chunk]
+            writer.write(b'%x\r\n' % len(piece) + piece + b'\r\n')
+            await writer.drain()  # waits while the server is not reading
+            if realtime:
+                ahead = start_time + (i + len(piece)) / 2 / sample_rate - time.perf_counter()
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        sent.append(time.perf_counter())
+
+    sending = asyncio.ensure_future(send())
+    finals, partials, last_final = [], 0, None
+    try:
+        async for message in read_messages(reader):
+            if 'final' in message:
+                finals.append(message['final'])
+                last_final = time.perf_counter()
+                if verbose:
+                    print('[{:.2f}-{:.2f}] {}'.format(message['start'], message['end'], message['final']))
+            else:
+                partials += 1
+                if verbose:
+                    print('  ... {}'.format(message['partial']))
+        await sending
+    finally:
+        sending.cancel()
+        writer.close()
+    latency = last_final - sent[0] if last_final is not None and sent else None
+    return ' '.join(f for f in finals if f), latency, partials
+
+
+async def run(args):
+    files = [read_pcm(path) for path in args.audio_path]
+    verbose = not args.quiet and args.sessions == 1
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[
+        stream(args.url, *files[i % len(files)], args.chunk_ms, args.realtime, verbose)
+        for i in range(args.sessions)])
+    total_time = time.perf_counter() - start_time
+    if not args.quiet and args.sessions > 1:
+        for i, (transcript, _, _) in enumerate(results):
+            print("{}: {}".format(args.audio_path[i % len(files)], transcript))
+    audio_seconds = sum(len(files[i % len(files)][0]) / 2 / files[i % len(files)][1] for i in range(args.sessions))
+    latencies = np.array([latency for _, latency, _ in results if latency is not None]) * 1000
+    print("{} sessions, {:.1f}s of audio in {:.1f}s, {} partial transcripts".format(
+        args.sessions, audio_seconds, total_time, sum(partials for _, _, partials in results)))
+    if len(latencies):
+        print("Final transcript after end of audio (ms): p50 {:.1f}  p90 {:.1f}  max {:.1f}".format(
+            *np.percentile(latencies, [50, 90, 100])))
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import torch
+
+from batching import MicroBatcher
+from data.data_loader import SpectrogramParser, quiet_point
+from decoder import GreedyDecoder
+from model import DeepSpeech
+from opts import add_decoder_args, add_inference_args
+from transcribe import transcribe_batch
+
+parser = argparse.ArgumentParser(description='DeepSpeech streaming transcription server')
+parser.add_argument('--host', type=str, default='0.0.0.0', help='Host to be used by the server')
+parser.add_argument('--port', type=int, default=8889, help='Port to be used by the server')
+parser.add_argument('--step-ms', type=float, default=500.,
+                    help='A new partial transcript is computed when this much audio has arrived')
+parser.add_argument('--segment-seconds', type=float, default=10.,
+                    help='Audio is finalized in segments of at most this length, cut at the quietest point of '
+                         'their last second')
+parser.add_argument('--max-buffer-seconds', type=float, default=5.,
+                    help='Reading of a session is paused while this much of its audio is not transcribed yet')
+parser.add_argument('--max-batch-size', type=int, default=16,
+                    help='Model steps of concurrent sessions are run in batches of up to this size')
+parser.add_argument('--max-wait-ms', type=float, default=10.,
+                    help='Longest time a model step waits for others to fill its batch')
+parser.add_argument('--model-workers', type=int, default=1, help='Number of threads running batches')
+parser.add_argument('--feature-workers', type=int, default=4, help='Number of threads computing spectrograms')
+parser = add_inference_args(parser)
+parser = add_decoder_args(parser)
+
+
+async def read_body(reader, headers):
+    """
+    Yields the pieces of a request body as they arrive, with chunked transfer encoding or a content length.
+    """
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()).strip():  # trailers
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    remaining = int(headers.get('content-length', 0))
+    while remaining > 0:
+        data = await reader.read(min(remaining, 65536))
+        if not data:
+            return
+        remaining -= len(data)
+        yield data
+
+
+class StreamSession(object):
+    def __init__(self, sample_rate):
+        """
+        Audio of one stream. Only the current segment is kept; its transcript is recomputed as audio arrives.
+        """
+        self.sample_rate = sample_rate
+        self.audio = np.zeros(0, dtype=np.float32)  # samples of the current segment
+        self.offset = 0  # position of the current segment in the stream, in samples
+        self.transcribed = 0  # samples of the current segment covered by the last partial transcript
+        self.segment = 0
+        self.closed = False
+        self.aborted = False
+        self.changed = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self._odd_byte = b''
+
+    def add(self, data):
+        """
+        :param data: signed 16-bit little-endian mono PCM, in pieces of any length
+        """
+        data = self._odd_byte + data
+        n = len(data) // 2 * 2
+        self._odd_byte = data[n:]
+        # on the scale of load_audio, which gives 32-bit integer sample values
+        samples = np.frombuffer(data[:n], dtype='<i2').astype(np.float32) * 65536
+        self.audio = np.concatenate((self.audio, samples))
+        self.changed.set()
+
+    def pending(self):
+        return len(self.audio) - self.transcribed
+
+    def cut(self, end):
+        """
+        Ends the current segment at sample end of it.
+        :return: the samples of the segment and its start and end in seconds in the stream
+        """
+        audio, start = self.audio[:end], self.offset
+        self.audio = self.audio[end:]
+        self.offset += end
+        self.transcribed = 0
+        self.segment += 1
+        return audio, start / self.sample_rate, self.offset / self.sample_rate
+
+
+class StreamingServer(object):
+    def __init__(self, spect_parser, batcher, step_seconds, segment_seconds, max_buffer_seconds, feature_workers=4):
+        """
+        Transcribes audio streamed in the body of POST (or PUT) /stream requests with chunked transfer encoding.
+        The response is sent while the audio is received, as JSON lines with chunked transfer encoding:
+        {"segment": i, "partial": text} whenever step_seconds of new audio have arrived, and
+        {"segment": i, "final": text, "start": seconds, "end": seconds} when a segment is complete.
+        The model steps of all sessions go through the batcher, so concurrent sessions share batches.
+        """
+        self.spect_parser = spect_parser
+        self.batcher = batcher
+        self.sample_rate = spect_parser.sample_rate
+        self.step = int(step_seconds * self.sample_rate)
+        self.segment = int(segment_seconds * self.sample_rate)
+        self.max_buffer = int(max_buffer_seconds * self.sample_rate)
+        self.min_samples = int(spect_parser.window_size * self.sample_rate)
+        self.features = ThreadPoolExecutor(feature_workers)
+        self.sessions = 0
+
+    async def handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = urlparse(target)
+            if url.path == '/stats' and method == 'GET':
+                stats = dict(self.batcher.stats(), sessions=self.sessions)
+                await self.respond(writer, '200 OK', json.dumps(stats))
+                return
+            if url.path != '/stream' or method not in ('POST', 'PUT'):
+                await self.respond(writer, '404 Not Found', json.dumps({'status': 'error', 'message': 'not found'}))
+                return
+            rate = int(parse_qs(url.query).get('rate', [self.sample_rate])[0])
+            if rate != self.sample_rate:
+                message = 'audio should be 16-bit PCM at {} Hz'.format(self.sample_rate)
+                await self.respond(writer, '400 Bad Request', json.dumps({'status': 'error', 'message': message}))
+                return
+            if headers.get('expect', '').lower() == '100-continue':
+                writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                         b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+            await self.stream(reader, writer, headers)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            logging.info('Stream ended: {!r}'.format(e))
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body):
+        body = body.encode()
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+        await writer.drain()
+
+    async def stream(self, reader, writer, headers):
+        session = StreamSession(self.sample_rate)
+        self.sessions += 1
+        receiving = asyncio.ensure_future(self.receive(session, reader, headers))
+        try:
+            await self.transcribe(session, writer)
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            self.sessions -= 1
+            receiving.cancel()
+
+    async def receive(self, session, reader, headers):
+        try:
+            async for data in read_body(reader, headers):
+                session.add(data)
+                # backpressure: stop reading the socket of this session until its transcription catches up
+                if session.pending() > self.max_buffer:
+                    session.drained.clear()
+                    await session.drained.wait()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            session.aborted = True
+        finally:
+            session.closed = True
+            session.changed.set()
+
+    async def transcribe(self, session, writer):
+        step = min(self.step, self.max_buffer)
+        while not session.aborted:
+            if len(session.audio) >= self.segment:
+                audio, start, end = session.cut(quiet_point(session.audio, self.sample_rate))
+                await self.send(writer, {'segment': session.segment - 1, 'final': await self.recognize(audio),
+                                         'start': start, 'end': end})
+            elif session.closed:
+                if len(session.audio):
+                    audio, start, end = session.cut(len(session.audio))
+                    await self.send(writer, {'segment': session.segment - 1, 'final': await self.recognize(audio),
+                                             'start': start, 'end': end})
+                return
+            elif session.pending() >= step:
+                audio = session.audio
+                session.transcribed = len(audio)
+                text = await self.recognize(audio)
+                await self.send(writer, {'segment': session.segment, 'partial': text})
+            else:
+                session.changed.clear()
+                await session.changed.wait()
+            if session.pending() <= self.max_buffer:
+                session.drained.set()
+
+    async def recognize(self, audio):
+        if len(audio) < self.min_samples:
+            return ''
+        loop = asyncio.get_event_loop()
+        spect = await loop.run_in_executor(self.features, self.spect_parser.parse_audio_samples, audio,
+                                           self.sample_rate)
+        spect = spect.contiguous()
+        transcription, _ = await asyncio.wrap_future(self.batcher.submit(spect, spect.size(1)))
+        return transcription[0][0]
+
+    async def send(self, writer, message):
+        data = (json.dumps(message) + '\n').encode()
+        writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        await writer.drain()
+
+
+def main():
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.INFO)
+
+    logging.info('Setting up server...')
+    torch.set_grad_enabled(False)
+    model = DeepSpeech.load_model(args.model_path)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = model.to(device)
+    model.eval()
+
+    labels = DeepSpeech.get_labels(model)
+    audio_conf = DeepSpeech.get_audio_conf(model)
+
+    if args.decoder == "beam":
+        from decoder import create_beam_decoder
+
+        decoder = create_beam_decoder(labels, implementation=args.beam_decoder, lm_path=args.lm_path,
+                                      alpha=args.alpha, beta=args.beta, cutoff_top_n=args.cutoff_top_n,
+                                      cutoff_prob=args.cutoff_prob, beam_width=args.beam_width,
+                                      num_processes=args.lm_workers)
+    else:
+        decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
+
+    spect_parser = SpectrogramParser(audio_conf, cache_path=None, normalize='max_frame')
+    batcher = MicroBatcher(lambda spects: transcribe_batch(spects, model, decoder, device),
+                           max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms,
+                           num_workers=args.model_workers)
+    server = StreamingServer(spect_parser, batcher, args.step_ms / 1000., args.segment_seconds,
+                             args.max_buffer_seconds, feature_workers=args.feature_workers)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    listener = loop.run_until_complete(asyncio.start_server(server.handle, args.host, args.port))
+    logging.info('Server initialised, streaming at http://{}:{}/stream'.format(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        batcher.close()
+        decoder.close()
+
+
+if __name__ == "__main__":
+    main()
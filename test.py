@@ -1,17 +1,30 @@
 import argparse
 import csv
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
 
 import numpy as np
 import torch
 import gc
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
 from tqdm import tqdm
 
-from data.data_loader import SpectrogramDataset, AudioDataLoader
-from data.utils import get_cer_wer
+from data.data_loader import SpectrogramDataset, AudioDataLoader, DurationBatchSampler, padding_ratio
+from data.utils import get_batch_cer_wer
 from decoder import GreedyDecoder
+from eval_cache import EvalCache
+from logits_store import LogitsStoreWriter, merge_stores
 from model import DeepSpeech
 from opts import add_decoder_args, add_inference_args
+from sparse_logits import sparsify
 
 parser = argparse.ArgumentParser(description='DeepSpeech transcription')
 parser = add_inference_args(parser)
@@ -21,6 +34,29 @@ parser.add_argument('--test-manifest', metavar='DIR',
                     help='path to validation manifest csv', default='data/test_manifest.csv')
 parser.add_argument('--batch-size', default=20, type=int, help='Batch size for training')
 parser.add_argument('--num-workers', default=4, type=int, help='Number of workers used in dataloading')
+parser.add_argument('--metric-workers', default=0, type=int,
+                    help='Number of processes computing WER/CER of large batches (0 computes them in place)')
+parser.add_argument('--pipeline-workers', default=0, type=int,
+                    help='Decode and score batches in this many threads while the model runs on the next batches '
+                         '(0 runs everything in turn)')
+parser.add_argument('--pipeline-queue', default=4, type=int,
+                    help='Maximum number of batches of model outputs waiting to be decoded')
+parser.add_argument('--sort-by-duration', action='store_true',
+                    help='Batch utterances of similar duration together, reports keep the manifest order')
+parser.add_argument('--batch-frames', default=0, type=int,
+                    help='With --sort-by-duration, fill batches up to this many padded spectrogram frames '
+                         'instead of --batch-size utterances')
+parser.add_argument('--eval-processes', default=1, type=int,
+                    help='Evaluate interleaved shards of the manifest in this many processes, each with its own model '
+                         '(for CPU-only machines)')
+parser.add_argument('--threads', default=0, type=int,
+                    help='torch threads per process (0 keeps the torch default, or divides the cores evenly '
+                         'between --eval-processes)')
+parser.add_argument('--summary-file', default='', type=str,
+                    help='Save the error counts and throughput of the run to this JSON file')
+parser.add_argument('--eval-cache', default='', type=str,
+                    help='Directory caching the model outputs of every utterance, keyed by the model weights, the '
+                         'feature configuration and the audio. Runs with other decoder options skip the forward pass')
 parser.add_argument('--verbose', action="store_true", help="print out decoded output and error of each sample")
 parser.add_argument('--errors', action="store_true", help="print error report")
 parser.add_argument('--best', action="store_true", help="print best results")
@@ -30,84 +66,153 @@ parser.add_argument('--report-file', metavar='DIR', default='data/test_report.cs
 no_decoder_args = parser.add_argument_group("No Decoder Options", "Configuration options for when no decoder is "
                                                                   "specified")
 no_decoder_args.add_argument('--output-path', default=None, type=str, help="Where to save raw acoustic output")
+no_decoder_args.add_argument('--output-store', default=None, type=str,
+                             help="Directory to save the outputs of all utterances to as memory-mapped shards "
+                                  "(see logits_store.py), for tune_decoder.py")
+no_decoder_args.add_argument('--output-topk', default=0, type=int,
+                             help="Save only the top k probabilities of every frame instead of the full logits and "
+                                  "probs (0 saves everything), see sparse_logits.py")
+no_decoder_args.add_argument('--output-half', action='store_true', help="Save the top k probabilities in fp16")
+no_decoder_args.add_argument('--output-rle-threshold', default=0., type=float,
+                             help="Store consecutive frames with at least this blank probability once (0 disables)")
 parser = add_decoder_args(parser)
 args = parser.parse_args()
 
-if __name__ == '__main__':
-    torch.set_grad_enabled(False)
-    model = DeepSpeech.load_model(args.model_path)
-    device = torch.device("cuda" if args.cuda else "cpu")
-    model = model.to(device)
-    model.eval()
 
-    labels = DeepSpeech.get_labels(model)
-    audio_conf = DeepSpeech.get_audio_conf(model)
+class StageTimer(object):
+    def __init__(self):
+        """
+        Total time spent per evaluation stage, stages may run in several threads at once.
+        """
+        self.totals = {}
+        self._lock = threading.Lock()
 
-    report_file = None
-    if args.report_file:
-        os.makedirs(os.path.dirname(args.report_file), exist_ok=True)
-        report_file = csv.writer(open(args.report_file, 'wt'))
-        report_file.writerow(['wav', 'text', 'transcript', 'offsets', 'CER', 'WER'])
+    def add(self, stage, seconds):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.) + seconds
 
-    if args.decoder == "beam":
-        from .decoder import BeamCTCDecoder
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
 
-        decoder = BeamCTCDecoder(labels, lm_path=args.lm_path, alpha=args.alpha, beta=args.beta,
-                                 cutoff_top_n=args.cutoff_top_n, cutoff_prob=args.cutoff_prob,
-                                 beam_width=args.beam_width, num_processes=args.lm_workers)
-    elif args.decoder == "greedy":
-        decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
-    else:
-        decoder = None
-    target_decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
-    test_dataset = SpectrogramDataset(audio_conf=audio_conf,
-                                      manifest_filepath=args.test_manifest,
-                                      cache_path=args.cache_dir,
-                                      labels=labels,
-                                      normalize=args.norm)
-    # import random;random.shuffle(test_dataset.ids)
+    def report(self, wall_time):
+        print("Stage timings (s):  " + "  ".join("{} {:.2f}".format(stage, seconds)
+                                                  for stage, seconds in self.totals.items()) +
+              "  wall {:.2f}".format(wall_time))
 
-    test_loader = AudioDataLoader(test_dataset, batch_size=args.batch_size,
-                                  num_workers=args.num_workers)
-    total_cer, total_wer, num_tokens, num_chars = 0, 0, 0, 0
-    processed_files = []
-    for i, data in tqdm(enumerate(test_loader), total=len(test_loader)):
-        inputs, targets, filenames, input_percentages, target_sizes = data
-        input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
 
-        # unflatten targets
-        split_targets = []
-        offset = 0
-        for size in target_sizes:
-            split_targets.append(targets[offset:offset + size])
-            offset += size
+class EvalPipeline(object):
+    def __init__(self, process, write, workers, queue_size):
+        """
+        Runs process(item) in worker threads and write(result) in one writer thread, in the order the items were put.
+        put() blocks while queue_size items are waiting, so that model outputs don't pile up in memory.
+        """
+        self.process = process
+        self.write = write
+        self.inputs = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.error = None
+        self.count = 0
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        for thread in self.workers + [self.writer]:
+            thread.start()
 
-        inputs = inputs.to(device)
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.inputs.put((self.count, item))
+        self.count += 1
 
-        # print(inputs.shape, inputs.is_cuda, input_sizes.shape, input_sizes.is_cuda)
-        out0, out, output_sizes = model(inputs, input_sizes)
+    def close(self):
+        for _ in self.workers:
+            self.inputs.put(None)
+        for thread in self.workers:
+            thread.join()
+        self.results.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
 
-        del inputs, targets, input_percentages, target_sizes
+    def _work(self):
+        while True:
+            task = self.inputs.get()
+            if task is None:
+                break
+            index, item = task
+            try:
+                result = self.process(item) if self.error is None else None
+            except Exception as e:
+                self.error = e
+                result = None
+            self.results.put((index, result))
 
-        if decoder is None: continue
-        decoded_output, _ = decoder.decode(out.data, output_sizes.data)
-        target_strings = target_decoder.convert_to_strings(split_targets)
+    def _write(self):
+        pending = {}
+        next_index = 0
+        while True:
+            task = self.results.get()
+            if task is None:
+                break
+            pending[task[0]] = task[1]
+            while next_index in pending:
+                result = pending.pop(next_index)
+                next_index += 1
+                if self.error is None:
+                    try:
+                        self.write(result)
+                    except Exception as e:
+                        self.error = e
+
+
+class EvalReport(object):
+    def __init__(self, labels, report_file, output_store, order=None):
+        """
+        Accumulates error counts and writes the per-utterance reports and outputs of decoded batches.
+        :param order: dict of audio path -> manifest position. If given, report rows and the output list
+        are kept until close() and written in manifest order
+        """
+        self.labels = labels
+        self.report_file = report_file
+        self.output_store = output_store
+        self.order = order
+        self.total_cer, self.total_wer, self.num_tokens, self.num_chars = 0, 0, 0, 0
+        self.processed_files = []
+        self.rows = []
+
+    def close(self):
+        if self.order is not None:
+            self.processed_files.sort(key=lambda fn: self.order[fn[:-len('.ts')]])
+            self.rows.sort(key=lambda row: self.order[row[0]])
+            if self.report_file:
+                self.report_file.writerows(self.rows)
 
-        out_raw_cpu = out0.cpu().numpy()
-        out_softmax_cpu = out.cpu().numpy()
-        sizes_cpu = output_sizes.cpu().numpy()
-        for x in tqdm(range(len(target_strings))):
+    def write(self, result):
+        (filenames, out_raw_cpu, out_softmax_cpu, sizes_cpu, _), decoded_output, target_strings, errors = result
+        labels, report_file, output_store = self.labels, self.report_file, self.output_store
+        for x in range(len(target_strings)):
             transcript, reference = decoded_output[x][0], target_strings[x][0]
 
-            wer, cer, wer_ref, cer_ref = get_cer_wer(decoder, transcript[:2000], reference[:2000])
+            wer, cer, wer_ref, cer_ref = errors[x]
+
+            if output_store is not None:
+                output_store.add(filenames[x], out_softmax_cpu[x, :sizes_cpu[x]], reference, transcript)
 
             if args.output_path:
                 # add output to data array, and continue
                 import pickle
                 with open(filenames[x]+'.ts', 'wb') as f:
+                    if args.output_topk > 0:
+                        outputs = {'sparse_probs': sparsify(out_softmax_cpu[x, :sizes_cpu[x]], args.output_topk,
+                                                            args.output_half, args.output_rle_threshold,
+                                                            labels.index('_'))}
+                    else:
+                        outputs = {'logits': out_raw_cpu[x, :sizes_cpu[x]], 'probs': out_softmax_cpu[x, :sizes_cpu[x]]}
                     results = {
-                        'logits': out_raw_cpu[x, :sizes_cpu[x]],
-                        'probs': out_softmax_cpu[x, :sizes_cpu[x]],
                         'len': sizes_cpu[x],
                         'transcript': transcript,
                         'reference': reference,
@@ -115,10 +220,11 @@ if __name__ == '__main__':
                         'wer': wer / wer_ref,
                         'cer': cer / cer_ref,
                     }
+                    results.update(outputs)
                     pickle.dump(results, f, protocol=4)
                     del results
                 # continue
-                processed_files.append(filenames[x] + '.ts')
+                self.processed_files.append(filenames[x] + '.ts')
 
             if args.verbose:
                 print("Ref:", reference)
@@ -145,32 +251,311 @@ if __name__ == '__main__':
             if report_file:
                 # report_file.write_row(['wav', 'text', 'transcript', 'offsets', 'CER', 'WER'])
 
-                report_file.writerow([
+                row = [
                     filenames[x],
                     reference,
                     transcript,
                     cer / cer_ref,
                     wer / wer_ref
-                ])
+                ]
+                if self.order is not None:
+                    self.rows.append(row)
+                else:
+                    report_file.writerow(row)
+
+            self.total_wer += wer
+            self.total_cer += cer
+            self.num_tokens += wer_ref
+            self.num_chars += cer_ref
+
 
-            total_wer += wer
-            total_cer += cer
-            num_tokens += wer_ref
-            num_chars += cer_ref
+def cached_batches(rows, dataset, batch_size):
+    """
+    Batches of model outputs of utterances in the evaluation cache, as the forward pass gives them.
+    :return: batch, and the number of input frames of its utterances
+    """
+    for i in range(0, len(rows), batch_size):
+        chunk = rows[i:i + batch_size]
+        outputs = [eval_cache.get(wav) for wav, _, _ in chunk]
+        sizes = np.array([len(logits) for logits, _ in outputs], dtype=np.int32)
+        out_raw = np.zeros((len(chunk), sizes.max(), outputs[0][0].shape[1]), dtype=np.float32)
+        for j, (logits, _) in enumerate(outputs):
+            out_raw[j, :sizes[j]] = logits
+        out_softmax = torch.softmax(torch.from_numpy(out_raw), dim=-1).numpy()
+        split_targets = [torch.IntTensor(dataset.parse_transcript(txt)) for _, txt, _ in chunk]
+        yield ([wav for wav, _, _ in chunk], out_raw, out_softmax, sizes, split_targets), \
+            sum(frames for _, frames in outputs)
+
+
+def decode_outputs(batch):
+    """
+    Decodes a batch of model outputs and computes its error counts.
+    """
+    filenames, out_raw_cpu, out_softmax_cpu, sizes_cpu, split_targets = batch
+    with timer.measure('decode'):
+        decoded_output, _ = decoder.decode(torch.from_numpy(out_softmax_cpu), torch.from_numpy(sizes_cpu))
+    with timer.measure('metrics'):
+        target_strings = target_decoder.convert_to_strings(split_targets)
+        errors, _ = get_batch_cer_wer([x[0][:2000] for x in decoded_output], [x[0][:2000] for x in target_strings],
+                                      pool=metric_pool)
+    return batch, decoded_output, target_strings, errors
+
+
+def write_outputs(result):
+    with timer.measure('write'):
+        report.write(result)
+
+
+def print_summary(summary):
+    if summary['wer_ref']:
+        print('Test Summary \t'
+              'Average WER {wer:.3f}\t'
+              'Average CER {cer:.3f}\t'.format(wer=100. * summary['wer'] / summary['wer_ref'],
+                                                cer=100. * summary['cer'] / summary['cer_ref']))
+    print("Processed {} utterances ({:.2f} h of audio) in {:.1f}s: {:.2f} utterances/s, real-time factor {:.4f}".format(
+        summary['utterances'], summary['audio_seconds'] / 3600, summary['wall_time'],
+        summary['utterances'] / max(summary['wall_time'], 1e-9),
+        summary['wall_time'] / max(summary['audio_seconds'], 1e-9)))
+    if 'cache_hits' in summary:
+        print("Evaluation cache: {} hits, {} misses ({:.1f}% hit rate)".format(
+            summary['cache_hits'], summary['cache_misses'],
+            100. * summary['cache_hits'] / max(summary['cache_hits'] + summary['cache_misses'], 1)))
+
+
+def without_args(argv, names):
+    """
+    Removes options and their values from a command line.
+    """
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif arg.split('=', 1)[0] not in names:
+            result.append(arg)
+    return result
+
+
+def evaluate_sharded(num_processes):
+    """
+    Runs test.py in several processes on interleaved shards of the test manifest, and merges their reports,
+    outputs and error counts. Process 0 prints to the console, the others log to the work directory.
+    """
+    start_time = time.perf_counter()
+    with open(args.test_manifest, newline='') as f:
+        rows = list(csv.reader(f))
+    num_processes = min(num_processes, len(rows))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // num_processes)
+    work_dir = tempfile.mkdtemp(prefix='deepspeech_eval_')
+    argv = without_args(sys.argv[1:], ['--eval-processes', '--test-manifest', '--report-file', '--output-path',
+                                       '--output-store', '--summary-file', '--threads'])
+    shards = [os.path.join(work_dir, 'shard_{}'.format(i)) for i in range(num_processes)]
+    workers = []
+    for i, shard in enumerate(shards):
+        with open(shard + '.csv', 'w', newline='') as f:
+            csv.writer(f).writerows(rows[i::num_processes])
+        shard_argv = argv + ['--test-manifest', shard + '.csv', '--summary-file', shard + '.json',
+                             '--threads', str(threads), '--report-file', shard + '.report.csv' if args.report_file else '']
+        if args.output_path:
+            shard_argv += ['--output-path', shard + '.outputs.txt']
+        if args.output_store:
+            shard_argv += ['--output-store', shard + '.store']
+        log = None if i == 0 else open(shard + '.log', 'w')
+        workers.append(subprocess.Popen([sys.executable, sys.argv[0]] + shard_argv, stdout=log, stderr=log))
+    failed = [i for i, p in enumerate(workers) if p.wait() != 0]
+    if failed:
+        print("Evaluation processes {} failed, see the logs in {}".format(failed, work_dir))
+        sys.exit(1)
+
+    order = {row[0]: i for i, row in reversed(list(enumerate(rows)))}
+    if args.report_file:
+        report_rows = []
+        for shard in shards:
+            with open(shard + '.report.csv', newline='') as f:
+                report_rows.extend(list(csv.reader(f))[1:])
+        os.makedirs(os.path.dirname(args.report_file) or '.', exist_ok=True)
+        with open(args.report_file, 'wt') as f:
+            report_file = csv.writer(f)
+            report_file.writerow(['wav', 'text', 'transcript', 'offsets', 'CER', 'WER'])
+            report_file.writerows(sorted(report_rows, key=lambda row: order[row[0]]))
+    if args.output_path:
+        processed_files = []
+        for shard in shards:
+            with open(shard + '.outputs.txt') as f:
+                processed_files.extend(line.strip() for line in f if line.strip())
+        with open(args.output_path, 'w') as f:
+            f.write('\n'.join(sorted(processed_files, key=lambda fn: order[fn[:-len('.ts')]])))
+    if args.output_store:
+        merge_stores(args.output_store, [shard + '.store' for shard in shards])
+        print("Saved outputs to {}".format(args.output_store))
+
+    summary = {}
+    for shard in shards:
+        with open(shard + '.json') as f:
+            for key, value in json.load(f).items():
+                summary[key] = summary.get(key, 0) + value
+    summary['wall_time'] = time.perf_counter() - start_time
+    print_summary(summary)
+    shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    if args.eval_processes > 1:
+        evaluate_sharded(args.eval_processes)
+        sys.exit(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.set_grad_enabled(False)
+    model = DeepSpeech.load_model(args.model_path)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    model = model.to(device)
+    model.eval()
+
+    labels = DeepSpeech.get_labels(model)
+    audio_conf = DeepSpeech.get_audio_conf(model)
+
+    report_file = None
+    if args.report_file:
+        os.makedirs(os.path.dirname(args.report_file), exist_ok=True)
+        report_file = csv.writer(open(args.report_file, 'wt'))
+        report_file.writerow(['wav', 'text', 'transcript', 'offsets', 'CER', 'WER'])
+
+    if args.decoder == "beam":
+        from decoder import create_beam_decoder
+
+        decoder = create_beam_decoder(labels, implementation=args.beam_decoder, lm_path=args.lm_path,
+                                      alpha=args.alpha, beta=args.beta, cutoff_top_n=args.cutoff_top_n,
+                                      cutoff_prob=args.cutoff_prob, beam_width=args.beam_width,
+                                      num_processes=args.lm_workers)
+    elif args.decoder == "greedy":
+        decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
+    else:
+        decoder = None
+    target_decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
+    test_dataset = SpectrogramDataset(audio_conf=audio_conf,
+                                      manifest_filepath=args.test_manifest,
+                                      cache_path=args.cache_dir,
+                                      labels=labels,
+                                      normalize=args.norm)
+    # import random;random.shuffle(test_dataset.ids)
+
+    order = None
+    if args.sort_by_duration or args.eval_cache:
+        order = {wav: i for i, (wav, _, _) in reversed(list(enumerate(test_dataset.ids)))}
+    eval_cache, cached_rows = None, []
+    if args.eval_cache:
+        eval_cache = EvalCache(args.eval_cache, model, audio_conf, args.norm)
+        missing_rows = []
+        for row in tqdm(test_dataset.ids, desc='Looking up the evaluation cache'):
+            (cached_rows if eval_cache.contains(row[0]) else missing_rows).append(row)
+        test_dataset.ids = missing_rows
+        test_dataset.size = len(missing_rows)
+    if args.sort_by_duration:
+        durations = test_dataset.durations()
+        sampler = DurationBatchSampler(durations, args.batch_size, args.batch_frames,
+                                       frames_per_second=1. / test_dataset.window_stride)
+        manifest_batches = [range(i, min(i + args.batch_size, len(durations)))
+                            for i in range(0, len(durations), args.batch_size)]
+        print("Padding: {:.1f}% in manifest order, {:.1f}% sorted by duration ({} batches)".format(
+            100 * padding_ratio(durations, manifest_batches), 100 * padding_ratio(durations, sampler.bins),
+            len(sampler)))
+        test_loader = AudioDataLoader(test_dataset, batch_sampler=sampler, num_workers=args.num_workers)
+    else:
+        test_loader = AudioDataLoader(test_dataset, batch_size=args.batch_size,
+                                      num_workers=args.num_workers)
+    metric_pool = Pool(args.metric_workers) if args.metric_workers > 1 else None
+    output_store = None
+    if args.output_store:
+        output_store = LogitsStoreWriter(args.output_store, labels, topk=args.output_topk, half=args.output_half)
+    report = EvalReport(labels, report_file, output_store, order)
+    timer = StageTimer()
+    pipeline = None
+    if args.pipeline_workers > 0:
+        pipeline = EvalPipeline(decode_outputs, write_outputs, args.pipeline_workers, args.pipeline_queue)
+    num_frames, num_padded_frames, num_utterances, cached_frames = 0, 0, 0, 0
+    start_time = time.perf_counter()
+    data_start = time.perf_counter()
+    for i, data in tqdm(enumerate(test_loader), total=len(test_loader)):
+        timer.add('data', time.perf_counter() - data_start)
+        inputs, targets, filenames, input_percentages, target_sizes = data
+        input_sizes = input_percentages.mul_(int(inputs.size(3))).int()
+        num_frames += int(input_sizes.sum())
+        num_padded_frames += inputs.size(0) * inputs.size(3)
+        num_utterances += inputs.size(0)
+
+        # unflatten targets
+        split_targets = []
+        offset = 0
+        for size in target_sizes:
+            split_targets.append(targets[offset:offset + size])
+            offset += size
+
+        with timer.measure('forward'):
+            inputs = inputs.to(device)
+
+            # print(inputs.shape, inputs.is_cuda, input_sizes.shape, input_sizes.is_cuda)
+            out0, out, output_sizes = model(inputs, input_sizes)
+            batch = (filenames, out0.cpu().numpy(), out.cpu().numpy(), output_sizes.cpu().numpy(), split_targets)
+        if eval_cache is not None:
+            with timer.measure('cache'):
+                for x in range(len(filenames)):
+                    eval_cache.put(filenames[x], batch[1][x, :batch[3][x]], int(input_sizes[x]))
+
+        del inputs, targets, input_percentages, target_sizes
+        del out, out0, output_sizes
+
+        if decoder is not None:
+            if pipeline is not None:
+                with timer.measure('queue'):
+                    pipeline.put(batch)
+            else:
+                write_outputs(decode_outputs(batch))
+        del batch
 
-        del out, out0, output_sizes, out_raw_cpu, out_softmax_cpu
         if (i + 1) % 5 == 0 or args.batch_size == 1:
             gc.collect()
             torch.cuda.empty_cache()
-
+        data_start = time.perf_counter()
+    for batch, frames in cached_batches(cached_rows, test_dataset, args.batch_size):
+        timer.add('cache', time.perf_counter() - data_start)
+        num_utterances += len(batch[0])
+        num_frames += frames
+        cached_frames += frames
+        if pipeline is not None:
+            with timer.measure('queue'):
+                pipeline.put(batch)
+        else:
+            write_outputs(decode_outputs(batch))
+        data_start = time.perf_counter()
+    if pipeline is not None:
+        with timer.measure('drain'):
+            pipeline.close()
     if decoder is not None:
-        wer_avg = float(total_wer) / num_tokens
-        cer_avg = float(total_cer) / num_chars
+        decoder.close()
+    if metric_pool is not None:
+        metric_pool.close()
+    wall_time = time.perf_counter() - start_time
+    timer.report(wall_time)
+    report.close()
+    if num_padded_frames:
+        print("Padding: {:.1f}% of {} input frames".format(
+            100. * (1 - (num_frames - cached_frames) / num_padded_frames), num_padded_frames))
 
-        print('Test Summary \t'
-              'Average WER {wer:.3f}\t'
-              'Average CER {cer:.3f}\t'.format(wer=wer_avg * 100, cer=cer_avg * 100))
+    summary = {'wer': report.total_wer, 'cer': report.total_cer, 'wer_ref': report.num_tokens,
+               'cer_ref': report.num_chars, 'utterances': num_utterances,
+               'audio_seconds': num_frames * test_dataset.window_stride, 'wall_time': wall_time}
+    if eval_cache is not None:
+        summary.update(cache_hits=eval_cache.hits, cache_misses=eval_cache.misses)
+    print_summary(summary)
+    if args.summary_file:
+        with open(args.summary_file, 'w') as f:
+            json.dump(summary, f)
+    if output_store is not None:
+        output_store.close()
+        print("Saved outputs of {} utterances to {}".format(len(output_store.index), args.output_store))
     if args.output_path:
         import pickle
         with open(args.output_path, 'w') as f:
-            f.write('\n'.join(processed_files))
+            f.write('\n'.join(report.processed_files))
@@ -0,0 +1,72 @@
+import pytest
+
+from arpa_lm import ArpaLM, UNK_LOG_PROB
+
+ARPA = """
+\\data\\
+ngram 1=4
+ngram 2=2
+ngram 3=1
+
+\\1-grams:
+-1.0 <s> -0.5
+-0.7 a -0.3
+-0.9 b -0.2
+-1.2 </s>
+
+\\2-grams:
+-0.2 <s> a -0.6
+-0.4 a b
+
+\\3-grams:
+-0.1 <s> a b
+
+\\end\\
+"""
+
+
+@pytest.fixture(params=['arpa', 'npz'])
+def lm(request, tmp_path):
+    path = str(tmp_path / 'lm.arpa')
+    with open(path, 'w') as f:
+        f.write(ARPA)
+    lm = ArpaLM.load(path)
+    if request.param == 'npz':
+        lm.save(str(tmp_path / 'lm.npz'))
+        lm = ArpaLM.load(str(tmp_path / 'lm.npz'))
+    return lm
+
+
+def ids(lm, *words):
+    return tuple(lm.word_id(w) for w in words)
+
+
+def test_score_uses_longest_ngram(lm):
+    log_prob, context = lm.score(ids(lm, '<s>', 'a'), lm.word_id('b'))
+    assert log_prob == pytest.approx(-0.1)
+    assert context == ids(lm, 'a', 'b')
+
+
+def test_score_backs_off_to_bigram(lm):
+    # no trigram "b a b" and no bigram "b a" to take a backoff weight from
+    log_prob, context = lm.score(ids(lm, 'b', 'a'), lm.word_id('b'))
+    assert log_prob == pytest.approx(-0.4)
+    assert context == ids(lm, 'a', 'b')
+
+
+def test_score_backs_off_to_unigram(lm):
+    # p(a) plus the backoff weights of "<s> a" and "a"
+    log_prob, context = lm.score(ids(lm, '<s>', 'a'), lm.word_id('a'))
+    assert log_prob == pytest.approx(-0.7 - 0.6 - 0.3)
+    assert context == ids(lm, 'a')
+
+
+def test_score_from_sentence_start(lm):
+    log_prob, context = lm.score(lm.sentence_start(), lm.word_id('b'))
+    assert log_prob == pytest.approx(-0.9 - 0.5)
+    assert context == ids(lm, 'b')
+
+
+def test_unknown_word(lm):
+    assert lm.word_id('zzz') is None
+    assert lm.score(ids(lm, 'a'), lm.word_id('zzz')) == (UNK_LOG_PROB, ())
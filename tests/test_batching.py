@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from batching import MicroBatcher
+
+
+def batcher_with(lengths, max_batch_size):
+    batcher = MicroBatcher(lambda items: items, max_batch_size=max_batch_size, num_workers=0)
+    batcher._pending = [(float(i), length, i, None) for i, length in enumerate(lengths)]
+    return batcher
+
+
+def taken(batcher):
+    return sorted(item for _, _, item, _ in batcher._take())
+
+
+def test_take_groups_the_oldest_with_the_closest_lengths():
+    batcher = batcher_with([50, 10, 90, 48, 55, 11, 52], max_batch_size=3)
+    assert taken(batcher) == [0, 3, 6]
+    assert [item for _, _, item, _ in batcher._pending] == [1, 2, 4, 5]
+
+
+def test_take_always_includes_the_oldest():
+    batcher = batcher_with([100, 10, 11, 12, 13], max_batch_size=2)
+    assert taken(batcher) == [0, 4]
+
+
+def test_take_everything_when_the_batch_is_not_full():
+    batcher = batcher_with([5, 1, 3], max_batch_size=8)
+    assert taken(batcher) == [0, 1, 2]
+    assert batcher._pending == []
+
+
+def test_results_go_to_their_requests():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=4, max_wait_ms=20)
+    try:
+        with ThreadPoolExecutor(16) as pool:
+            results = list(pool.map(lambda i: batcher(i, length=i % 5), range(64)))
+    finally:
+        batcher.close()
+    assert results == [i * 2 for i in range(64)]
+    stats = batcher.stats()
+    assert stats['requests'] == 64
+    assert stats['batches'] < 64
@@ -0,0 +1,51 @@
+import wave
+
+import numpy as np
+
+from data.data_loader import iter_audio, quiet_point
+
+
+def test_quiet_point_finds_the_silence():
+    sample_rate = 1000
+    audio = np.random.RandomState(0).randn(3 * sample_rate).astype(np.float32)
+    audio[2500:2540] = 0
+    point = quiet_point(audio, sample_rate, search_seconds=1., frame_seconds=0.02)
+    assert 2500 <= point < 2540
+
+
+def test_quiet_point_only_searches_the_end():
+    sample_rate = 1000
+    audio = np.random.RandomState(0).randn(3 * sample_rate).astype(np.float32)
+    audio[500:1000] = 0
+    point = quiet_point(audio, sample_rate, search_seconds=1.)
+    assert point >= 2000
+
+
+def test_quiet_point_of_short_audio():
+    audio = np.ones(10, dtype=np.float32)
+    assert quiet_point(audio, 1000, frame_seconds=0.02) == 10
+    assert quiet_point(np.zeros(0, dtype=np.float32), 1000) == 0
+
+
+def write_wav(path, samples, sample_rate, channels=1):
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.astype('<i2').tobytes())
+
+
+def test_iter_audio_reads_wav_in_blocks(tmp_path):
+    samples = np.arange(-2500, 2500, dtype=np.int16)
+    write_wav(tmp_path / 'a.wav', samples, 1000)
+    blocks = list(iter_audio(str(tmp_path / 'a.wav'), 1000, block_seconds=2.))
+    assert [len(b) for b in blocks] == [2000, 2000, 1000]
+    assert np.array_equal(np.concatenate(blocks), samples.astype(np.float32) * 65536)
+
+
+def test_iter_audio_channels(tmp_path):
+    stereo = np.stack([np.full(100, 100), np.full(100, 300)], axis=1).ravel()
+    write_wav(tmp_path / 'b.wav', stereo, 1000, channels=2)
+    path = str(tmp_path / 'b.wav')
+    assert (np.concatenate(list(iter_audio(path, 1000))) == 200 * 65536).all()
+    assert (np.concatenate(list(iter_audio(path, 1000, channel=1))) == 300 * 65536).all()
@@ -0,0 +1,102 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from decoder import GreedyDecoder, PrefixBeamCTCDecoder, Scorer
+
+LABELS = "_'ABC "
+
+
+def test_collapse_batch_removes_blanks_and_repeats():
+    decoder = GreedyDecoder(LABELS, blank_index=0)
+    # A A _ A B B space C -> "AAB C", repeats only merge without a blank in between
+    sequences = torch.tensor([[2, 2, 0, 2, 3, 3, 5, 4]])
+    strings, offsets = decoder.collapse_batch(sequences)
+    assert strings == [['AAB C']]
+    assert offsets[0][0].tolist() == [0, 3, 4, 6, 7]
+
+
+def test_collapse_batch_respects_sizes():
+    decoder = GreedyDecoder(LABELS, blank_index=0)
+    sequences = torch.tensor([[2, 3, 4, 4],
+                              [4, 0, 0, 0]])
+    strings, offsets = decoder.collapse_batch(sequences, sizes=[2, 4])
+    assert strings == [['AB'], ['C']]
+    assert [o[0].tolist() for o in offsets] == [[0, 1], [0]]
+
+
+def test_collapse_batch_matches_convert_to_strings():
+    decoder = GreedyDecoder(LABELS, blank_index=0)
+    generator = torch.Generator().manual_seed(0)
+    sequences = torch.randint(0, len(LABELS), (16, 30), generator=generator)
+    sizes = torch.randint(0, 31, (16,), generator=generator)
+    strings, offsets = decoder.collapse_batch(sequences, sizes)
+    expected_strings, expected_offsets = decoder.convert_to_strings(sequences, sizes, remove_repetitions=True,
+                                                                    return_offsets=True)
+    assert strings == expected_strings
+    for o, expected in zip(offsets, expected_offsets):
+        assert o[0].tolist() == list(expected[0].tolist() if torch.is_tensor(expected[0]) else expected[0])
+
+
+def test_prefix_beam_search_keeps_one_beam_per_prefix():
+    # a prefix is pruned while its extension stays in the beam, and is extended to again later: the extensions
+    # have to reuse the existing nodes, otherwise two beams hold "axax"
+    probs = np.array([[0.08, 0.00, 0.88, 0.04],
+                      [0.04, 0.52, 0.35, 0.09],
+                      [0.13, 0.00, 0.69, 0.18],
+                      [0.00, 0.89, 0.00, 0.11],
+                      [0.01, 0.31, 0.66, 0.02],
+                      [0.30, 0.49, 0.02, 0.19]])
+    decoder = PrefixBeamCTCDecoder("_xab", beam_width=3, cutoff_top_n=4, num_processes=1)
+    transcripts = [transcript for transcript, _ in decoder.decode_utterance(probs)]
+    assert len(transcripts) == len(set(transcripts)) == 3
+    assert transcripts[0] == 'axax'
+
+
+class LengthScorer(Scorer):
+    def start(self):
+        return ()
+
+    def score(self, state, word):
+        return -float(len(word)), state + (word,)
+
+
+def test_scorer_cache_shared_by_threads():
+    scorer = LengthScorer(alpha=2, beta=1, cache_size=50)
+    words = ['w%d' % (i % 200) for i in range(20000)]
+
+    def score(word):
+        return scorer.word_score((), word)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(score, words))
+    assert results == [(-2. * len(word) + 1, (word,)) for word in words]
+    assert len(scorer._cache) <= 50
+    assert scorer.hits + scorer.misses == len(words)
+
+
+def test_scorer_pickles_with_an_empty_cache():
+    scorer = LengthScorer(cache_size=10)
+    scorer.word_score((), 'abc')
+    copy = pickle.loads(pickle.dumps(scorer))
+    assert (len(copy._cache), copy.hits, copy.misses, copy.cache_size) == (0, 0, 0, 10)
+    assert copy.word_score((), 'abc') == scorer.word_score((), 'abc')
+
+
+def test_prefix_beam_pool_follows_lm_weights_and_closes():
+    probs = torch.from_numpy(np.random.RandomState(0).dirichlet(np.ones(4), size=(3, 12)))
+    serial = PrefixBeamCTCDecoder("_ ab", scorer=LengthScorer(cache_size=10), beam_width=4, num_processes=1)
+    decoder = PrefixBeamCTCDecoder("_ ab", scorer=LengthScorer(cache_size=10), beam_width=4, num_processes=2)
+    try:
+        assert decoder.decode(probs)[0] == serial.decode(probs)[0]
+        pool = decoder._pool
+        for alpha, beta in [(1, 0.5), (3, -1)]:
+            serial.set_lm_weights(alpha, beta)
+            decoder.set_lm_weights(alpha, beta)
+            assert decoder.decode(probs)[0] == serial.decode(probs)[0]
+        assert decoder._pool is pool
+    finally:
+        decoder.close()
+    assert decoder._pool is None
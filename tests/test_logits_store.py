@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from logits_store import LogitsStore, LogitsStoreWriter, merge_stores
+
+
+def test_merge_stores(tmp_path):
+    rng = np.random.RandomState(0)
+    utterances = {}
+    parts = []
+    for p in range(2):
+        part = str(tmp_path / 'part{}'.format(p))
+        writer = LogitsStoreWriter(part, "_ab ", shard_frames=16)
+        for u in range(3):
+            probs = rng.rand(5 + u * 4, 4).astype(np.float32)
+            utterance_id = 'u{}_{}'.format(p, u)
+            utterances[utterance_id] = probs
+            writer.add(utterance_id, probs, reference='ref ' + utterance_id)
+        writer.close()
+        parts.append(part)
+    merge_stores(str(tmp_path / 'merged'), parts)
+    store = LogitsStore(str(tmp_path / 'merged'))
+    assert sorted(store.ids) == sorted(utterances)
+    for i, utterance_id in enumerate(store.ids):
+        assert np.array_equal(store.get(i), utterances[utterance_id])
+        assert store.references[i] == 'ref ' + utterance_id
+
+
+def test_merge_no_stores(tmp_path):
+    with pytest.raises(ValueError):
+        merge_stores(str(tmp_path / 'merged'), [])
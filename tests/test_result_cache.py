@@ -0,0 +1,65 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from result_cache import ResultCache
+
+
+def test_concurrent_requests_are_coalesced():
+    cache = ResultCache(max_entries=4)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'text'
+
+    with ThreadPoolExecutor(8) as pool:
+        first = pool.submit(cache.get, 'key', compute)
+        started.wait(5)
+        others = [pool.submit(cache.get, 'key', compute) for _ in range(7)]
+        while cache.stats()['coalesced'] < 7:
+            time.sleep(0.001)
+        release.set()
+        assert first.result() == 'text'
+        assert [f.result() for f in others] == ['text'] * 7
+    assert len(calls) == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced'], stats['hits'], stats['in_flight']) == (1, 7, 0, 0)
+    assert cache.get('key', compute) == 'text'
+    assert cache.stats()['hits'] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResultCache(max_entries=2)
+    cache.get('a', lambda: 1)
+    cache.get('b', lambda: 2)
+    cache.get('a', lambda: None)  # hit, b becomes the least recently used
+    cache.get('c', lambda: 3)
+    assert cache.get('a', lambda: None) == 1
+    assert cache.get('b', lambda: 4) == 4
+    stats = cache.stats()
+    assert (stats['entries'], stats['evictions'], stats['hits'], stats['misses']) == (2, 2, 2, 4)
+
+
+def test_errors_reach_waiters_and_are_not_cached():
+    cache = ResultCache()
+
+    def fail():
+        raise ValueError('bad audio')
+
+    with pytest.raises(ValueError):
+        cache.get('key', fail)
+    assert cache.get('key', lambda: 'ok') == 'ok'
+    assert cache.stats()['misses'] == 2
+
+
+def test_disabled_cache_keeps_nothing():
+    cache = ResultCache(max_entries=0)
+    assert cache.get('key', lambda: 1) == 1
+    assert cache.get('key', lambda: 2) == 2
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,46 @@
+import numpy as np
+
+from sparse_logits import sparsify, densify
+
+
+def random_probs(frames=40, labels=29, seed=0):
+    logits = np.random.RandomState(seed).randn(frames, labels) * 3
+    probs = np.exp(logits)
+    return (probs / probs.sum(1, keepdims=True)).astype(np.float32)
+
+
+def test_all_labels_round_trip_exactly():
+    probs = random_probs()
+    assert np.array_equal(densify(sparsify(probs, k=probs.shape[1])), probs)
+
+
+def test_top_k_keeps_the_largest_probabilities():
+    probs = random_probs()
+    dense = densify(sparsify(probs, k=3), fill=False)
+    top = np.argsort(-probs, axis=1)[:, :3]
+    assert np.array_equal(np.take_along_axis(dense, top, 1), np.take_along_axis(probs, top, 1))
+    assert ((dense > 0).sum(1) == 3).all()
+    assert np.array_equal(dense.argmax(1), probs.argmax(1))
+
+
+def test_fill_spreads_the_dropped_mass():
+    probs = random_probs()
+    dense = densify(sparsify(probs, k=3), fill=True)
+    assert np.allclose(dense.sum(1), 1., atol=1e-5)
+    assert (dense > 0).all()
+
+
+def test_half_precision():
+    probs = random_probs()
+    sparse = sparsify(probs, k=5, half=True)
+    assert sparse['values'].dtype == np.float16
+    assert np.allclose(densify(sparse, fill=False).max(1), probs.max(1), atol=1e-3)
+
+
+def test_run_length_encoding_of_blank_frames():
+    probs = random_probs(frames=10, labels=5)
+    probs[2:7] = [0.97, 0.01, 0.01, 0.005, 0.005]
+    sparse = sparsify(probs, k=5, rle_threshold=0.9, blank_index=0)
+    assert len(sparse['values']) == 6
+    assert sparse['repeats'].tolist() == [1, 1, 5, 1, 1, 1]
+    assert np.array_equal(densify(sparse), probs)
@@ -0,0 +1,23 @@
+import json
+
+from transcribe import find_audio_files, read_done_ids
+
+
+def test_find_audio_files(tmp_path):
+    (tmp_path / 'calls' / 'day2').mkdir(parents=True)
+    for name in ['calls/b.wav', 'calls/a.flac', 'calls/notes.txt', 'calls/day2/c.wav', 'extra.wav']:
+        (tmp_path / name).touch()
+    manifest = tmp_path / 'test.csv'
+    manifest.write_text('{0}/m.wav,{0}/m.txt,3.5\n{0}/extra.wav,{0}/extra.txt\n'.format(tmp_path))
+    found = find_audio_files([str(tmp_path / 'calls'), str(manifest), str(tmp_path / '*.wav')])
+    assert found == [(str(tmp_path / 'calls' / 'a.flac'), 0), (str(tmp_path / 'calls' / 'b.wav'), 0),
+                     (str(tmp_path / 'calls' / 'day2' / 'c.wav'), 0), (str(tmp_path / 'm.wav'), 3.5),
+                     (str(tmp_path / 'extra.wav'), 0)]
+
+
+def test_read_done_ids_drops_a_cut_off_line(tmp_path):
+    output = tmp_path / 'out.jsonl'
+    assert read_done_ids(str(output)) == set()
+    output.write_text(json.dumps({'id': 'a.wav'}) + '\n' + json.dumps({'id': 'b.wav'}) + '\n{"id": "c.w')
+    assert read_done_ids(str(output)) == {'a.wav', 'b.wav'}
+    assert output.read_text().splitlines() == [json.dumps({'id': 'a.wav'}), json.dumps({'id': 'b.wav'})]
@@ -0,0 +1,37 @@
+import random
+from multiprocessing import Pool
+
+from data.utils import get_batch_cer_wer, ErrorCounts
+from decoder import GreedyDecoder
+
+WORDS = ['the', 'cat', 'sat', 'on', 'a', 'mat', 'hat']
+
+
+def random_sentences(count, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 6))) for _ in range(count)]
+
+
+def test_batch_errors_match_decoder():
+    decoder = GreedyDecoder("_'ABC ")
+    transcripts, references = random_sentences(50, seed=1), random_sentences(50, seed=2)
+    errors, total = get_batch_cer_wer(transcripts, references, chunk_size=7)
+    for (wer, cer, wer_ref, cer_ref), transcript, reference in zip(errors, transcripts, references):
+        assert wer == decoder.wer(transcript, reference)
+        assert cer == decoder.cer(transcript, reference)
+        assert wer_ref == max(len(reference.split()), 1)
+        assert cer_ref == max(len(reference.replace(' ', '')), 1)
+    assert total == ErrorCounts(*[sum(values) for values in zip(*errors)])
+
+
+def test_identical_and_empty():
+    errors, total = get_batch_cer_wer(['the cat ', ''], [' the cat', ''])
+    assert errors == [ErrorCounts(0, 0, 2., 6.), ErrorCounts(0, 0, 1., 1.)]
+    assert get_batch_cer_wer([], []) == ([], ErrorCounts(0, 0, 0., 0.))
+
+
+def test_pool_gives_the_same_errors():
+    transcripts, references = random_sentences(40, seed=3), random_sentences(40, seed=4)
+    with Pool(2) as pool:
+        assert get_batch_cer_wer(transcripts, references, pool=pool, chunk_size=8) == \
+            get_batch_cer_wer(transcripts, references, chunk_size=8)
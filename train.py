@@ -11,8 +11,9 @@ import tqdm
 from enorm.enorm import ENorm
 from warpctc_pytorch import CTCLoss
 
-from data.data_loader import AudioDataLoader, SpectrogramDataset, BucketingSampler, DistributedBucketingSampler
-from data.utils import reduce_tensor, get_cer_wer
+from data.data_loader import AudioDataLoader, SpectrogramDataset, BucketingSampler, DistributedBucketingSampler, \
+    DurationBatchSampler, padding_ratio
+from data.utils import reduce_tensor, get_batch_cer_wer
 from decoder import GreedyDecoder
 from model import DeepSpeech, supported_rnns
 
@@ -32,6 +33,9 @@ parser.add_argument('--curriculum', metavar='DIR',
                     help='path to curriculum file', default='')
 parser.add_argument('--sample-rate', default=16000, type=int, help='Sample rate')
 parser.add_argument('--batch-size', default=20, type=int, help='Batch size for training')
+parser.add_argument('--val-batch-frames', default=0, type=int,
+                    help='Batch validation utterances of similar duration together, up to this many padded '
+                         'spectrogram frames per batch (0 uses --batch-size in manifest order)')
 parser.add_argument('--num-workers', default=4, type=int, help='Number of workers used in data-loading')
 parser.add_argument('--labels-path', default='labels.json', help='Contains all characters for transcription')
 parser.add_argument('--window-size', default=.02, type=float, help='Window size for spectrogram in seconds')
@@ -89,6 +93,14 @@ parser.add_argument('--rank', default=0, type=int,
                     help='The rank of this process')
 parser.add_argument('--gpu-rank', default=None,
                     help='If using distributed parallel for multi-gpu, sets the GPU for the process')
+parser.add_argument('--recompute-rnns', default=0, type=int,
+                    help='Recompute RNN activations in backward for every group of N layers to save memory (0 disables)')
+parser.add_argument('--packed-rnns', dest='packed_rnns', action='store_true',
+                    help='Pack the RNN input once for the whole RNN stack instead of once per layer')
+parser.add_argument('--amp', dest='amp', action='store_true',
+                    help='Mixed precision training: forward under autocast with dynamic loss scaling, CTC loss in fp32')
+parser.add_argument('--amp-dtype', default=None, choices=['float16', 'bfloat16'],
+                    help='Autocast dtype, defaults to float16 with --cuda and bfloat16 on CPU')
 
 torch.manual_seed(123456)
 torch.cuda.manual_seed_all(123456)
@@ -335,17 +347,18 @@ def check_model_quality(epoch, checkpoint, train_loss, train_cer, train_wer):
 
             decoded_output, _ = decoder.decode(probs, output_sizes)
             target_strings = decoder.convert_to_strings(split_targets)
-            for x in range(len(target_strings)):
-                transcript, reference = decoded_output[x][0], target_strings[x][0]
-                wer, cer, wer_ref, cer_ref = get_cer_wer(decoder, transcript, reference)
-                if x < 1:
-                    print("CER: {:6.2f}% WER: {:6.2f}% Filename: {}".format(cer/cer_ref*100, wer/wer_ref*100, filenames[x]))
-                    print('Reference:', reference, '\nTranscript:', transcript)
-
-                val_wer_sum += wer
-                val_cer_sum += cer
-                num_words += wer_ref
-                num_chars += cer_ref
+            transcripts = [x[0] for x in decoded_output]
+            references = [x[0] for x in target_strings]
+            errors, total = get_batch_cer_wer(transcripts, references)
+            if errors:
+                wer, cer, wer_ref, cer_ref = errors[0]
+                print("CER: {:6.2f}% WER: {:6.2f}% Filename: {}".format(cer/cer_ref*100, wer/wer_ref*100, filenames[0]))
+                print('Reference:', references[0], '\nTranscript:', transcripts[0])
+
+            val_wer_sum += total.wer
+            val_cer_sum += total.cer
+            num_words += total.wer_ref
+            num_chars += total.cer_ref
 
             del inputs, targets, input_percentages, target_sizes
             del logits, probs, output_sizes, input_sizes
@@ -414,10 +427,10 @@ class Trainer:
         inputs = inputs.to(device)
         input_sizes = input_sizes.to(device)
 
-        logits, probs, output_sizes = model(inputs, input_sizes)
-        assert logits.is_cuda
-        assert probs.is_cuda
-        assert output_sizes.is_cuda
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=args.amp):
+            logits, probs, output_sizes = model(inputs, input_sizes)
+        # CTC loss and decoding stay in fp32
+        logits, probs = logits.float(), probs.float()
 
         split_targets = []
         offset = 0
@@ -427,15 +440,17 @@ class Trainer:
 
         decoded_output, _ = decoder.decode(probs, output_sizes)
         target_strings = decoder.convert_to_strings(split_targets)
-        for x in range(len(target_strings)):
-            transcript, reference = decoded_output[x][0], target_strings[x][0]
-            wer, cer, wer_ref, cer_ref = get_cer_wer(decoder, transcript, reference)
-            train_dataset.update_curriculum(filenames[x], reference, transcript, None, cer / cer_ref, wer / wer_ref)
-
-            self.train_wer += wer
-            self.train_cer += cer
-            self.num_words += wer_ref
-            self.num_chars += cer_ref
+        transcripts = [x[0] for x in decoded_output]
+        references = [x[0] for x in target_strings]
+        errors, total = get_batch_cer_wer(transcripts, references)
+        for x, (wer, cer, wer_ref, cer_ref) in enumerate(errors):
+            train_dataset.update_curriculum(filenames[x], references[x], transcripts[x], None, cer / cer_ref,
+                                            wer / wer_ref)
+
+        self.train_wer += total.wer
+        self.train_cer += total.cer
+        self.num_words += total.wer_ref
+        self.num_chars += total.cer_ref
 
         logits = logits.transpose(0, 1)  # TxNxH
 
@@ -464,17 +479,24 @@ class Trainer:
 
         # compute gradient
         optimizer.zero_grad()
-        loss.backward()
+        scaler.scale(loss).backward()
 
+        # clip the real gradients, not the scaled ones
+        scaler.unscale_(optimizer)
         torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_norm)
 
         if torch.isnan(logits).any():
             # work around bad data
             print("WARNING: Skipping NaNs in backward step")
+            scaler.update()
         else:
-            # SGD step
-            optimizer.step()
-            if args.enorm: 
+            # SGD step, skipped by the scaler if the gradients overflowed
+            scale = scaler.get_scale()
+            scaler.step(optimizer)
+            scaler.update()
+            if scaler.get_scale() < scale:
+                print("WARNING: Skipping inf/NaN gradients, loss scale reduced to {:.6g}".format(scaler.get_scale()))
+            elif args.enorm:
                 enorm.step()
 
         # measure elapsed time
@@ -553,7 +575,8 @@ def train(from_epoch, from_iter, from_checkpoint):
                                                     checkpoint_loss_results=checkpoint_plots.loss_results,
                                                     checkpoint_wer_results=checkpoint_plots.wer_results,
                                                     checkpoint_cer_results=checkpoint_plots.cer_results,
-                                                    avg_loss=total_loss / num_losses), file_path)
+                                                    avg_loss=total_loss / num_losses,
+                                                    scaler=scaler), file_path)
                     train_dataset.save_curriculum(file_path + '.csv')
 
                     check_model_quality(epoch, checkpoint, total_loss / num_losses, trainer.get_cer(), trainer.get_wer())
@@ -592,6 +615,7 @@ def train(from_epoch, from_iter, from_checkpoint):
                                             checkpoint_loss_results=checkpoint_plots.loss_results,
                                             checkpoint_wer_results=checkpoint_plots.wer_results,
                                             checkpoint_cer_results=checkpoint_plots.cer_results,
+                                            scaler=scaler,
                                             ), file_path)
             train_dataset.save_curriculum(file_path + '.csv')
 
@@ -611,6 +635,7 @@ def train(from_epoch, from_iter, from_checkpoint):
                                             checkpoint_loss_results=checkpoint_plots.loss_results,
                                             checkpoint_wer_results=checkpoint_plots.wer_results,
                                             checkpoint_cer_results=checkpoint_plots.cer_results,
+                                            scaler=scaler,
                                             ),
                        args.model_path)
             train_dataset.save_curriculum(args.model_path + '.csv')
@@ -638,6 +663,11 @@ if __name__ == '__main__':
     checkpoint_plots = PlotWindow(args.id, 'val loss, checkpoints', log_y=True)
     lr_plots = LRPlotWindow(args.id, 'LRFinder', log_x=True)
 
+    if args.amp_dtype is None:
+        args.amp_dtype = 'float16' if args.cuda else 'bfloat16'
+    amp_dtype = getattr(torch, args.amp_dtype)
+    scaler = torch.amp.GradScaler(device.type, enabled=args.amp)
+
     total_avg_loss, start_epoch, start_iter, start_checkpoint = 0, 0, 0, 0
     if args.continue_from:  # Starting from previous model
         print("Loading checkpoint model %s" % args.continue_from)
@@ -650,6 +680,8 @@ if __name__ == '__main__':
         if not args.finetune:  # Don't want to restart training
             model = model.to(device)
             optimizer.load_state_dict(package['optim_dict'])
+            if args.amp and package.get('scaler_dict'):
+                scaler.load_state_dict(package['scaler_dict'])
             set_lr(args.lr)
             start_epoch = int(package.get('epoch', 1)) - 1  # Index start at 0 for training
             start_iter = package.get('iteration', None)
@@ -695,6 +727,9 @@ if __name__ == '__main__':
         parameters = model.parameters()
         optimizer = build_optimizer(args, parameters)
 
+    model.recompute_rnns = args.recompute_rnns
+    if args.packed_rnns:
+        model.packed_rnns = True
     enorm = ENorm(model.named_parameters(), optimizer, c=1)
 
     criterion = CTCLoss()
@@ -710,9 +745,20 @@ if __name__ == '__main__':
         # XXX: A hack to test max memory load.
         train_dataset.ids.reverse()
 
-    test_loader = AudioDataLoader(test_dataset,
-                                  batch_size=args.batch_size,
-                                  num_workers=args.num_workers)
+    if args.val_batch_frames:
+        val_durations = test_dataset.durations()
+        val_sampler = DurationBatchSampler(val_durations, max_frames=args.val_batch_frames,
+                                           frames_per_second=1. / args.window_stride)
+        manifest_batches = [range(i, min(i + args.batch_size, len(val_durations)))
+                            for i in range(0, len(val_durations), args.batch_size)]
+        print("Validation padding: {:.1f}% in manifest order, {:.1f}% sorted by duration ({} batches)".format(
+            100 * padding_ratio(val_durations, manifest_batches), 100 * padding_ratio(val_durations, val_sampler.bins),
+            len(val_sampler)))
+        test_loader = AudioDataLoader(test_dataset, batch_sampler=val_sampler, num_workers=args.num_workers)
+    else:
+        test_loader = AudioDataLoader(test_dataset,
+                                      batch_size=args.batch_size,
+                                      num_workers=args.num_workers)
 
     model = model.to(device)
     if args.distributed:
@@ -1,4 +1,8 @@
 import argparse
+import csv
+import glob
+import sys
+import time
 import warnings
 
 from opts import add_decoder_args, add_inference_args
@@ -7,10 +11,12 @@ warnings.simplefilter('ignore')
 
 from decoder import GreedyDecoder
 
+import numpy as np
 import torch
 
-from data.data_loader import SpectrogramParser
-from model import DeepSpeech
+from data.data_loader import SpectrogramParser, AudioFileDataset, AudioFileDataLoader, DurationBatchSampler, \
+    iter_audio, quiet_point
+from model import DeepSpeech, CNNStreamer
 import os.path
 import json
 
@@ -26,11 +32,33 @@ parser.add_argument('--channel', dest='channel', default='-1', type=int,
                     help='Use specified channel for stereo (0=left, 1=right, -1=average all)')
 parser.add_argument('--meta', dest='meta', action='store_true',
                     help='Returns meta information')
+parser.add_argument('--stream-chunk', default=0, type=float,
+                    help='Feed the audio in chunks of this many seconds through the streaming decoder '
+                         '(cnn models only, 0 disables)')
+parser.add_argument('--long-form-window', default=0, type=float,
+                    help='Transcribe the audio in windows of at most this many seconds, cut at quiet points, so that '
+                         'memory does not depend on its length (0 runs the whole file at once)')
+parser.add_argument('--long-form-context', default=2, type=float,
+                    help='Seconds of audio added on both sides of each window, whose outputs are not kept')
+parser.add_argument('--long-form-batch', default=8, type=int, help='Windows run through the model at once')
+batch_args = parser.add_argument_group("Batch Options",
+                                       "Transcribe many files in length-bucketed batches instead of --audio-path")
+batch_args.add_argument('--inputs', nargs='+', default=None,
+                        help='Audio files, directories (searched recursively), glob patterns or csv manifests '
+                             '(audio path in the first column, optional duration in the third)')
+batch_args.add_argument('--output', default=None,
+                        help='JSON Lines file the transcripts are appended to; files whose id is already in it are '
+                             'skipped, so an interrupted run can be resumed. Printed to stdout if not given')
+batch_args.add_argument('--batch-size', default=16, type=int, help='Files per batch')
+batch_args.add_argument('--batch-frames', default=0, type=int,
+                        help='Fill batches up to this many padded spectrogram frames instead of --batch-size files')
+batch_args.add_argument('--num-workers', default=4, type=int, help='Number of workers computing spectrograms')
 parser = add_decoder_args(parser)
-args = parser.parse_args()
 
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.mp3', '.ogg', '.opus', '.webm')
 
-def decode_results(model, decoded_output, decoded_offsets):
+
+def decode_results(model, decoded_output, decoded_offsets, frame_seconds=None):
     results = {
         "output": [],
     }
@@ -56,6 +84,8 @@ def decode_results(model, decoded_output, decoded_offsets):
             result = {'transcription': decoded_output[b][pi]}
             if args.offsets:
                 result['offsets'] = decoded_offsets[b][pi].tolist()
+                if frame_seconds:
+                    result['times'] = [round(offset * frame_seconds, 3) for offset in result['offsets']]
             results['output'].append(result)
     return results
 
@@ -71,7 +101,204 @@ def transcribe(audio_path, parser, model, decoder, device):
     return decoded_output, decoded_offsets
 
 
+def pad_spects(spects):
+    """
+    :return: FxT spectrograms of different lengths zero-padded into an Nx1xFxT batch, longest first (as packed RNNs
+    expect), their lengths, and the index in spects of every batch entry
+    """
+    order = sorted(range(len(spects)), key=lambda i: -spects[i].size(1))
+    lengths = [spects[i].size(1) for i in order]
+    inputs = torch.zeros(len(spects), 1, spects[0].size(0), lengths[0])
+    for j, i in enumerate(order):
+        inputs[j, 0, :, :lengths[j]] = spects[i]
+    return inputs, torch.IntTensor(lengths), order
+
+
+@torch.no_grad()
+def transcribe_batch(spects, model, decoder, device):
+    """
+    Transcribes several spectrograms (FxT tensors) of different lengths in one forward pass.
+    Grad mode is thread-local, so it is disabled here for the batcher threads of the servers.
+    :return: decoded output and offsets of every spectrogram, as transcribe() returns them for one
+    """
+    inputs, input_sizes, order = pad_spects(spects)
+    out0, out, output_sizes = model(inputs.to(device), input_sizes)
+    decoded_output, decoded_offsets = decoder.decode(out, output_sizes)
+    results = [None] * len(spects)
+    for j, i in enumerate(order):
+        results[i] = ([decoded_output[j]], [decoded_offsets[j]])
+    return results
+
+
+def output_frame_samples(model, parser):
+    """
+    Number of audio samples per output frame of the model.
+    """
+    hop = int(parser.sample_rate * (parser.window_stride + 1e-8))
+    frames = 1000
+    return hop * int(round(frames / model.get_seq_lens(torch.IntTensor([frames]))[0].item()))
+
+
+def transcribe_long(audio_path, parser, model, decoder, device, window_seconds, context_seconds, batch_windows):
+    """
+    Transcribes audio of any length in windows. Each window is cut at the quietest point of its last second and
+    extended by context_seconds of audio on both sides; only its outputs between the cut points are kept.
+    The kept outputs of all windows are decoded together, so words and repeated labels at the cuts are decoded as in
+    one sequence. The audio is read in blocks and windows are run batch_windows at a time, so memory depends on the
+    window length and the batch size; only the kept label probabilities grow with the length of the audio
+    (about 20 MB per hour of audio with 29 labels and 50 output frames per second).
+    :return: decoded output and offsets as transcribe() returns them, offsets are output frames from the start of the
+    file
+    """
+    sample_rate = parser.sample_rate
+    step = output_frame_samples(model, parser)
+    window = max(1, int(window_seconds * sample_rate) // step) * step
+    context = int(context_seconds * sample_rate) // step * step
+    blocks = iter_audio(audio_path, sample_rate, channel=parser.channel)
+    audio, audio_start = np.zeros(0, dtype=np.float32), 0  # buffered samples and their position in the file
+    start, finished = 0, False  # start of the next window in samples, a multiple of step
+    pending = []  # (spect, first output frame of the spect, first and last + 1 output frames to keep)
+    kept = []  # kept label probabilities of the windows, TxV each, in order
+
+    def run_pending():
+        inputs, input_sizes, order = pad_spects([spect for spect, _, _, _ in pending])
+        _, out, output_sizes = model(inputs.to(device), input_sizes)
+        out = out.cpu()
+        for (_, first, keep_start, keep_end), j in zip(pending, np.argsort(order)):
+            kept.append(out[j, keep_start - first:min(keep_end - first, output_sizes[j].item())].clone())
+        del pending[:]
+
+    while True:
+        while not finished and audio_start + len(audio) < start + window + context:
+            block = next(blocks, None)
+            if block is None:
+                finished = True
+            else:
+                audio = np.concatenate((audio, block))
+        end = audio_start + len(audio)
+        if start >= end:
+            break
+        if end >= start + window + context:
+            cut = start + quiet_point(audio[start - audio_start:start + window - audio_start], sample_rate)
+            cut = max(cut // step * step, start + step)
+        else:
+            cut = end
+        left = max(0, start - context)
+        right = min(end, cut + context)
+        spect = parser.parse_audio_samples(audio[left - audio_start:right - audio_start], sample_rate)
+        pending.append((spect.contiguous(), left // step, start // step, -(-cut // step)))
+        start = cut
+        # samples before the left context of the next window are not needed any more
+        drop = max(0, start - context) - audio_start
+        audio, audio_start = audio[drop:], audio_start + drop
+        if len(pending) == batch_windows:
+            run_pending()
+    if pending:
+        run_pending()
+    probs = torch.cat(kept).unsqueeze(0)
+    return decoder.decode(probs, torch.IntTensor([probs.size(1)]))
+
+
+def transcribe_streaming(audio_path, parser, model, decoder, device, chunk_seconds):
+    spect = parser.parse_audio_for_transcription(audio_path).contiguous()
+    chunk = max(1, int(round(chunk_seconds / parser.window_stride)))
+    streamer = CNNStreamer(model)
+    outs = []
+    for i in range(0, spect.size(1), chunk):
+        _, out = streamer.feed(spect[:, i:i + chunk])
+        outs.append(out)
+    _, out = streamer.finish()
+    outs.append(out)
+    out = torch.cat(outs, 0).unsqueeze(0)
+    output_sizes = torch.IntTensor([out.size(1)])
+    decoded_output, decoded_offsets = decoder.decode(out, output_sizes)
+    return decoded_output, decoded_offsets
+
+
+def find_audio_files(inputs):
+    """
+    :param inputs: audio files, directories, glob patterns or csv manifests
+    :return: list of (path, duration in seconds or 0 if unknown) without duplicates, in the order of the inputs
+    """
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                found.extend((os.path.join(root, fn), 0) for fn in sorted(files)
+                             if fn.lower().endswith(AUDIO_EXTENSIONS))
+        elif item.lower().endswith('.csv'):
+            with open(item, newline='') as f:
+                found.extend((row[0], float(row[2]) if len(row) > 2 and row[2] else 0) for row in csv.reader(f))
+        elif glob.has_magic(item):
+            found.extend((path, 0) for path in sorted(glob.glob(item, recursive=True)) if os.path.isfile(path))
+        else:
+            found.append((item, 0))
+    seen = set()
+    return [(path, dur) for path, dur in found if not (path in seen or seen.add(path))]
+
+
+def read_done_ids(output_path):
+    """
+    Ids already transcribed into a JSON Lines output. A line cut off by an interrupted run is dropped from the file.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    done, lines, damaged = set(), [], False
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['id'])
+                lines.append(line)
+            except (ValueError, KeyError):
+                damaged = True
+    if damaged:
+        with open(output_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(output_path + '.tmp', output_path)
+    return done
+
+
+def transcribe_files(inputs, output_path, model, decoder, device, audio_conf):
+    files = find_audio_files(inputs)
+    done = read_done_ids(output_path) if output_path else set()
+    todo = [(path, dur) for path, dur in files if path not in done]
+    print("{} files, {} already transcribed".format(len(files), len(files) - len(todo)), file=sys.stderr)
+    if not todo:
+        return
+    dataset = AudioFileDataset(audio_conf, [path for path, _ in todo], cache_path=args.cache_dir,
+                               normalize='max_frame', channel=args.channel, durations=[dur for _, dur in todo])
+    durations = dataset.durations()
+    sampler = DurationBatchSampler(durations, args.batch_size, args.batch_frames,
+                                   frames_per_second=1. / dataset.window_stride)
+    loader = AudioFileDataLoader(dataset, batch_sampler=sampler, num_workers=args.num_workers)
+    index = {path: i for i, path in enumerate(dataset.paths)}
+    frame_seconds = output_frame_samples(model, dataset) / float(dataset.sample_rate)
+    out = open(output_path, 'a', encoding='utf-8') if output_path else sys.stdout
+    audio_seconds, count = 0., 0
+    start_time = time.perf_counter()
+    try:
+        for spects, paths in loader:
+            results = transcribe_batch(spects, model, decoder, device)
+            for path, (decoded_output, decoded_offsets) in zip(paths, results):
+                result = {'id': path, 'duration': durations[index[path]]}
+                result.update(decode_results(model, decoded_output, decoded_offsets, frame_seconds))
+                out.write(json.dumps(result, ensure_ascii=False) + '\n')
+                audio_seconds += durations[index[path]]
+                count += 1
+            out.flush()  # completed batches are kept when the run is interrupted
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        wall_time = time.perf_counter() - start_time
+        print("Transcribed {} files, {:.1f}s of audio in {:.1f}s: "
+              "RTF {:.4f}, {:.1f}x real time, {:.2f} files/s".format(
+                  count, audio_seconds, wall_time, wall_time / max(audio_seconds, 1e-9),
+                  audio_seconds / max(wall_time, 1e-9), count / max(wall_time, 1e-9)), file=sys.stderr)
+
+
 if __name__ == '__main__':
+    args = parser.parse_args()
     torch.set_grad_enabled(False)
     model = DeepSpeech.load_model(args.model_path)
     device = torch.device("cuda" if args.cuda else "cpu")
@@ -82,19 +309,35 @@ if __name__ == '__main__':
     audio_conf = DeepSpeech.get_audio_conf(model)
 
     if args.decoder == "beam":
-        from decoder import BeamCTCDecoder
+        from decoder import create_beam_decoder
 
-        decoder = BeamCTCDecoder(labels, lm_path=args.lm_path, alpha=args.alpha, beta=args.beta,
-                                 cutoff_top_n=args.cutoff_top_n, cutoff_prob=args.cutoff_prob,
-                                 beam_width=args.beam_width, num_processes=args.lm_workers)
+        decoder = create_beam_decoder(labels, implementation=args.beam_decoder, lm_path=args.lm_path,
+                                      alpha=args.alpha, beta=args.beta, cutoff_top_n=args.cutoff_top_n,
+                                      cutoff_prob=args.cutoff_prob, beam_width=args.beam_width,
+                                      num_processes=args.lm_workers)
     else:
         decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
 
+    if args.inputs:
+        transcribe_files(args.inputs, args.output, model, decoder, device, audio_conf)
+        decoder.close()
+        sys.exit(0)
+
     parser = SpectrogramParser(audio_conf, cache_path=args.cache_dir, 
                                normalize='max_frame', channel=args.channel, augment=True)
 
-    decoded_output, decoded_offsets = transcribe(args.audio_path, parser, model, decoder, device)
-    output = decode_results(model, decoded_output, decoded_offsets)
+    if args.long_form_window > 0:
+        decoded_output, decoded_offsets = transcribe_long(args.audio_path, parser, model, decoder, device,
+                                                          args.long_form_window, args.long_form_context,
+                                                          args.long_form_batch)
+    elif args.stream_chunk > 0:
+        decoded_output, decoded_offsets = transcribe_streaming(args.audio_path, parser, model, decoder, device,
+                                                               args.stream_chunk)
+    else:
+        decoded_output, decoded_offsets = transcribe(args.audio_path, parser, model, decoder, device)
+    decoder.close()
+    frame_seconds = output_frame_samples(model, parser) / float(parser.sample_rate)
+    output = decode_results(model, decoded_output, decoded_offsets, frame_seconds)
     output['input'] = {
         'channel': args.channel,
         'source': args.audio_path}
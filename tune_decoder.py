@@ -1,22 +1,20 @@
 import argparse
 import json
+import math
+import os
 import sys
+import time
 from multiprocessing import Pool
 
 import numpy as np
-import torch
 
-from data.data_loader import SpectrogramDataset, AudioDataLoader
-from decoder import GreedyDecoder, BeamCTCDecoder
-from model import DeepSpeech
+from decoder import create_beam_decoder
+from logits_store import LogitsStore
 from opts import add_decoder_args
 
 parser = argparse.ArgumentParser(description='DeepSpeech transcription')
-parser.add_argument('--model-path', default='models/deepspeech_final.pth',
-                    help='Path to model file created by training')
-parser.add_argument('--logits', default="", type=str, help='Path to logits from test.py')
-parser.add_argument('--test-manifest', metavar='DIR',
-                    help='path to validation manifest csv', default='data/test_manifest.csv')
+parser.add_argument('--logits', default="", type=str, help='Path to the logits store saved by test.py --output-store')
+parser.add_argument('--batch-size', default=20, type=int, help='Batch size for decoding')
 parser.add_argument('--num-workers', default=16, type=int, help='Number of parallel decodes to run')
 parser.add_argument('--output-path', default="tune_results.json", help="Where to save tuning results")
 parser.add_argument('--lm-alpha-from', default=1, type=float, help='Language model weight start tuning')
@@ -25,38 +23,60 @@ parser.add_argument('--lm-beta-from', default=0.0, type=float,
                        help='Language model word bonus (all words) start tuning')
 parser.add_argument('--lm-beta-to', default=0.45, type=float,
                        help='Language model word bonus (all words) end tuning')
-parser.add_argument('--lm-num-alphas', default=45, type=float, help='Number of alpha candidates for tuning')
-parser.add_argument('--lm-num-betas', default=8, type=float, help='Number of beta candidates for tuning')
+parser.add_argument('--lm-num-alphas', default=45, type=int, help='Number of alpha candidates for tuning')
+parser.add_argument('--lm-num-betas', default=8, type=int, help='Number of beta candidates for tuning')
+parser.add_argument('--search', default='grid', choices=['grid', 'halving'],
+                    help='grid decodes all utterances for every candidate. halving (successive halving) decodes a '
+                         'random subset for all candidates, then keeps the best 1/eta of them on eta times larger '
+                         'subsets until the full set')
+parser.add_argument('--halving-utterances', default=100, type=int,
+                    help='Size of the first random subset of the halving search')
+parser.add_argument('--halving-eta', default=3, type=int, help='Reduction factor of the halving search (2 or more)')
+parser.add_argument('--seed', default=123456, type=int, help='Seed of the random order of the halving subsets')
+parser.add_argument('--resume', action='store_true',
+                    help='Continue an interrupted search from the results in --output-path (use the same arguments)')
 parser = add_decoder_args(parser)
 args = parser.parse_args()
+if args.halving_eta < 2:
+    parser.error('--halving-eta must be at least 2')
+if args.halving_utterances < 1:
+    parser.error('--halving-utterances must be at least 1')
 
 
-def decode_dataset(logits, test_dataset, batch_size, lm_alpha, lm_beta, mesh_x, mesh_y, labels, grid_index):
-    print("Beginning decode for {}, {}".format(lm_alpha, lm_beta))
-    test_loader = AudioDataLoader(test_dataset, batch_size=batch_size, num_workers=0)
-    target_decoder = GreedyDecoder(labels, blank_index=labels.index('_'))
-    decoder = BeamCTCDecoder(labels, beam_width=args.beam_width, cutoff_top_n=args.cutoff_top_n,
-                             blank_index=labels.index('_'), lm_path=args.lm_path,
-                             alpha=lm_alpha, beta=lm_beta, num_processes=1)
-    total_cer, total_wer = 0, 0
-    for i, (data) in enumerate(test_loader):
-        inputs, targets, input_percentages, target_sizes = data
+store = None
+decoder = None
+
+
+def load(logits_path):
+    """
+    Opens the logits store and loads the decoder with its language model. Called once before the workers are
+    forked, which inherit both (the store is memory-mapped and the LM is shared copy-on-write).
+    """
+    global store, decoder
+    store = LogitsStore(logits_path)
+    labels = store.labels
+    decoder = create_beam_decoder(labels, implementation=args.beam_decoder, beam_width=args.beam_width,
+                                  cutoff_top_n=args.cutoff_top_n, blank_index=labels.index('_'),
+                                  lm_path=args.lm_path, alpha=0, beta=0, num_processes=1)
 
-        # unflatten targets
-        split_targets = []
-        offset = 0
-        for size in target_sizes:
-            split_targets.append(targets[offset:offset + size])
-            offset += size
 
-        out = torch.from_numpy(logits[i][0])
-        sizes = torch.from_numpy(logits[i][1])
+def init_worker(logits_path):
+    if store is None:  # workers are not forked from the main process, e.g. on Windows
+        load(logits_path)
 
+
+def decode_dataset(batch_size, lm_alpha, lm_beta, indices):
+    """
+    :return: sums of the per-utterance WER and CER over the given utterances
+    """
+    print("Beginning decode for {}, {} ({} utterances)".format(lm_alpha, lm_beta, len(indices)))
+    decoder.set_lm_weights(lm_alpha, lm_beta)
+    total_cer, total_wer = 0, 0
+    for out, sizes, references in store.batches(batch_size, indices=indices):
         decoded_output, _, = decoder.decode(out, sizes)
-        target_strings = target_decoder.convert_to_strings(split_targets)
         wer, cer = 0, 0
-        for x in range(len(target_strings)):
-            transcript, reference = decoded_output[x][0], target_strings[x][0]
+        for x in range(len(references)):
+            transcript, reference = decoded_output[x][0], references[x]
             wer_inst = decoder.wer(transcript, reference) / float(len(reference.split()))
             cer_inst = decoder.cer(transcript, reference) / float(len(reference))
             wer += wer_inst
@@ -64,10 +84,40 @@ def decode_dataset(logits, test_dataset, batch_size, lm_alpha, lm_beta, mesh_x,
         total_cer += cer
         total_wer += wer
 
-    wer = total_wer / len(test_loader.dataset)
-    cer = total_cer / len(test_loader.dataset)
+    return total_wer, total_cer
 
-    return [grid_index, mesh_x, mesh_y, lm_alpha, lm_beta, wer, cer]
+
+def save_results(results, path):
+    with open(path + '.tmp', 'w') as fh:
+        json.dump(results, fh)
+    os.replace(path + '.tmp', path)
+
+
+def evaluate(pool, candidates, end, order, results, done, wers):
+    """
+    Evaluates the candidates on the first `end` utterances of `order`. Only the utterances after those already
+    evaluated for a candidate are decoded, split into chunks so that all workers are busy. A result row
+    [grid index, x, y, alpha, beta, WER, CER, utterances] is saved for every candidate when all its chunks are done.
+    :param done: dict of candidate -> (utterances evaluated, WER sum, CER sum), updated
+    :param wers: dict of candidate -> {utterances: WER}, updated
+    """
+    pending = [c for c in candidates if done[c][0] < end]
+    chunks_per_candidate = max(1, int(math.ceil(args.num_workers / max(len(pending), 1))))
+    futures = {}
+    for c in pending:
+        start = done[c][0]
+        step = int(math.ceil((end - start) / float(chunks_per_candidate)))
+        futures[c] = [pool.apply_async(decode_dataset, (args.batch_size, c[3], c[4], order[i:min(i + step, end)]))
+                      for i in range(start, end, step)]
+    for c in pending:
+        sums = [f.get() for f in futures[c]]
+        _, wer, cer = done[c]
+        done[c] = (end, wer + sum(s[0] for s in sums), cer + sum(s[1] for s in sums))
+        row = list(c) + [done[c][1] / end, done[c][2] / end, end]
+        wers[c][end] = row[5]
+        print("Result calculated:", row)
+        results.append(row)
+        save_results(results, args.output_path)
 
 
 if __name__ == '__main__':
@@ -75,44 +125,59 @@ if __name__ == '__main__':
         print("error: LM must be provided for tuning")
         sys.exit(1)
 
-    model = DeepSpeech.load_model(args.model_path)
-    if args.cuda:
-        model.cuda()
-    model.eval()
+    start_time = time.perf_counter()
+    load(args.logits)
+    load_time = time.perf_counter() - start_time
+    print("Loaded {} utterances and the language model in {:.2f}s".format(len(store), load_time))
 
-    labels = DeepSpeech.get_labels(model)
-    audio_conf = DeepSpeech.get_audio_conf(model)
-    test_dataset = SpectrogramDataset(audio_conf=audio_conf, manifest_filepath=args.test_manifest, labels=labels,
-                                      normalize=True)
-
-    logits = np.load(args.logits)
-    batch_size = logits[0][0].shape[0]
-
-    results = []
-
-
-    def result_callback(result):
-        results.append(result)
-
-
-    p = Pool(args.num_workers)
+    p = Pool(args.num_workers, initializer=init_worker, initargs=(args.logits,))
 
     cand_alphas = np.linspace(args.lm_alpha_from, args.lm_alpha_to, args.lm_num_alphas)
     cand_betas = np.linspace(args.lm_beta_from, args.lm_beta_to, args.lm_num_betas)
     params_grid = []
     for x, alpha in enumerate(cand_alphas):
         for y, beta in enumerate(cand_betas):
-            params_grid.append((alpha, beta, x, y))
-
-    futures = []
-    for index, (alpha, beta, x, y) in enumerate(params_grid):
-        print("Scheduling decode for a={}, b={} ({},{}).".format(alpha, beta, x, y))
-        f = p.apply_async(decode_dataset, (logits, test_dataset, batch_size, alpha, beta, x, y, labels, index),
-                          callback=result_callback)
-        futures.append(f)
-    for f in futures:
-        f.wait()
-        print("Result calculated:", f.get())
-    print("Saving tuning results to: {}".format(args.output_path))
-    with open(args.output_path, "w") as fh:
-        json.dump(results, fh)
+            params_grid.append((len(params_grid), x, y, float(alpha), float(beta)))
+
+    num_utterances = len(store)
+    order = list(np.random.RandomState(args.seed).permutation(num_utterances))
+    done = {c: (0, 0., 0.) for c in params_grid}
+    wers = {c: {} for c in params_grid}
+    results = []
+    if args.resume and os.path.exists(args.output_path):
+        with open(args.output_path) as fh:
+            previous = json.load(fh)
+        by_weights = {(round(c[3], 6), round(c[4], 6)): c for c in params_grid}
+        for row in previous:
+            c = by_weights.get((round(row[3], 6), round(row[4], 6)))
+            if c is not None and len(row) > 7 and done[c][0] < row[7] <= num_utterances:
+                done[c] = (row[7], row[5] * row[7], row[6] * row[7])
+                wers[c][row[7]] = row[5]
+                results.append(list(c) + row[5:8])
+        print("Resuming with {} results from {}".format(len(results), args.output_path))
+
+    decoded_before = sum(d[0] for d in done.values())
+    candidates = params_grid
+    end = num_utterances if args.search == 'grid' else min(args.halving_utterances, num_utterances)
+    while True:
+        print("Evaluating {} candidates on {} utterances".format(len(candidates), end))
+        evaluate(p, candidates, end, order, results, done, wers)
+        if end == num_utterances:
+            break
+        candidates = sorted(candidates, key=lambda c: wers[c][end])
+        candidates = candidates[:max(1, len(candidates) // args.halving_eta)]
+        end = min(num_utterances, end * args.halving_eta)
+    p.close()
+    p.join()
+    decoder.close()
+
+    best = min(candidates, key=lambda c: wers[c][num_utterances])
+    print("Best: alpha {:.4f} beta {:.4f} WER {:.3f} CER {:.3f}".format(
+        best[3], best[4], 100 * done[best][1] / num_utterances, 100 * done[best][2] / num_utterances))
+    decoded = sum(d[0] for d in done.values()) - decoded_before
+    print("Decoded {} utterances, {:.1f}% of the {} the full grid needs".format(
+        decoded, 100. * decoded / (len(params_grid) * num_utterances), len(params_grid) * num_utterances))
+    total_time = time.perf_counter() - start_time
+    print("Tuned {} grid points in {:.1f}s".format(len(params_grid), total_time))
+    save_results(results, args.output_path)
+    print("Saved tuning results to: {}".format(args.output_path))